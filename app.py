@@ -4,33 +4,413 @@ import os
 import json
 import time
 import random
+import heapq
+import math
+import re
+import bisect
+import calendar
+import struct
+import mmap
+from array import array
+import zlib
+import gzip
+import hashlib
+import csv
+import io
+import mimetypes
+import secrets
+import shutil
+import tempfile
+import click
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import islice, repeat
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, session, jsonify, flash
+    url_for, session, jsonify, flash, Response, send_file, current_app
 )
-from markupsafe import escape
+from markupsafe import escape, Markup
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask import request as flask_request  # used for SocketIO sid
 from functools import wraps
+from werkzeug.utils import safe_join
+
+try:
+    import brotli  # optional: enables .br asset variants
+except ImportError:
+    brotli = None
 
 # -----------------------------------------------------
 # Paths & Configuration
 # -----------------------------------------------------
 BASE_DIR = os.path.dirname(__file__)
-DATA_DIR = os.path.join(BASE_DIR, "data")
-USERS_FILE = os.path.join(DATA_DIR, "users.json")
-SENTENCES_FILE = os.path.join(DATA_DIR, "sentences.json")
-HISTORY_FILE = os.path.join(DATA_DIR, "history.json")
-LEVELS_FILE = os.path.join(DATA_DIR, "levels.json")
+
+
+def data_path(*parts):
+    """Path under the current app's DATA_DIR (each create_app() app keeps its own; see Config)."""
+    return os.path.join(current_app.config["DATA_DIR"], *parts)
+
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+ASSET_BUILD_DIR = os.path.join(STATIC_DIR, "build")
+# text assets that get precompressed gzip/brotli siblings
+ASSET_COMPRESSIBLE = (".css", ".js", ".json", ".svg", ".txt", ".html")
+
+# Leaderboards: users kept per time bucket, and (bucket_seconds, bucket_count) per window.
+LEADERBOARD_CAPACITY = int(os.environ.get("LEADERBOARD_CAPACITY", 100))
+LEADERBOARD_WINDOWS = {
+    "daily": (3600, 24),
+    "weekly": (86400, 7),
+    "alltime": (None, 1),
+}
+
+# Socket.IO flood protection: per-sid token buckets as (events per second, burst).
+# Override with e.g. RATE_LIMIT_PROGRESS_UPDATE="10,20".
+def _rate_from_env(event, default):
+    raw = os.environ.get(f"RATE_LIMIT_{event.upper()}")
+    if not raw:
+        return default
+    try:
+        rate, burst = (float(x) for x in raw.split(","))
+        return rate, burst
+    except ValueError:
+        return default
+
+SOCKET_RATE_LIMITS = {
+    "progress_update": _rate_from_env("progress_update", (10.0, 20.0)),
+    "request_race": _rate_from_env("request_race", (0.2, 2.0)),
+    "new_sentence_request": _rate_from_env("new_sentence_request", (0.5, 3.0)),
+}
+# Outbound messages queued for one client before we stop sending it progress
+# broadcasts, and the backlog at which the client is disconnected outright.
+SOCKET_MAX_OUTBOUND_QUEUE = int(os.environ.get("SOCKET_MAX_OUTBOUND_QUEUE", 256))
+SOCKET_DISCONNECT_QUEUE = int(os.environ.get("SOCKET_DISCONNECT_QUEUE", SOCKET_MAX_OUTBOUND_QUEUE * 4))
+
+# Matchmaking: racers per shard, WPM width of a skill bucket, how long a shard
+# waits for same-bucket players before widening, and how long a started race
+# keeps its shard closed to newcomers.
+RACE_SHARD_CAPACITY = int(os.environ.get("RACE_SHARD_CAPACITY", 8))
+MATCH_WPM_BUCKET = int(os.environ.get("MATCH_WPM_BUCKET", 10))
+MATCH_WAIT_BUDGET = float(os.environ.get("MATCH_WAIT_BUDGET", 10))
+RACE_LOCK_SECONDS = float(os.environ.get("RACE_LOCK_SECONDS", 180))
+
+# Spectators get one downsampled snapshot of their level's races per interval.
+SPECTATOR_INTERVAL = float(os.environ.get("SPECTATOR_INTERVAL", 0.5))
+
+# Replays: cap on the recorded timeline bytes kept per racer per race.
+REPLAY_MAX_BYTES_PER_PLAYER = int(os.environ.get("REPLAY_MAX_BYTES_PER_PLAYER", 64 * 1024))
+
+# Rendered-fragment cache budget (characters of cached HTML/JSON).
+FRAGMENT_CACHE_BYTES = int(os.environ.get("FRAGMENT_CACHE_BYTES", 4 * 1024 * 1024))
+
+# Clock sync: seconds between time_ping rounds per connection.
+CLOCK_SYNC_INTERVAL = float(os.environ.get("CLOCK_SYNC_INTERVAL", 5))
+# Seconds a dropped player keeps their seat and progress for a resume (0 disables).
+SESSION_RESUME_GRACE = float(os.environ.get("SESSION_RESUME_GRACE", 30))
+# History retention: raw runs older than this many days (0 keeps everything) are
+# folded into per-day summaries every HISTORY_COMPACT_INTERVAL seconds.
+HISTORY_RETENTION_DAYS = float(os.environ.get("HISTORY_RETENTION_DAYS", 90))
+HISTORY_COMPACT_INTERVAL = float(os.environ.get("HISTORY_COMPACT_INTERVAL", 6 * 3600))
+# Anti-cheat: sustained WPM and short-burst characters/second nobody types at.
+ANTICHEAT_MAX_WPM = float(os.environ.get("ANTICHEAT_MAX_WPM", 220))
+ANTICHEAT_MAX_BURST_CPS = float(os.environ.get("ANTICHEAT_MAX_BURST_CPS", 25))
+# Corpus imports: newest archived sentences.<version>.json files kept in data/corpus.
+CORPUS_KEEP_VERSIONS = int(os.environ.get("CORPUS_KEEP_VERSIONS", 10))
 
 ADMIN_USERNAME = "abdulmuiz"
 ADMIN_PASSWORD = "muizudeen"
 
-app = Flask(__name__)
-app.secret_key = os.environ.get("SECRET_KEY", "typeforge_dev_secret_key")
 
-# allow CORS for socket clients during development
-socketio = SocketIO(app, cors_allowed_origins="*")
+class Config:
+    """Default settings for create_app(); subclass to override (e.g. DATA_DIR in tests)."""
+    SECRET_KEY = os.environ.get("SECRET_KEY", "typeforge_dev_secret_key")
+    DATA_DIR = os.environ.get("DATA_DIR", os.path.join(BASE_DIR, "data"))
+    # "background": load data in a background task after startup (see /readyz)
+    # "sync": load inside create_app(); "off": never (caller seeds what it needs)
+    WARM_UP = os.environ.get("WARM_UP", "background")
+    BUILD_ASSETS = True
+
+
+class DeferredApp:
+    """Records route/hook registrations so create_app() can replay them on each new Flask app."""
+
+    def __init__(self):
+        self._deferred = []
+
+    def route(self, rule, **options):
+        def decorator(f):
+            endpoint = options.get("endpoint", f.__name__)
+            opts = {k: v for k, v in options.items() if k != "endpoint"}
+            self._deferred.append(lambda app: app.add_url_rule(rule, endpoint, f, **opts))
+            return f
+        return decorator
+
+    def after_request(self, f):
+        self._deferred.append(lambda app: app.after_request(f))
+        return f
+
+    def before_request(self, f):
+        self._deferred.append(lambda app: app.before_request(f))
+        return f
+
+    def context_processor(self, f):
+        self._deferred.append(lambda app: app.context_processor(f))
+        return f
+
+    def template_global(self, name):
+        def decorator(f):
+            self._deferred.append(lambda app: app.add_template_global(f, name))
+            return f
+        return decorator
+
+    def cli_command(self, name):
+        def decorator(f):
+            self._deferred.append(lambda app: app.cli.command(name)(f))
+            return f
+        return decorator
+
+    def init_app(self, app):
+        for register in self._deferred:
+            register(app)
+
+
+web = DeferredApp()
+
+# allow CORS for socket clients during development (bound to the app in create_app)
+socketio = SocketIO()
+
+
+def spawn(f, *args, app=None):
+    """socketio.start_background_task inside an app context (the caller's app unless given),
+    so background loops resolve data_path() against the app that started them."""
+    app = app or current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            f(*args)
+
+    return socketio.start_background_task(run)
+
+
+# -------------------------
+# Socket.IO rate limiting & backpressure
+# -------------------------
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        """Seconds until the next token is available."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+_rate_buckets = {}  # sid -> {event: TokenBucket}
+_socket_stats = {"dropped": {}, "coalesced": {}, "shed": 0, "disconnected_slow": 0}
+
+
+def _count(kind, event):
+    _socket_stats[kind][event] = _socket_stats[kind].get(event, 0) + 1
+
+
+def _bucket_for(sid, event):
+    buckets = _rate_buckets.setdefault(sid, {})
+    bucket = buckets.get(event)
+    if bucket is None:
+        rate, burst = SOCKET_RATE_LIMITS[event]
+        bucket = buckets[event] = TokenBucket(rate, burst)
+    return bucket
+
+
+def rate_limited(event, coalesce=None):
+    """Drop (or hand to `coalesce(sid, data, bucket)`) events over the sid's budget."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            sid = flask_request.sid  # type: ignore[attr-defined]
+            bucket = _bucket_for(sid, event)
+            if bucket.consume():
+                return f(*args, **kwargs)
+            if coalesce is not None:
+                _count("coalesced", event)
+                return coalesce(sid, args[0] if args else {}, bucket)
+            _count("dropped", event)
+        return wrapper
+    return decorator
+
+
+def outbound_backlog(sid):
+    """Number of packets queued on the engine.io socket behind this sid (0 if unknown)."""
+    try:
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, "/")
+        sock = socketio.server.eio.sockets.get(eio_sid)
+        return sock.queue.qsize() if sock else 0
+    except Exception:
+        return 0
+
+
+def stalled_sids(sids):
+    """Return the sids too far behind to receive more broadcasts; drop the hopeless ones."""
+    stalled = []
+    for sid in sids:
+        backlog = outbound_backlog(sid)
+        if backlog >= SOCKET_DISCONNECT_QUEUE:
+            _socket_stats["disconnected_slow"] += 1
+            print(f"[BACKPRESSURE] disconnecting {sid}, {backlog} packets queued")
+            try:
+                socketio.server.disconnect(sid, namespace="/")
+            except Exception:
+                pass
+            stalled.append(sid)
+        elif backlog >= SOCKET_MAX_OUTBOUND_QUEUE:
+            stalled.append(sid)
+    _socket_stats["shed"] += len(stalled)
+    return stalled
+
+
+# -------------------------
+# Connection clock sync (RTT & clock offset per sid)
+# -------------------------
+# Every CLOCK_SYNC_INTERVAL seconds the server emits "time_ping" {"id", "t0"}
+# and the client answers "time_pong" {"id", "t0", "t1", "t2"} with its own
+# receive (t1) and send (t2) times in seconds. NTP-style:
+#   rtt    = (t3 - t0) - (t2 - t1)
+#   offset = ((t1 - t0) + (t2 - t3)) / 2     (client clock minus server clock)
+# RTT is smoothed like TCP's SRTT/RTTVAR; the offset comes from the
+# lowest-RTT sample of the last 8, the least distorted by queueing.
+# Each pong is answered with "clock_sync" so clients can map server
+# timestamps such as start_at onto their own clock (and we can map their
+# finished_at back onto ours).
+CLOCK_MAX_PENDING = 4  # unanswered pings kept per sid; older ones no longer count
+_clock = {}  # sid -> {"srtt", "rttvar", "offset", "samples": deque, "pending": {id: t0}, "next_id"}
+_rtt_histogram = {}  # upper bound in ms -> samples (log2 buckets)
+_clock_loop = {"running": False}
+
+
+def _clock_state(sid):
+    return _clock.setdefault(sid, {"srtt": None, "rttvar": 0.0, "offset": 0.0,
+                                   "samples": deque(maxlen=8), "pending": {}, "next_id": 0})
+
+
+def send_time_ping(sid):
+    state = _clock_state(sid)
+    state["next_id"] += 1
+    ping_id = state["next_id"]
+    t0 = time.time()
+    state["pending"][ping_id] = t0
+    for stale in [i for i in state["pending"] if i <= ping_id - CLOCK_MAX_PENDING]:
+        del state["pending"][stale]
+    socketio.emit("time_ping", {"id": ping_id, "t0": t0}, to=sid)
+
+
+def record_clock_sample(sid, t0, t1, t2, t3):
+    state = _clock_state(sid)
+    rtt = max(0.0, (t3 - t0) - (t2 - t1))
+    offset = ((t1 - t0) + (t2 - t3)) / 2
+    if state["srtt"] is None:
+        state["srtt"], state["rttvar"] = rtt, rtt / 2
+    else:
+        state["rttvar"] = 0.75 * state["rttvar"] + 0.25 * abs(state["srtt"] - rtt)
+        state["srtt"] = 0.875 * state["srtt"] + 0.125 * rtt
+    state["samples"].append((rtt, offset))
+    state["offset"] = min(state["samples"])[1]
+    bucket = 1
+    while bucket < rtt * 1000 and bucket < 65536:
+        bucket *= 2
+    _rtt_histogram[bucket] = _rtt_histogram.get(bucket, 0) + 1
+    return state
+
+
+def one_way_delay(sid):
+    """Best estimate (seconds) of how long a message from this client took to arrive."""
+    state = _clock.get(sid)
+    return (state["srtt"] or 0.0) / 2 if state else 0.0
+
+
+def client_offset(sid):
+    """Client clock minus server clock (seconds); 0 until the first pong."""
+    state = _clock.get(sid)
+    return state["offset"] if state else 0.0
+
+
+def network_jitter(sid):
+    """Spread (seconds) to expect between send and receive spacing, 0.05-1 s."""
+    state = _clock.get(sid)
+    if not state or state["srtt"] is None:
+        return 0.25
+    return max(0.05, min(1.0, 4 * state["rttvar"]))
+
+
+def timing_tolerance(sid):
+    """How far a client-reported duration may differ from ours: RTT plus jitter, 1-5 s."""
+    state = _clock.get(sid)
+    if not state or state["srtt"] is None:
+        return 5.0
+    return max(1.0, min(5.0, state["srtt"] + 4 * state["rttvar"]))
+
+
+def _clock_sync_loop():
+    while _clock_loop["running"]:
+        for sid in list(players) + list(_spectators):
+            if sid not in _parked:
+                send_time_ping(sid)
+        socketio.sleep(CLOCK_SYNC_INTERVAL)
+
+
+def ensure_clock_sync(sid):
+    if _clock_loop["running"]:
+        send_time_ping(sid)
+    else:
+        # the loop's first round pings every connection, this one included
+        _clock_loop["running"] = True
+        spawn(_clock_sync_loop)
+
+
+@socketio.on("time_pong")
+def handle_time_pong(data):
+    t3 = time.time()
+    sid = flask_request.sid  # type: ignore[attr-defined]
+    state = _clock.get(sid)
+    if not state or not isinstance(data, dict):
+        return
+    t0 = state["pending"].pop(data.get("id"), None)
+    try:
+        t1, t2 = float(data["t1"]), float(data["t2"])
+    except Exception:
+        return
+    if t0 is None or t2 < t1:
+        return
+    state = record_clock_sample(sid, t0, t1, t2, t3)
+    emit("clock_sync", {"rtt_ms": round(state["srtt"] * 1000, 1), "offset_ms": round(client_offset(sid) * 1000, 1)})
+
+
+def rtt_summary():
+    rtts = sorted(s["srtt"] for s in _clock.values() if s["srtt"] is not None)
+
+    def pct(p):
+        return round(rtts[min(len(rtts) - 1, int(p / 100 * len(rtts)))] * 1000, 1) if rtts else None
+
+    return {
+        "connections_measured": len(rtts),
+        "srtt_ms": {"p50": pct(50), "p90": pct(90), "p99": pct(99), "max": pct(100)},
+        "histogram_ms": {f"<={k}": v for k, v in sorted(_rtt_histogram.items())},
+    }
 
 
 # -------------------------
@@ -70,6 +450,7 @@ def _handle_join(data):
     emit("update_progress", {"players": {u: r["players"][u]["progress"] for u in r["players"]}}, room=room) #type: ignore
 
 @socketio.on("new_sentence_request")
+@rate_limited("new_sentence_request")
 def _handle_new_sentence_request(data):
     room = data.get("room")
     sentence = data.get("sentence")
@@ -80,7 +461,8 @@ def _handle_new_sentence_request(data):
     # server time start slightly in future to allow sync on clients
     r["started_at"] = time.time() + 1.5
     r["finished"] = False
-    emit("new_sentence", {"sentence": sentence, "start_at": r["started_at"]}, room=room) #type: ignore
+    # start_at is server time; clients shift it by the offset from clock_sync
+    emit("new_sentence", {"sentence": sentence, "start_at": r["started_at"], "server_now": time.time()}, room=room) #type: ignore
 
 @socketio.on("progress_update")
 def _handle_progress_update(data):
@@ -120,11 +502,13 @@ def _handle_race_finished(data):
     sentence_norm = _normalize_for_compare(server_sentence)
     accuracy = _compute_accuracy(sentence_norm, typed_norm)
     started_at = r.get("started_at") or time.time()
-    finish_time = time.time()
+    sid = flask_request.sid  # type: ignore[attr-defined]
+    # the finish happened one network hop before we received it
+    finish_time = time.time() - one_way_delay(sid)
     duration = finish_time - started_at
-    # sanity-check client_time
+    # sanity-check client_time against this connection's measured latency/jitter
     if isinstance(client_time, (int, float)):
-        if abs(client_time - duration) < 5.0:
+        if abs(client_time - duration) < timing_tolerance(sid):
             duration = client_time
     word_count = len(typed_text.strip().split())
     minutes = max(1/60, duration / 60.0)
@@ -150,7 +534,7 @@ import json, os
 def load_data(filename):
     """Safely load a JSON file and return its contents or an empty list."""
     try:
-        path = os.path.join("data", filename)
+        path = data_path(filename)
         if not os.path.exists(path):
             return []
         with open(path, "r", encoding="utf-8") as f:
@@ -160,7 +544,7 @@ def load_data(filename):
         return []
 
 def ensure_data_dir():
-    os.makedirs(DATA_DIR, exist_ok=True)
+    os.makedirs(data_path(), exist_ok=True)
 
 def load_json(path, default=None):
     ensure_data_dir()
@@ -185,24 +569,807 @@ def save_json(path, obj):
 # Levels & sentences
 # -----------------------------------------------------
 def load_levels():
-    return load_json(LEVELS_FILE, {})
+    return load_json(data_path("levels.json"), {})
 
 def get_level_sentences(level):
-    levels = load_levels()
-    return levels.get(level, {}).get("sentences", [])
+    return get_level_table().meta(level).get("sentences", [])
 
 def pick_level_sentence(level):
     sents = get_level_sentences(level) or []
     return random.choice(sents) if sents else None
 
 def load_sentences_all():
-    return load_json(SENTENCES_FILE, {
+    return load_json(data_path("sentences.json"), {
         "easy": [],
         "medium": [],
         "hard": [],
         "expert": []
     })
 
+# -----------------------------------------------------
+# Sentence feature index (selection by length / difficulty)
+# -----------------------------------------------------
+# Built once per corpus version (sentences.json + levels.json mtimes), by
+# warm-up, `flask ingest-corpus`, `flask compile-corpus` or a background task (never a request). Every
+# passage gets chars, words, punctuation density and a rare-bigram score (mean
+# surprisal, in bits, of its letter pairs against the whole corpus). Each pool
+# keeps two sorted key arrays so a pick by target length or by difficulty
+# percentile is a bisect / index lookup instead of a scan.
+#
+# The index lives in a compiled file, data/corpus/compiled.<version>.bin, that
+# every worker process mmaps read-only, so they all share one copy in the page
+# cache and none of them parses JSON once it exists. Layout (native byte
+# order, 8-byte aligned sections):
+#   header   magic, passages, pools, bigrams, then the section offsets below
+#   offsets  u64[passages + 1] into the blob; passage i is blob[off[i]:off[i+1]]
+#   chars, words  u32[passages];  punct, rare, difficulty  f64[passages]
+#   pools    per pool: kind u8, name, count u32, ids by chars u32[count],
+#            ids by difficulty u32[count]
+#   bigrams  per letter pair: the pair, corpus count u32, postings count u32,
+#            passage ids u32[count], occurrences u32[count] (densest first)
+#   blob     distinct passages as UTF-8, in first-seen order
+# Only the small pool and bigram directories become Python objects; a
+# passage's text and features are read from the mapping when picked.
+CHARS_PER_WORD = 5  # standard WPM word length
+CORPUS_MAGIC = b"TFCORP01"
+_CORPUS_HEADER = struct.Struct("<8sIII10Q")
+_POOL_KINDS = ("sentences", "levels", "all")
+
+
+def _align(buf):
+    buf.extend(b"\0" * (-len(buf) % 8))
+    return len(buf)
+
+
+def compile_corpus(sentences, levels, path):
+    """Write the compiled corpus for these sentences.json / levels.json contents to path."""
+    corpus = {("sentences", k): [t for t in v if isinstance(t, str) and t.strip()] for k, v in sentences.items()}
+    for name, meta in levels.items():
+        corpus[("levels", name)] = [t for t in meta.get("sentences", []) if isinstance(t, str) and t.strip()]
+
+    counts = {}
+    for texts in corpus.values():
+        for text in texts:
+            for bigram in _letter_bigrams(text):
+                counts[bigram] = counts.get(bigram, 0) + 1
+    total = sum(counts.values()) or 1
+    surprisal = {b: -math.log2(c / total) for b, c in counts.items()}
+
+    ids = {}
+    for texts in corpus.values():
+        for text in texts:
+            ids.setdefault(text, len(ids))
+    texts = list(ids)
+    features = [_sentence_features(t, surprisal) for t in texts]
+    corpus[("all", None)] = [t for key in list(corpus) for t in corpus[key]]
+
+    # inverted index: bigram -> passage ids and occurrences, densest (occurrences per char)
+    # first so a drill can stop after the best DRILL_POSTINGS_CAP candidates
+    postings = {}
+    for i, text in enumerate(texts):
+        occurrences = {}
+        for bigram in _letter_bigrams(text):
+            occurrences[bigram] = occurrences.get(bigram, 0) + 1
+        for bigram, n in occurrences.items():
+            postings.setdefault(bigram, []).append((i, n))
+    for bigram, entries in postings.items():
+        entries.sort(key=lambda e: (-e[1] / max(1, features[e[0]]["chars"]), e[0]))
+        postings[bigram] = (array("I", (i for i, _ in entries)), array("I", (n for _, n in entries)))
+
+    buf = bytearray(_CORPUS_HEADER.size)
+    blob = [t.encode("utf-8") for t in texts]
+    offsets = array("Q", [0])
+    for data in blob:
+        offsets.append(offsets[-1] + len(data))
+    sections = []
+    for column in (offsets, array("I", (f["chars"] for f in features)), array("I", (f["words"] for f in features)),
+                   array("d", (f["punct_density"] for f in features)), array("d", (f["rare_bigram"] for f in features)),
+                   array("d", (f["difficulty"] for f in features))):
+        sections.append(_align(buf))
+        buf.extend(column.tobytes())
+
+    sections.append(_align(buf))
+    for (kind, name), pool_texts in corpus.items():
+        name_bytes = (name or "").encode("utf-8")
+        pool_ids = [ids[t] for t in pool_texts]
+        buf.extend(struct.pack("<BH", _POOL_KINDS.index(kind), len(name_bytes)) + name_bytes)
+        _align(buf)
+        buf.extend(struct.pack("<I", len(pool_ids)))
+        buf.extend(array("I", sorted(pool_ids, key=lambda i: features[i]["chars"])).tobytes())
+        buf.extend(array("I", sorted(pool_ids, key=lambda i: features[i]["difficulty"])).tobytes())
+        _align(buf)
+
+    sections.append(_align(buf))
+    for bigram, (posting_ids, posting_counts) in postings.items():
+        pair = bigram.encode("utf-8")
+        buf.extend(struct.pack("<B", len(pair)) + pair)
+        _align(buf)
+        buf.extend(struct.pack("<II", counts.get(bigram, 0), len(posting_ids)))
+        buf.extend(posting_ids.tobytes())
+        buf.extend(posting_counts.tobytes())
+        _align(buf)
+
+    sections.append(_align(buf))
+    for data in blob:
+        buf.extend(data)
+    sections.extend([0] * (10 - len(sections)))
+    _CORPUS_HEADER.pack_into(buf, 0, CORPUS_MAGIC, len(texts), len(corpus), len(postings), *sections)
+
+    # per-process temp name: several workers may compile the same version at once
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(buf)
+    os.replace(tmp, path)
+
+
+class CompiledCorpus:
+    """Read-only mmap view of a compiled corpus file."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mm)
+        magic, n, n_pools, n_bigrams, *sections = _CORPUS_HEADER.unpack_from(self.mm, 0)
+        if magic != CORPUS_MAGIC:
+            raise ValueError(f"{path} is not a compiled corpus")
+        o_offsets, o_chars, o_words, o_punct, o_rare, o_diff, o_pools, o_bigrams, o_blob = sections[:9]
+        self.offsets = view[o_offsets:o_offsets + 8 * (n + 1)].cast("Q")
+        self.chars = view[o_chars:o_chars + 4 * n].cast("I")
+        self.words = view[o_words:o_words + 4 * n].cast("I")
+        self.punct = view[o_punct:o_punct + 8 * n].cast("d")
+        self.rare = view[o_rare:o_rare + 8 * n].cast("d")
+        self.difficulty = view[o_diff:o_diff + 8 * n].cast("d")
+        self.blob = view[o_blob:]
+
+        self.pools = {}
+        pos = o_pools
+        for _ in range(n_pools):
+            kind, name_len = struct.unpack_from("<BH", self.mm, pos)
+            name = str(view[pos + 3:pos + 3 + name_len], "utf-8")
+            pos += 3 + name_len
+            pos += -pos % 8
+            (count,) = struct.unpack_from("<I", self.mm, pos)
+            pos += 4
+            by_chars = view[pos:pos + 4 * count].cast("I")
+            by_difficulty = view[pos + 4 * count:pos + 8 * count].cast("I")
+            pos += 8 * count
+            pos += -pos % 8
+            kind = _POOL_KINDS[kind]
+            self.pools[(kind, None if kind == "all" else name)] = (by_chars, by_difficulty)
+
+        self.bigrams = {}
+        pos = o_bigrams
+        for _ in range(n_bigrams):
+            (pair_len,) = struct.unpack_from("<B", self.mm, pos)
+            pair = str(view[pos + 1:pos + 1 + pair_len], "utf-8")
+            pos += 1 + pair_len
+            pos += -pos % 8
+            corpus_count, count = struct.unpack_from("<II", self.mm, pos)
+            pos += 8
+            self.bigrams[pair] = (corpus_count, view[pos:pos + 4 * count].cast("I"),
+                                  view[pos + 4 * count:pos + 8 * count].cast("I"))
+            pos += 8 * count
+            pos += -pos % 8
+
+    def __len__(self):
+        return len(self.chars)
+
+    def text(self, i):
+        # decoded straight from the mapped pages; no intermediate bytes copy
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def feature(self, i):
+        return {
+            "text": self.text(i),
+            "chars": self.chars[i],
+            "words": self.words[i],
+            "punct_density": self.punct[i],
+            "rare_bigram": self.rare[i],
+            "difficulty": self.difficulty[i],
+        }
+
+
+class _FeatureSeq:
+    """Sequence of feature dicts over an id array (materialized per access)."""
+
+    def __init__(self, corpus, ids):
+        self.corpus = corpus
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.corpus.feature(j) for j in self.ids[i]]
+        return self.corpus.feature(self.ids[i])
+
+
+class _CharKeys:
+    """chars of each id in an id array, for bisect."""
+
+    def __init__(self, corpus, ids):
+        self.chars = corpus.chars
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.chars[self.ids[i]]
+
+
+class SentencePool:
+    def __init__(self, corpus, by_chars_ids, by_difficulty_ids):
+        self.by_chars = _FeatureSeq(corpus, by_chars_ids)
+        self.char_keys = _CharKeys(corpus, by_chars_ids)
+        self.by_difficulty = _FeatureSeq(corpus, by_difficulty_ids)
+
+    def __len__(self):
+        return len(self.by_chars)
+
+    def random(self):
+        return random.choice(self.by_chars) if self.by_chars else None
+
+    def pick_by_length(self, target_chars, spread=2):
+        """One of the passages closest in length to target_chars."""
+        if not self.by_chars:
+            return None
+        i = bisect.bisect_left(self.char_keys, target_chars)
+        return random.choice(self.by_chars[max(0, i - spread):min(len(self.by_chars), i + spread)])
+
+    def pick_by_percentile(self, percentile, spread=2):
+        """A passage around the given difficulty percentile (0 = easiest, 100 = hardest)."""
+        if not self.by_difficulty:
+            return None
+        n = len(self.by_difficulty)
+        i = round(max(0.0, min(100.0, percentile)) / 100 * (n - 1))
+        return random.choice(self.by_difficulty[max(0, i - spread):min(n, i + spread + 1)])
+
+
+class SentenceIndex:
+    def __init__(self, corpus):
+        self.corpus = corpus
+        total = sum(c for c, _, _ in corpus.bigrams.values()) or 1
+        self.surprisal = {b: -math.log2(c / total) for b, (c, _, _) in corpus.bigrams.items() if c}
+        self.pools = {key: SentencePool(corpus, *ids) for key, ids in corpus.pools.items()}
+
+    def pool(self, kind, name=None):
+        return self.pools.get((kind, name))
+
+    def names(self, kind):
+        return [name for k, name in self.pools if k == kind]
+
+    def postings(self, bigram):
+        """(passage ids, occurrences) of the passages containing bigram."""
+        entry = self.corpus.bigrams.get(bigram)
+        return (entry[1], entry[2]) if entry else ((), ())
+
+
+# ASCII fast paths (regex runs in C); they match the isalpha/isalnum loops exactly for ASCII
+_ASCII_BIGRAM = re.compile(r"(?=([a-z]{2}))")
+_ASCII_PUNCT = re.compile(r"[^a-zA-Z0-9\s]")
+_ASCII_WORDS = re.compile(r"[a-z]+")
+
+
+def _letter_bigrams(text):
+    text = text.lower()
+    if text.isascii():
+        return _ASCII_BIGRAM.findall(text)
+    return [text[i:i + 2] for i in range(len(text) - 1) if text[i].isalpha() and text[i + 1].isalpha()]
+
+
+def _bigram_surprisal(text, surprisal, word_cache=None):
+    """(summed surprisal, bigram count) of text's letter pairs.
+
+    With a word_cache (bulk ingestion) ASCII text is scored per letter run,
+    memoized, since a corpus reuses a small vocabulary; the cache is reset
+    when it grows past 50k words.
+    """
+    if word_cache is None or not text.isascii():
+        bigrams = _letter_bigrams(text)
+        return sum(map(surprisal.get, bigrams, repeat(0.0))), len(bigrams)
+    total, count = 0.0, 0
+    for word in _ASCII_WORDS.findall(text.lower()):
+        stats = word_cache.get(word)
+        if stats is None:
+            if len(word_cache) >= 50000:
+                word_cache.clear()
+            bigrams = [word[i:i + 2] for i in range(len(word) - 1)]
+            stats = word_cache[word] = (sum(map(surprisal.get, bigrams, repeat(0.0))), len(bigrams))
+        total += stats[0]
+        count += stats[1]
+    return total, count
+
+
+def _sentence_features(text, surprisal, word_cache=None):
+    chars = len(text)
+    words = len(text.split())
+    if text.isascii():
+        punct = len(_ASCII_PUNCT.findall(text))
+    else:
+        punct = sum(1 for ch in text if not ch.isalnum() and not ch.isspace())
+    total, count = _bigram_surprisal(text, surprisal, word_cache)
+    rare = total / count if count else 0.0
+    punct_density = punct / max(1, chars)
+    avg_word = chars / max(1, words)
+    return {
+        "text": text,
+        "chars": chars,
+        "words": words,
+        "punct_density": round(punct_density, 4),
+        "rare_bigram": round(rare, 3),
+        # rough composite used for percentile picks: unusual letter pairs,
+        # punctuation and long words all slow typists down
+        "difficulty": round(rare + 10 * punct_density + 0.5 * avg_word, 3),
+    }
+
+
+_sentence_index = {"version": None, "index": None, "missing": None}
+CORPUS_LOCK_STALE = 600  # seconds before a compile lock left by a crashed worker is ignored
+
+
+def corpus_version():
+    # the data dir is part of the version so apps on different DATA_DIRs never share an index
+    return (data_path(), _file_version(data_path("sentences.json")), _file_version(data_path("levels.json")))
+
+
+def compiled_corpus_path(version):
+    # workers see the same file stats, so they agree on the name without reading the corpus
+    return os.path.join(data_path("corpus"), f"compiled.{hashlib.sha1(repr(version).encode()).hexdigest()[:16]}.bin")
+
+
+def compile_current_corpus():
+    """Make sure the current corpus version is compiled; returns its path.
+
+    Called from warm-up, the CLI commands and start_corpus_compile(), never
+    per request. A lock file next to the target lets one worker compile
+    while the others wait for its file.
+    """
+    path = compiled_corpus_path(corpus_version())
+    lock = path + ".lock"
+    os.makedirs(data_path("corpus"), exist_ok=True)
+    while not os.path.exists(path):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > CORPUS_LOCK_STALE:
+                    os.remove(lock)
+            except OSError:
+                pass
+            socketio.sleep(0.2)
+            continue
+        try:
+            os.close(fd)
+            if not os.path.exists(path):
+                compile_corpus(load_sentences_all(), load_levels(), path)
+                print(f"[CORPUS] Compiled {os.path.basename(path)}")
+                # mmaps of superseded versions stay valid in workers that still hold them
+                for fname in os.listdir(data_path("corpus")):
+                    if fname.startswith("compiled.") and fname.endswith(".bin") and fname != os.path.basename(path):
+                        try:
+                            os.remove(os.path.join(data_path("corpus"), fname))
+                        except OSError:
+                            pass
+        finally:
+            try:
+                os.remove(lock)
+            except OSError:
+                pass
+    return path
+
+
+class _NoCorpus:
+    """Stands in for a compiled corpus before a process has one: no pools, no bigrams."""
+    bigrams = {}
+    pools = {}
+
+    def __len__(self):
+        return 0
+
+
+_corpus_compiles = set()  # data dirs with a background compile running in this process
+
+
+def start_corpus_compile():
+    """Compile the current corpus in a background task (once per data dir at a time)."""
+    key = data_path()
+    if key in _corpus_compiles:
+        return
+    _corpus_compiles.add(key)
+
+    def run():
+        try:
+            compile_current_corpus()
+        except Exception as e:
+            print(f"[CORPUS] background compile failed: {e}")
+        finally:
+            _corpus_compiles.discard(key)
+
+    spawn(run)
+
+
+def get_sentence_index():
+    """The feature index for the current corpus, opened from its compiled file.
+
+    Never compiles: if the current version has no compiled file yet, a
+    background compile starts and the previous index keeps serving; a
+    process with no index at all (warm-up off or still running) serves an
+    empty one until the file lands.
+    """
+    version = corpus_version()
+    if _sentence_index["version"] != version:
+        path = compiled_corpus_path(version)
+        if os.path.exists(path):
+            _sentence_index["index"] = SentenceIndex(CompiledCorpus(path))
+            _sentence_index["version"] = version
+        else:
+            start_corpus_compile()
+            if _sentence_index["missing"] != version:
+                _sentence_index["missing"] = version
+                print(f"[CORPUS] compiling {os.path.basename(path)} in the background; serving the previous corpus")
+            if not _sentence_index["version"] or _sentence_index["version"][0] != version[0]:
+                return SentenceIndex(_NoCorpus())  # nothing compiled for this data dir yet
+    return _sentence_index["index"]
+
+
+@web.cli_command("compile-corpus")
+def compile_corpus_command():
+    """Compile sentences.json + levels.json into the shared mmap index."""
+    print(f"[CORPUS] {compile_current_corpus()} ready")
+
+
+def pick_sentence(pool, seconds=None, wpm=None, percentile=None):
+    """Pick from a SentencePool by target duration (seconds at wpm), difficulty percentile, or at random."""
+    if pool is None or not len(pool):
+        return None
+    if seconds is not None:
+        target_chars = seconds / 60.0 * (wpm or 40) * CHARS_PER_WORD
+        return pool.pick_by_length(target_chars)
+    if percentile is not None:
+        return pool.pick_by_percentile(percentile)
+    return pool.random()
+
+
+# -----------------------------------------------------
+# Per-user bigram weakness profiles & adaptive drills
+# -----------------------------------------------------
+# Clients may attach "keystrokes": [[ms, typed, expected], ...] to a saved run.
+# Each consecutive pair of expected letters is a bigram; we keep per user
+# {bigram: [samples, errors, total_latency_ms]} in data/profiles/<user>.json,
+# updated in place from each run (at most 26*26 entries per user).
+DRILL_MIN_SAMPLES = 5
+DRILL_TARGETS = 5
+DRILL_SENTENCES = 5
+DRILL_POSTINGS_CAP = 2000  # densest passages scored per target bigram
+
+
+def _profile_path(username):
+    return os.path.join(data_path("profiles"), f"{os.path.basename(username)}.json")
+
+
+def load_bigram_profile(username):
+    path = _profile_path(username)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f) or {}
+    except Exception:
+        return {}
+
+
+def update_bigram_profile(username, keystrokes):
+    """Fold one run's keystrokes into the user's bigram stats; returns the number of bigrams counted."""
+    if not username or not isinstance(keystrokes, list):
+        return 0
+    profile = load_bigram_profile(username)
+    prev = None
+    counted = 0
+    for item in keystrokes[:5000]:
+        try:
+            at_ms = float(item[0])
+            typed = str(item[1])[:1]
+            expected = str(item[2])[:1] if len(item) > 2 else typed
+        except Exception:
+            prev = None
+            continue
+        if prev is not None and prev[1].isalpha() and expected.isalpha():
+            stats = profile.setdefault((prev[1] + expected).lower(), [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += int(typed != expected)
+            stats[2] += max(0.0, min(5000.0, at_ms - prev[0]))  # ignore long pauses
+            counted += 1
+        prev = (at_ms, expected)
+    if counted:
+        os.makedirs(data_path("profiles"), exist_ok=True)
+        with open(_profile_path(username), "w", encoding="utf-8") as f:
+            json.dump(profile, f)
+    return counted
+
+
+def weakest_bigrams(profile, limit=DRILL_TARGETS):
+    """Rank bigrams by error rate plus how much slower than the user's average they are."""
+    total_samples = sum(s[0] for s in profile.values())
+    if not total_samples:
+        return []
+    mean_latency = sum(s[2] for s in profile.values()) / total_samples or 1.0
+    ranked = []
+    for bigram, (samples, errors, latency) in profile.items():
+        if samples < DRILL_MIN_SAMPLES:
+            continue
+        error_rate = errors / samples
+        slowness = (latency / samples) / mean_latency - 1
+        ranked.append({
+            "bigram": bigram,
+            "samples": samples,
+            "error_rate": round(error_rate, 3),
+            "mean_latency_ms": round(latency / samples, 1),
+            "score": round(2 * error_rate + slowness, 3),
+        })
+    ranked.sort(key=lambda r: r["score"], reverse=True)
+    return [r for r in ranked if r["score"] > 0][:limit]
+
+
+def build_drill(index, targets, limit=DRILL_SENTENCES):
+    """Passages densest in the target bigrams, gathered from the inverted index only."""
+    scores = {}
+    for target in targets:
+        ids, occurrences = index.postings(target["bigram"])
+        # postings are stored densest first, so the cap only drops weaker candidates
+        for i, n in islice(zip(ids, occurrences), DRILL_POSTINGS_CAP):
+            scores[i] = scores.get(i, 0.0) + target["score"] * n
+    chars = index.corpus.chars
+    best = heapq.nlargest(limit, scores, key=lambda i: scores[i] / max(1, chars[i]))
+    return [index.corpus.text(i) for i in best]
+
+
+def _float_arg(value):
+    try:
+        return float(value) if value is not None and value != "" else None
+    except (TypeError, ValueError):
+        return None
+
+
+# -----------------------------------------------------
+# Corpus ingestion (streamed, deduplicated, versioned)
+# -----------------------------------------------------
+# Reads a text corpus (one passage per line) or JSONL ({"text", "difficulty"?}
+# or a bare string per line) line by line. Passages are cleaned with
+# _normalize_for_compare, deduplicated by an 8-byte hash of their
+# case/punctuation-folded text (the existing corpus seeds the hash set, so
+# only hashes, never passages, stay in memory) and, unless the line names a
+# bucket, classified by the feature index's difficulty score against cut
+# points taken from the curated buckets (or the corpus quartiles when their
+# medians don't rise, or the import's own quartiles when the corpus is too
+# small for either). Each bucket streams to a spool file;
+# the spools are stitched into data/corpus/sentences.<version>.json, which
+# then atomically replaces sentences.json. Versions are the import time plus
+# a random suffix (so same-second imports never collide); the newest
+# CORPUS_KEEP_VERSIONS stay in data/corpus for rollback.
+CORPUS_BUCKETS = ("easy", "medium", "hard", "expert")
+CORPUS_MIN_CHARS = 10
+CORPUS_MAX_CHARS = 1000
+CORPUS_CUT_MIN_PASSAGES = 20  # fewer scored passages than this say nothing about quartiles
+
+
+_NON_ALNUM = re.compile(r"[\W_]+")
+
+
+def _corpus_key(text):
+    """Dedup hash: case, spacing and punctuation don't make a passage new."""
+    folded = _NON_ALNUM.sub("", text.casefold())
+    return hashlib.blake2b(folded.encode("utf-8"), digest_size=8).digest()
+
+
+def clean_passage(text):
+    if not isinstance(text, str):
+        return None
+    text = " ".join(_normalize_for_compare(text).split())
+    return text if CORPUS_MIN_CHARS <= len(text) <= CORPUS_MAX_CHARS else None
+
+
+def corpus_format(filename):
+    return "jsonl" if str(filename or "").lower().endswith((".jsonl", ".ndjson")) else "text"
+
+
+def iter_corpus_entries(f, fmt):
+    """(text, difficulty or None) per non-blank line; unparseable lines yield (None, None)."""
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        if fmt != "jsonl":
+            yield line, None
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            yield None, None
+            continue
+        if isinstance(item, dict):
+            yield item.get("text") or item.get("sentence"), item.get("difficulty") or item.get("level")
+        else:
+            yield item, None
+
+
+def difficulty_cut_points(index):
+    """Scores separating easy/medium/hard/expert, midway between the curated buckets' medians.
+
+    The medians are only used when they rise from easy to expert; otherwise
+    the cuts are the quartiles of the whole corpus, and None when the corpus
+    is too small for either (ingest_corpus then takes the quartiles of the
+    imported passages themselves).
+    """
+    medians = []
+    for name in CORPUS_BUCKETS:
+        pool = index.pool("sentences", name)
+        if not pool or not len(pool):
+            break
+        medians.append(pool.by_difficulty[len(pool) // 2]["difficulty"])
+    if len(medians) == len(CORPUS_BUCKETS) and all(a < b for a, b in zip(medians, medians[1:])):
+        return [(a + b) / 2 for a, b in zip(medians, medians[1:])]
+    # curated buckets missing or overlapping: quartiles of the whole corpus
+    everything = index.pool("all")
+    ranked = [f["difficulty"] for f in everything.by_difficulty] if everything else []
+    return quartile_cut_points(ranked)
+
+
+def quartile_cut_points(scores, minimum=CORPUS_CUT_MIN_PASSAGES):
+    """Quartiles of sorted `scores` as cut points, or None when there are fewer than `minimum`."""
+    if not scores or len(scores) < minimum:
+        return None
+    cuts = [scores[len(scores) * q // 4] for q in (1, 2, 3)]
+    # ties at a quartile would leave a bucket empty; step past them where the scores allow
+    for q in (1, 2):
+        if cuts[q] <= cuts[q - 1]:
+            cuts[q] = next((x for x in scores if x > cuts[q - 1]), cuts[q - 1])
+    return cuts
+
+
+def ingest_corpus(f, fmt="text", replace=False):
+    """Import passages from a text/JSONL stream into a new sentences.json version; returns stats."""
+    index = get_sentence_index()
+    cuts = difficulty_cut_points(index)
+    stats = {"read": 0, "added": 0, "duplicates": 0, "rejected": 0, "kept": 0,
+             "buckets": {name: 0 for name in CORPUS_BUCKETS}}
+    seen = set()
+    word_cache = {}
+    os.makedirs(data_path("corpus"), exist_ok=True)
+    spools = {}
+    pending = None  # without cuts: [score, text] lines placed once the import's own quartiles are known
+    pending_scores = array("d")
+
+    def spool(bucket):
+        if bucket not in spools:
+            spools[bucket] = tempfile.TemporaryFile("w+", encoding="utf-8", dir=data_path("corpus"))
+        return spools[bucket]
+
+    try:
+        for name in CORPUS_BUCKETS:
+            spool(name)
+        if not replace and os.path.exists(data_path("sentences.json")):
+            with open(data_path("sentences.json"), "r", encoding="utf-8") as existing:
+                for bucket, text in _JsonItemStream(existing):
+                    if not isinstance(text, str) or not isinstance(bucket, str):
+                        continue
+                    key = _corpus_key(text)
+                    if key in seen:
+                        stats["duplicates"] += 1
+                        continue
+                    seen.add(key)
+                    spool(bucket).write(json.dumps(text) + "\n")
+                    stats["kept"] += 1
+
+        for text, difficulty in iter_corpus_entries(f, fmt):
+            stats["read"] += 1
+            if stats["read"] % 5000 == 0:
+                socketio.sleep(0)  # let the eventlet worker serve others during big imports
+            text = clean_passage(text)
+            if not text:
+                stats["rejected"] += 1
+                continue
+            key = _corpus_key(text)
+            if key in seen:
+                stats["duplicates"] += 1
+                continue
+            seen.add(key)
+            bucket = str(difficulty).lower() if difficulty else None
+            stats["added"] += 1
+            if bucket not in CORPUS_BUCKETS:
+                score = _sentence_features(text, index.surprisal, word_cache)["difficulty"]
+                if cuts is None:
+                    if pending is None:
+                        pending = tempfile.TemporaryFile("w+", encoding="utf-8", dir=data_path("corpus"))
+                    pending_scores.append(score)
+                    pending.write(json.dumps([score, text]) + "\n")
+                    continue
+                bucket = CORPUS_BUCKETS[bisect.bisect_right(cuts, score)]
+            spool(bucket).write(json.dumps(text) + "\n")
+            stats["buckets"][bucket] += 1
+
+        if pending is not None:
+            # the corpus was too small to place them: split the import itself into quartiles
+            cuts = quartile_cut_points(sorted(pending_scores), minimum=1)
+            pending.seek(0)
+            for line in pending:
+                score, text = json.loads(line)
+                bucket = CORPUS_BUCKETS[bisect.bisect_right(cuts, score)]
+                spool(bucket).write(json.dumps(text) + "\n")
+                stats["buckets"][bucket] += 1
+
+        version = f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+        out_path = os.path.join(data_path("corpus"), f"sentences.{version}.json")
+        with open(out_path, "w", encoding="utf-8") as out:
+            out.write("{")
+            for i, (bucket, fh) in enumerate(spools.items()):
+                fh.seek(0)
+                out.write(("," if i else "") + "\n  " + json.dumps(bucket) + ": [")
+                for j, line in enumerate(fh):
+                    out.write(("," if j else "") + "\n    " + line.rstrip("\n"))
+                out.write("\n  ]")
+            out.write("\n}\n")
+        tmp = f"{data_path('sentences.json')}.{version}.tmp"
+        shutil.copyfile(out_path, tmp)
+        os.replace(tmp, data_path("sentences.json"))
+        stats["version"] = version
+    finally:
+        for fh in spools.values():
+            fh.close()
+        if pending is not None:
+            pending.close()
+    prune_corpus_versions()
+    print(f"[CORPUS] {stats['added']} added, {stats['duplicates']} duplicates, {stats['rejected']} rejected -> {stats.get('version')}")
+    return stats
+
+
+def prune_corpus_versions(keep=None):
+    """Delete all but the newest `keep` archived sentences.<version>.json files."""
+    keep = CORPUS_KEEP_VERSIONS if keep is None else keep
+    if keep <= 0 or not os.path.isdir(data_path("corpus")):
+        return
+    paths = [os.path.join(data_path("corpus"), f) for f in os.listdir(data_path("corpus"))
+             if f.startswith("sentences.") and f.endswith(".json")]
+    paths.sort(key=lambda p: (os.path.getmtime(p), p))
+    for path in paths[:-keep]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@web.cli_command("ingest-corpus")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["text", "jsonl"]), default=None,
+              help="Defaults to jsonl for .jsonl/.ndjson files, else one passage per line.")
+@click.option("--replace", is_flag=True, help="Start from an empty corpus instead of merging.")
+def ingest_corpus_command(path, fmt, replace):
+    """Import a text or JSONL corpus into data/sentences.json."""
+    compile_current_corpus()  # bucket against the current corpus
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        ingest_corpus(f, fmt or corpus_format(path), replace)
+    compile_current_corpus()
+
+
+@web.route("/api/admin/corpus/ingest", methods=["POST"])
+def api_ingest_corpus():
+    """Upload a corpus as multipart field "corpus" or as the raw body; ?format=text|jsonl&replace=1."""
+    user = current_user()
+    if not user or user.get("role") != "admin":
+        return jsonify({"error": "unauthorized"}), 403
+    upload = request.files.get("corpus")
+    stream = upload.stream if upload else request.stream
+    fmt = request.args.get("format") or corpus_format(upload.filename if upload else None)
+    if fmt not in ("text", "jsonl"):
+        return jsonify({"error": "format must be text or jsonl"}), 400
+    replace = request.args.get("replace", "").lower() in ("1", "true", "yes")
+    stats = ingest_corpus(io.TextIOWrapper(stream, encoding="utf-8", errors="replace"), fmt, replace)
+    # the new version compiles in the background; the previous index serves until it lands
+    start_corpus_compile()
+    return jsonify({**stats, "compiling": True}), 202
+
 # -----------------------------------------------------
 # User helpers
 # -----------------------------------------------------
@@ -210,7 +1377,7 @@ def current_user():
     uname = session.get("username")
     if not uname:
         return None
-    users = load_json(USERS_FILE, {})
+    users = load_json(data_path("users.json"), {})
     meta = users.get(uname)
     if not meta:
         return None
@@ -222,29 +1389,97 @@ def current_user():
     return {"username": uname, "role": meta.get("role"), "plan": meta.get("plan"), "level": meta.get("level")}
 
 def save_user_data(username, data):
-    users = load_json(USERS_FILE, {})
+    users = load_json(data_path("users.json"), {})
     users[username] = data
-    save_json(USERS_FILE, users)
+    save_json(data_path("users.json"), users)
 
-def promote_user_if_eligible(username, last_wpm):
-    """Check if user meets thresholds to promote; if premium user reaches > beginner, require premium_plus payment."""
-    users = load_json(USERS_FILE, {})
-    user = users.get(username)
-    if not user:
-        return False, None
+# -----------------------------------------------------
+# Level progression engine
+# -----------------------------------------------------
+class LevelTable:
+    """levels.json compiled once per file version.
+
+    The "range" of each level is flattened into disjoint, sorted WPM segments
+    (earlier levels win where ranges overlap, exactly like the old in-order
+    walk), so level_for_wpm() is a single bisect.
+    """
+
+    def __init__(self, levels):
+        self.levels = levels
+        bounds = []
+        for name, info in levels.items():
+            rng = info.get("range") or [0, 9999]
+            lo = float(rng[0])
+            hi = float(rng[1]) if len(rng) >= 2 else 9999.0
+            bounds.append((name, lo, math.nextafter(hi, math.inf)))  # inclusive max
+        points = sorted({p for _, lo, hi in bounds for p in (lo, hi)})
+        segments = []  # [start, end, level]
+        for start, end in zip(points, points[1:]):
+            owner = next((name for name, lo, hi in bounds if lo <= start < hi), None)
+            if owner is None:
+                continue
+            if segments and segments[-1][2] == owner and segments[-1][1] == start:
+                segments[-1][1] = end
+            else:
+                segments.append([start, end, owner])
+        self.segments = segments
+        self.starts = [seg[0] for seg in segments]
+
+    def level_for_wpm(self, wpm):
+        i = bisect.bisect_right(self.starts, wpm) - 1
+        if i >= 0 and wpm < self.segments[i][1]:
+            return self.segments[i][2]
+        return None
+
+    def meta(self, level):
+        return self.levels.get(level) or {}
+
+    def requirement(self, level):
+        req = self.meta(level).get("requirement", {})
+        return req.get("wins_needed", 3), req.get("min_wpm", 30)
+
+    def rank(self, level):
+        """Position of `level` in levels.json order (-1 when unknown)."""
+        try:
+            return list(self.levels).index(level)
+        except ValueError:
+            return -1
+
+
+_level_table = {"version": None, "table": None}
+
+
+def get_level_table():
+    version = (data_path(), _file_version(data_path("levels.json")))
+    if _level_table["table"] is None or _level_table["version"] != version:
+        _level_table["table"] = LevelTable(load_levels())
+        _level_table["version"] = version
+    return _level_table["table"]
+
+
+def _record_beaten(user, level, opponent_usernames, winner_username):
+    beaten = user.setdefault("beaten", {}).setdefault(level, [])
+    seen = set(beaten)
+    for opp in opponent_usernames:
+        if opp and opp != winner_username and opp not in seen:
+            beaten.append(opp)
+            seen.add(opp)
+    return seen
+
+
+def _try_promote(user, table, last_wpm, beaten=None):
+    """Promote `user` in place if eligible. Returns (promoted, next_level | "premium_needed" | None)."""
     current_level = user.get("level", "beginner")
-    levels = load_levels()
-    lvl_meta = levels.get(current_level)
+    lvl_meta = table.meta(current_level)
     if not lvl_meta:
         return False, None
     # check beaten opponents count at this level
-    beaten = user.get("beaten", {}).get(current_level, [])
-    unique_beaten = len(set(beaten or []))
-    wins_needed = lvl_meta.get("requirement", {}).get("wins_needed", 3)
-    min_wpm = lvl_meta.get("requirement", {}).get("min_wpm", 30)
+    if beaten is None:
+        beaten = set(user.get("beaten", {}).get(current_level, []) or [])
+    wins_needed, min_wpm = table.requirement(current_level)
 
     # promotion requires both unique beaten count >= wins_needed AND last_wpm >= min_wpm
-    if unique_beaten >= wins_needed and last_wpm >= min_wpm:
+    if len(beaten) >= wins_needed and last_wpm >= min_wpm:
         next_level = lvl_meta.get("next")
         if not next_level:
             return False, None
@@ -254,50 +1489,422 @@ def promote_user_if_eligible(username, last_wpm):
             user.setdefault("pending_upgrade_to", "premium_plus")
             user.setdefault("pending_amount", 1000)
             user.setdefault("pending_status", "pending")
-            save_user_data(username, user)
             return False, "premium_needed"
-        # promote
+        # promote; the level formula never takes the user back below this
         user["level"] = next_level
+        user["promoted_to"] = next_level
         # reset beaten list for new level
         user.setdefault("beaten", {})
         user["beaten"][next_level] = []
-        save_user_data(username, user)
         return True, next_level
     return False, None
 
+
+def promote_user_if_eligible(username, last_wpm):
+    """Check if user meets thresholds to promote; if premium user reaches > beginner, require premium_plus payment."""
+    users = load_json(data_path("users.json"), {})
+    user = users.get(username)
+    if not user:
+        return False, None
+    before = json.dumps(user, sort_keys=True)
+    result = _try_promote(user, get_level_table(), last_wpm)
+    if json.dumps(user, sort_keys=True) != before:
+        save_json(data_path("users.json"), users)
+    return result
+
+
 def record_win_and_opponents(winner_username, opponent_usernames, wpm):
     """Record that winner_username beat the listed opponent_usernames at their current level and attempt promotion."""
-    users = load_json(USERS_FILE, {})
+    users = load_json(data_path("users.json"), {})
     user = users.get(winner_username)
     if not user:
         return False, None
-    level = user.get("level", "beginner")
-    beaten = user.setdefault("beaten", {}).setdefault(level, [])
-    for opp in opponent_usernames:
-        if opp not in beaten and opp != winner_username:
-            beaten.append(opp)
-    users[winner_username] = user
-    save_json(USERS_FILE, users)
-    return promote_user_if_eligible(winner_username, wpm)
+    beaten = _record_beaten(user, user.get("level", "beginner"), opponent_usernames, winner_username)
+    result = _try_promote(user, get_level_table(), wpm, beaten)
+    save_json(data_path("users.json"), users)
+    return result
+
+
+def apply_race_result(username, wpm, won, opponent_usernames=()):
+    """Stats, win/beaten recording, level formula and promotion in one users.json read-modify-write."""
+    table = get_level_table()
+    users = load_json(data_path("users.json"), {})
+    user = users.setdefault(username, {})
+
+    # Update performance
+    user["races_played"] = user.get("races_played", 0) + 1
+    user["total_wpm"] = user.get("total_wpm", 0) + wpm
+    user["avg_wpm"] = round(user["total_wpm"] / user["races_played"], 2)
+    if won:
+        user["wins"] = user.get("wins", 0) + 1
+
+    old_level = user.get("level", "beginner")
+    level = calculate_level(user, table)
+    floor = user.get("promoted_to")
+    if floor and table.rank(level) < table.rank(floor):
+        level = floor  # a low average never undoes an earned promotion
+    user["level"] = level
+
+    promotion = None
+    if won:
+        beaten = _record_beaten(user, user["level"], opponent_usernames, username)
+        _, promotion = _try_promote(user, table, wpm, beaten)
+
+    save_json(data_path("users.json"), users)
+    new_level = user["level"]
+    leveled_up = table.rank(new_level) > table.rank(old_level)
+    return {"old_level": old_level, "level": new_level, "leveled_up": leveled_up, "promotion": promotion}
 
 # -----------------------------------------------------
 # Initial data create if not present
 # -----------------------------------------------------
-ensure_data_dir()
-# ensure there's an admin user saved (non-destructive)
-load_json(USERS_FILE, {ADMIN_USERNAME: {"password": ADMIN_PASSWORD, "role": "admin", "plan": "premium_plus", "level": "expert"}})
-load_json(HISTORY_FILE, {})
-# create default sentences file if missing (single-player)
-load_json(SENTENCES_FILE, {"easy": [], "medium": [], "hard": [], "expert": []})
-# ensure levels file exists (user must place the levels.json from earlier)
-if not os.path.exists(LEVELS_FILE):
-    # write a minimal placeholder so server won't crash; recommend replacing with the full file
-    save_json(LEVELS_FILE, {
-        "beginner": {"sentences": [], "requirement": {"wins_needed": 3, "min_wpm": 30}, "next": "intermediate", "range": [0, 29], "reward": "", "description": ""},
-        "intermediate": {"sentences": [], "requirement": {"wins_needed": 3, "min_wpm": 50}, "next": "advanced", "range": [30, 49], "reward": "", "description": ""},
-        "advanced": {"sentences": [], "requirement": {"wins_needed": 3, "min_wpm": 60}, "next": "expert", "range": [50, 84], "reward": "", "description": ""},
-        "expert": {"sentences": [], "requirement": {"wins_needed": 4, "min_wpm": 85}, "next": None, "range": [85, 9999], "reward": "", "description": ""}
-    })
+def init_data_files():
+    """Write defaults for missing data files; files that exist are neither read nor touched."""
+    ensure_data_dir()
+    defaults = {
+        # an admin user to log in with
+        "users.json": {ADMIN_USERNAME: {"password": ADMIN_PASSWORD, "role": "admin", "plan": "premium_plus", "level": "expert"}},
+        "history.json": {},
+        # empty single-player sentence buckets
+        "sentences.json": {"easy": [], "medium": [], "hard": [], "expert": []},
+        # a minimal placeholder so the server won't crash; replace it with the full levels.json
+        "levels.json": {
+            "beginner": {"sentences": [], "requirement": {"wins_needed": 3, "min_wpm": 30}, "next": "intermediate", "range": [0, 29], "reward": "", "description": ""},
+            "intermediate": {"sentences": [], "requirement": {"wins_needed": 3, "min_wpm": 50}, "next": "advanced", "range": [30, 49], "reward": "", "description": ""},
+            "advanced": {"sentences": [], "requirement": {"wins_needed": 3, "min_wpm": 60}, "next": "expert", "range": [50, 84], "reward": "", "description": ""},
+            "expert": {"sentences": [], "requirement": {"wins_needed": 4, "min_wpm": 85}, "next": None, "range": [85, 9999], "reward": "", "description": ""}
+        },
+    }
+    for name, default in defaults.items():
+        if not os.path.exists(data_path(name)):
+            save_json(data_path(name), default)
+
+# -----------------------------------------------------
+# Leaderboards (rolling daily / weekly / all-time windows)
+# -----------------------------------------------------
+class RollingLeaderboard:
+    """Best run per user over a sliding window of fixed-width time buckets.
+
+    Each bucket keeps at most `capacity` users (lowest WPM evicted first) and
+    whole buckets are dropped once they slide out of the window, so memory is
+    bounded by bucket_count * capacity and expiry never rescans history.
+    bucket_seconds=None means a single all-time bucket.
+    """
+
+    def __init__(self, bucket_seconds=None, bucket_count=1, capacity=LEADERBOARD_CAPACITY):
+        self.bucket_seconds = bucket_seconds
+        self.bucket_count = bucket_count
+        self.capacity = capacity
+        self.starts = []    # sorted bucket start times
+        self.buckets = {}   # bucket start -> {username: entry}
+        self.version = 0    # bumped whenever top() could change
+
+    def _bucket_start(self, ts):
+        if self.bucket_seconds is None:
+            return 0
+        return int(ts // self.bucket_seconds) * self.bucket_seconds
+
+    def _oldest_allowed(self, now):
+        if self.bucket_seconds is None:
+            return 0
+        return self._bucket_start(now) - (self.bucket_count - 1) * self.bucket_seconds
+
+    def _expire(self, now):
+        oldest = self._oldest_allowed(now)
+        while self.starts and self.starts[0] < oldest:
+            self.buckets.pop(self.starts.pop(0), None)
+            self.version += 1
+
+    def add(self, entry, now=None):
+        now = time.time() if now is None else now
+        self._expire(now)
+        start = self._bucket_start(entry["timestamp"])
+        if start < self._oldest_allowed(now):
+            return
+        bucket = self.buckets.get(start)
+        if bucket is None:
+            bucket = self.buckets[start] = {}
+            self.starts.append(start)
+            self.starts.sort()
+        current = bucket.get(entry["username"])
+        if current is not None and (current["wpm"], current["accuracy"]) >= (entry["wpm"], entry["accuracy"]):
+            return
+        bucket[entry["username"]] = entry
+        if len(bucket) > self.capacity:
+            weakest = min(bucket, key=lambda u: (bucket[u]["wpm"], bucket[u]["accuracy"]))
+            bucket.pop(weakest)
+        self.version += 1
+
+    def current_version(self, now=None):
+        self._expire(time.time() if now is None else now)
+        return self.version
+
+    def top(self, limit=LEADERBOARD_CAPACITY, now=None):
+        self._expire(time.time() if now is None else now)
+        best = {}
+        for start in self.starts:
+            for uname, entry in self.buckets[start].items():
+                current = best.get(uname)
+                if current is None or (entry["wpm"], entry["accuracy"]) > (current["wpm"], current["accuracy"]):
+                    best[uname] = entry
+        return heapq.nlargest(limit, best.values(), key=lambda e: (e["wpm"], e["accuracy"]))
+
+
+_leaderboards = {}  # _leaderboards[(window, difficulty)] = RollingLeaderboard
+_leaderboard_difficulties = set()
+
+
+def _parse_accuracy(raw):
+    try:
+        if isinstance(raw, str):
+            raw = raw.strip().replace("%", "")
+            return float(raw) if raw else 0.0
+        return float(raw or 0)
+    except Exception:
+        return 0.0
+
+
+def _get_leaderboard(window, difficulty):
+    board = _leaderboards.get((window, difficulty))
+    if board is None:
+        bucket_seconds, bucket_count = LEADERBOARD_WINDOWS[window]
+        board = _leaderboards[(window, difficulty)] = RollingLeaderboard(bucket_seconds, bucket_count)
+    return board
+
+
+def record_leaderboard_run(username, difficulty, wpm, accuracy, timestamp=None, now=None):
+    """Feed one finished run into every window for its difficulty and for "all"."""
+    if not username:
+        return
+    try:
+        wpm = int(float(wpm or 0))
+    except Exception:
+        wpm = 0
+    difficulty = str(difficulty or "unknown").lower()
+    entry = {
+        "username": username,
+        "level": difficulty,
+        "wpm": wpm,
+        "accuracy": round(_parse_accuracy(accuracy), 2),
+        "timestamp": int(timestamp or time.time()),
+    }
+    # only known difficulties get their own boards, so client input can't grow memory
+    targets = ["all"] + ([difficulty] if difficulty in _leaderboard_difficulties else [])
+    for window in LEADERBOARD_WINDOWS:
+        for target in targets:
+            _get_leaderboard(window, target).add(entry, now)
+
+
+def leaderboard_top(window="alltime", difficulty="all", limit=LEADERBOARD_CAPACITY):
+    return _get_leaderboard(window, difficulty).top(limit)
+
+
+def _history_run_timestamp(run):
+    ts = run.get("timestamp")
+    if ts:
+        return ts
+    try:
+        return int(time.mktime(time.strptime(run.get("date", ""), "%Y-%m-%d %H:%M:%S")))
+    except Exception:
+        return 0
+
+
+def seed_leaderboards():
+    """Build the leaderboards once from stored history; later runs update them incrementally."""
+    _leaderboards.clear()
+    _leaderboard_difficulties.clear()
+    _leaderboard_difficulties.update(k.lower() for k in get_sentence_index().names("sentences"))
+    _leaderboard_difficulties.update(k.lower() for k in load_levels())
+
+    sources = list(load_json(data_path("history.json"), {}).items())
+    if os.path.isdir(data_path("history")):
+        for fname in os.listdir(data_path("history")):
+            if not fname.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(data_path("history"), fname), "r", encoding="utf-8") as f:
+                    sources.append((os.path.splitext(fname)[0], json.load(f) or []))
+            except Exception as e:
+                print(f"[LEADERBOARD] Failed to read {fname}: {e}")
+
+    for uname, runs in sources:
+        for run in runs or []:
+            if not isinstance(run, dict):
+                continue
+            record_leaderboard_run(
+                uname,
+                run.get("level") or run.get("difficulty"),
+                run.get("wpm", 0),
+                run.get("accuracy", 0),
+                _history_run_timestamp(run),
+            )
+
+    # compacted days contribute their best run, which is all a leaderboard keeps
+    for uname, summary in iter_history_summaries():
+        record_leaderboard_run(uname, summary["level"], summary["best_wpm"],
+                               summary["best_accuracy"], summary["best_timestamp"])
+
+
+# -----------------------------------------------------
+# Fragment cache (rendered HTML/JSON keyed by data version)
+# -----------------------------------------------------
+class FragmentCache:
+    """LRU of rendered fragments, one entry per namespace, bounded by total size.
+
+    Each entry remembers the data version it was rendered from; asking for a
+    newer version re-renders and replaces it, so a content change (or
+    bump_data_version) invalidates exactly that fragment.
+    """
+
+    def __init__(self, max_bytes=FRAGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # namespace -> (version, text)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, namespace, version, render):
+        entry = self.entries.get(namespace)
+        if entry is not None and entry[0] == version:
+            self.entries.move_to_end(namespace)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        text = render()
+        self.discard(namespace)
+        if len(text) <= self.max_bytes:
+            self.entries[namespace] = (version, text)
+            self.size += len(text)
+            while self.size > self.max_bytes:
+                _, (_, old) = self.entries.popitem(last=False)
+                self.size -= len(old)
+        return text
+
+    def discard(self, namespace):
+        entry = self.entries.pop(namespace, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+fragment_cache = FragmentCache()
+_data_versions = {}  # e.g. "history:<username>" -> int
+
+
+def bump_data_version(key):
+    _data_versions[key] = _data_versions.get(key, 0) + 1
+    fragment_cache.discard(key)
+
+
+def _file_version(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+def render_fragment(template_name, **context):
+    """Render a partial template without request context processors (fragments are shared)."""
+    return current_app.jinja_env.get_template(template_name).render(**context)
+
+
+# -----------------------------------------------------
+# Static asset pipeline (fingerprinted + precompressed)
+# -----------------------------------------------------
+# build_assets() copies every file under static/ (subdirectories included) to
+# static/build/<dir>/<name>.<hash><ext> and, for text assets, writes .gz (and
+# .br when brotli is installed) next to it. Templates link through asset_url(), and /assets/ serves the hashed files
+# with year-long immutable caching, so repeat page loads never revalidate.
+_asset_manifest = {}  # "style.css" -> "style.1a2b3c4d5e6f.css"
+
+
+def _write_atomic(path, data):
+    # unique temp in the target dir: workers building at once never share one
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)  # mkstemp makes it owner-only
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _static_files():
+    """Relative posix paths of every file under static/, subdirectories included (not build/)."""
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != ASSET_BUILD_DIR)
+        for fname in sorted(files):
+            yield os.path.relpath(os.path.join(root, fname), STATIC_DIR).replace(os.sep, "/")
+
+
+def build_assets():
+    """Fingerprint and precompress static/; only new content hashes cost any work."""
+    os.makedirs(ASSET_BUILD_DIR, exist_ok=True)
+    manifest = {}
+    for fname in _static_files():
+        with open(os.path.join(STATIC_DIR, fname), "rb") as f:
+            data = f.read()
+        stem, ext = os.path.splitext(fname)
+        hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"  # keeps its subdirectory
+        out = os.path.join(ASSET_BUILD_DIR, hashed)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        if not os.path.exists(out):
+            _write_atomic(out, data)
+        if ext.lower() in ASSET_COMPRESSIBLE:
+            if not os.path.exists(out + ".gz"):
+                _write_atomic(out + ".gz", gzip.compress(data, 9, mtime=0))
+            if brotli is not None and not os.path.exists(out + ".br"):
+                _write_atomic(out + ".br", brotli.compress(data))
+        manifest[fname] = hashed
+    _write_atomic(os.path.join(ASSET_BUILD_DIR, "manifest.json"), json.dumps(manifest, indent=2).encode("utf-8"))
+    _asset_manifest.clear()
+    _asset_manifest.update(manifest)
+    return manifest
+
+
+@web.cli_command("build-assets")
+def build_assets_command():
+    """Fingerprint and precompress static assets ahead of deploy."""
+    manifest = build_assets()
+    print(f"[ASSETS] Built {len(manifest)} assets into {ASSET_BUILD_DIR}")
+
+
+@web.template_global("asset_url")
+def asset_url(endpoint, **values):
+    """Drop-in for url_for(); static files resolve to their fingerprinted /assets/ URL."""
+    if endpoint == "static":
+        hashed = _asset_manifest.get(values.get("filename", ""))
+        if hashed:
+            values["filename"] = hashed
+            return url_for("asset", **values)
+    return url_for(endpoint, **values)
+
+
+
+@web.route("/assets/<path:filename>")
+def asset(filename):
+    if filename not in _asset_manifest.values():
+        return jsonify({"error": "not_found"}), 404
+    path = safe_join(ASSET_BUILD_DIR, filename)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding = None
+    for enc, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[enc] and os.path.exists(path + suffix):
+            path, encoding = path + suffix, enc
+            break
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=True)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
 # ============================================================
 # ✅ LOGIN REQUIRED DECORATOR (for routes like /save_result)
 # ============================================================
@@ -318,7 +1925,7 @@ def login_required(f):
 # -----------------------------------------------------
 # Context for templates
 # -----------------------------------------------------
-@app.context_processor
+@web.context_processor
 def inject_user():
     u = current_user()
     # make sure templates can access both username and plan easily
@@ -327,20 +1934,20 @@ def inject_user():
 # -----------------------------------------------------
 # Routes (single-player & admin)
 # -----------------------------------------------------
-@app.route("/")
+@web.route("/")
 def index():
     user = current_user()
-    history = load_json(HISTORY_FILE, {})
+    history = load_json(data_path("history.json"), {})
     runs = history.get(user["username"], [])[-10:] if user else []
-    sentences = load_sentences_all()
-    return render_template("index.html", sentences=sentences, runs=runs)
+    # the sentence corpus is served (and cached) by /api/sentences/all
+    return render_template("index.html", runs=runs)
 
-@app.route("/login", methods=["GET", "POST"])
+@web.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         uname = request.form.get("username", "").strip()
         pwd = request.form.get("password", "")
-        users = load_json(USERS_FILE, {})
+        users = load_json(data_path("users.json"), {})
         u = users.get(uname)
         if u and u.get("password") == pwd:
             session["username"] = uname
@@ -351,13 +1958,13 @@ def login():
         flash("Invalid username or password", "error")
     return render_template("login.html")
 
-@app.route("/logout")
+@web.route("/logout")
 def logout():
     session.pop("username", None)
     flash("Logged out successfully.", "info")
     return redirect(url_for("login"))
 
-@app.route("/register", methods=["GET", "POST"])
+@web.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
         uname = request.form.get("username", "").strip()
@@ -367,7 +1974,7 @@ def register():
         if not uname or not pwd:
             flash("Enter username and password", "error")
             return redirect(url_for("register"))
-        users = load_json(USERS_FILE, {})
+        users = load_json(data_path("users.json"), {})
         if uname in users:
             flash("User already exists", "error")
             return redirect(url_for("register"))
@@ -378,19 +1985,19 @@ def register():
         else:
             plan_to_set = "free"
         users[uname] = {"password": pwd, "role": "user", "plan": plan_to_set, "level": "beginner", "beaten": {}}
-        save_json(USERS_FILE, users)
+        save_json(data_path("users.json"), users)
         flash("Registered successfully! Please log in.", "success")
         return redirect(url_for("login"))
     return render_template("register.html")
 
-@app.route("/admin_dashboard")
+@web.route("/admin_dashboard")
 def admin_dashboard():
     user = current_user()
     if not user or user.get("role") != "admin":
         flash("Admin access required", "error")
         return redirect(url_for("login"))
-    users = load_json(USERS_FILE, {})
-    history = load_json(HISTORY_FILE, {})
+    users = load_json(data_path("users.json"), {})
+    history = load_json(data_path("history.json"), {})
     # For payment table optional rendering: collect pending requests
     pending = []
     for uname, u in users.items():
@@ -406,122 +2013,110 @@ def admin_dashboard():
 # ✅ LIVE JSON ENDPOINTS for AJAX updates (Leaderboard & History)
 # ============================================================
 
-@app.route("/api/leaderboard")
+@web.route("/api/leaderboard")
 def api_leaderboard():
     """
-    Return leaderboard entries with safe parsing and normalized keys.
-    Produces records like: { username, level, wpm, accuracy }
+    Return leaderboard entries from the rolling leaderboards.
+    Query args: window (daily|weekly|alltime), difficulty (default "all"), limit.
+    Produces records like: { username, level, wpm, accuracy, timestamp }
     """
-    # Attempt to load central HISTORY_FILE or per-user files in data/history
-    leaderboard = []
-
-    # Option A: if you maintain a HISTORY_FILE dict mapping username->runs
+    window = request.args.get("window", "alltime").lower()
+    difficulty = request.args.get("difficulty", "all").lower()
+    if window not in LEADERBOARD_WINDOWS:
+        return jsonify({"error": "invalid_window"}), 400
+    if difficulty != "all" and difficulty not in _leaderboard_difficulties:
+        return jsonify({"error": "invalid_difficulty"}), 400
     try:
-        if os.path.exists(HISTORY_FILE):
-            hist_data = load_json(HISTORY_FILE, {})
-            # hist_data could be {username: [runs...], ...}
-            for uname, runs in hist_data.items():
-                if not runs:
-                    continue
-                # pick best wpm from runs
-                try:
-                    wpms = [int(float(r.get("wpm", 0) or 0)) for r in runs if r]
-                    best = max(wpms) if wpms else 0
-                except Exception:
-                    best = 0
-                last = runs[-1] if runs else {}
-                level = last.get("level") or last.get("difficulty") or "unknown"
-                accuracy_raw = last.get("accuracy", 0)
-                try:
-                    if isinstance(accuracy_raw, str):
-                        accuracy_val = float(accuracy_raw.strip().replace("%", "")) if accuracy_raw.strip() else 0.0
-                    else:
-                        accuracy_val = float(accuracy_raw or 0)
-                except Exception:
-                    accuracy_val = 0.0
-
-                leaderboard.append({
-                    "username": uname,
-                    "level": level,
-                    "wpm": int(best),
-                    "accuracy": round(accuracy_val, 2)
-                })
-            # sort by wpm desc
-            leaderboard = sorted(leaderboard, key=lambda x: x.get("wpm", 0), reverse=True)
-            return jsonify(leaderboard)
-    except Exception as e:
-        print("[API_LEADERBOARD] history file path approach failed:", e)
-
-    # Option B: fallback to scanning data/history per-user json files
-    try:
-        history_dir = os.path.join("data", "history")
-        if os.path.isdir(history_dir):
-            for fname in os.listdir(history_dir):
-                if not fname.endswith(".json"):
-                    continue
-                uname = os.path.splitext(fname)[0]
-                try:
-                    with open(os.path.join(history_dir, fname), "r", encoding="utf-8") as f:
-                        runs = json.load(f) or []
-                except Exception:
-                    runs = []
-                if not runs:
-                    continue
-                # compute best wpm and last run metadata
-                try:
-                    wpms = [int(float(r.get("wpm", 0) or 0)) for r in runs if r]
-                    best = max(wpms) if wpms else 0
-                except Exception:
-                    best = 0
-                last = runs[-1] if runs else {}
-                level = last.get("level") or last.get("difficulty") or "unknown"
-                accuracy_raw = last.get("accuracy", 0)
-                try:
-                    if isinstance(accuracy_raw, str):
-                        accuracy_val = float(accuracy_raw.strip().replace("%", "")) if accuracy_raw.strip() else 0.0
-                    else:
-                        accuracy_val = float(accuracy_raw or 0)
-                except Exception:
-                    accuracy_val = 0.0
-
-                leaderboard.append({
-                    "username": uname,
-                    "level": level,
-                    "wpm": int(best),
-                    "accuracy": round(accuracy_val, 2)
-                })
-
-            leaderboard = sorted(leaderboard, key=lambda x: x.get("wpm", 0), reverse=True)
-            return jsonify(leaderboard)
-    except Exception as e:
-        print("[API_LEADERBOARD] fallback per-user scan failed:", e)
-
-    # Final fallback: empty list
-    return jsonify([])
+        limit = max(1, min(LEADERBOARD_CAPACITY, int(request.args.get("limit", LEADERBOARD_CAPACITY))))
+    except ValueError:
+        limit = LEADERBOARD_CAPACITY
+    return jsonify(leaderboard_top(window, difficulty, limit))
 
 
 
-@app.route("/history")
+@web.route("/history")
 def history_view():
     user = current_user()
     if not user:
         flash("Please log in to view history", "error")
         return redirect(url_for("login"))
 
-    history = load_json(HISTORY_FILE, {})
-    runs = history.get(user["username"], [])
+    username = user["username"]
 
-    # Sort runs by timestamp descending (if timestamp key present)
-    runs = sorted(runs, key=lambda x: x.get("timestamp", x.get("date", "")), reverse=True)
+    def render_rows():
+        history = load_json(data_path("history.json"), {})
+        runs = history.get(username, [])
+        # Sort runs by timestamp descending (if timestamp key present)
+        runs = sorted(runs, key=lambda x: x.get("timestamp", x.get("date", "")), reverse=True)
+        return render_fragment("_history_rows.html", history=runs)
 
-    return render_template("history.html", runs=runs)
-@app.route("/leaderboard")
+    key = f"history:{username}"
+    rows = fragment_cache.get(key, _data_versions.get(key, 0), render_rows)
+    return render_template("history.html", history_rows=Markup(rows))
+@web.route("/leaderboard")
 def leaderboard():
-    leaderboard_data = load_data("leaderboard.json") or []
-    return render_template("leaderboard.html", leaderboard=leaderboard_data)
+    window = request.args.get("window", "alltime").lower()
+    difficulty = request.args.get("difficulty", "all").lower()
+    if window not in LEADERBOARD_WINDOWS:
+        window = "alltime"
+    if difficulty != "all" and difficulty not in _leaderboard_difficulties:
+        difficulty = "all"
+    board = _get_leaderboard(window, difficulty)
+    rows = fragment_cache.get(
+        f"leaderboard:{window}:{difficulty}",
+        board.current_version(),
+        lambda: render_fragment("_leaderboard_rows.html", leaderboard=board.top()),
+    )
+    return render_template(
+        "leaderboard.html",
+        leaderboard_rows=Markup(rows),
+        window=window,
+        difficulty=difficulty,
+        windows=list(LEADERBOARD_WINDOWS),
+        difficulties=["all"] + sorted(_leaderboard_difficulties),
+    )
+
+
+def normalize_history_entry(entry):
+    """Copy of a stored run with level, numeric accuracy/wpm/time, status and timestamp/date filled in."""
+    e = dict(entry)  # shallow copy
+    # ensure level
+    e["level"] = e.get("level") or e.get("difficulty") or "beginner"
+    # ensure numeric accuracy
+    acc = e.get("accuracy", 0)
+    try:
+        if isinstance(acc, str):
+            acc = acc.strip().replace("%", "")
+        e["accuracy"] = float(acc) if acc != "" else 0.0
+    except Exception:
+        try:
+            e["accuracy"] = float(str(acc).replace("%", ""))
+        except Exception:
+            e["accuracy"] = 0.0
+    # ensure numeric wpm/time
+    try:
+        e["wpm"] = int(float(e.get("wpm", 0) or 0))
+    except Exception:
+        e["wpm"] = 0
+    try:
+        e["time"] = int(float(e.get("time", 0) or 0))
+    except Exception:
+        e["time"] = 0
+    # status default
+    e["status"] = e.get("status") or "completed"
+    # timestamp & date fallback
+    if not e.get("timestamp") and e.get("date"):
+        # attempt parse date into timestamp if possible
+        try:
+            e["timestamp"] = int(time.mktime(time.strptime(e["date"], "%Y-%m-%d %H:%M:%S")))
+        except Exception:
+            e["timestamp"] = int(time.time())
+    if not e.get("date"):
+        e["date"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(e.get("timestamp", time.time())))
+    return e
 
 
-@app.route("/api/history")
+@web.route("/api/history")
 def api_history():
     """
     Returns the logged-in user's typing history as JSON.
@@ -537,7 +2132,7 @@ def api_history():
         return jsonify({"error": "Not logged in"}), 401
 
     username = user.get("username", None) or session.get("username", "Guest")
-    user_file = os.path.join("data/history", f"{username}.json")
+    user_file = os.path.join(data_path("history"), f"{username}.json")
 
     history = []
     if os.path.exists(user_file):
@@ -548,53 +2143,507 @@ def api_history():
             print(f"[API_HISTORY] Failed to read {user_file}: {e}")
             history = []
 
-    # normalization helper
-    def normalize(entry):
-        e = dict(entry)  # shallow copy
-        # ensure level
-        e["level"] = e.get("level") or e.get("difficulty") or "beginner"
-        # ensure numeric accuracy
-        acc = e.get("accuracy", 0)
-        try:
-            if isinstance(acc, str):
-                acc = acc.strip().replace("%", "")
-            e["accuracy"] = float(acc) if acc != "" else 0.0
-        except Exception:
+    normalized = [normalize_history_entry(h) for h in history]
+
+    # optional: sort by timestamp newest first
+    normalized.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
+
+    return jsonify(normalized)
+
+
+# -----------------------------------------------------
+# History export (streamed CSV / NDJSON)
+# -----------------------------------------------------
+# Exports never hold a whole history in memory: the JSON files are read in
+# chunks and decoded one run at a time, rows are written as they are decoded
+# and flushed to the client in ~64 KB pieces (optionally through a streaming
+# gzip compressor). Runs come out in storage order, per-user files first and
+# then the legacy history.json, rather than sorted.
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_COLUMNS = ["username", "date", "timestamp", "level", "wpm", "accuracy", "time", "status"]
+
+
+class _JsonItemStream:
+    """Incrementally decode the runs of a history file without loading it whole.
+
+    Handles both layouts in use: a list of runs (data/history/<user>.json)
+    and an object of username -> list of runs (data/history.json).
+    """
+
+    def __init__(self, f, chunk_size=EXPORT_CHUNK_BYTES):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        more = self.f.read(self.chunk_size)
+        if not more:
+            return False
+        self.buf = self.buf[self.pos:] + more
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n,:":
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def _value(self):
+        while True:
             try:
-                e["accuracy"] = float(str(acc).replace("%", ""))
-            except Exception:
-                e["accuracy"] = 0.0
-        # ensure numeric wpm/time
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or not self._fill():
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+
+    def _items(self, owner):
+        self.pos += 1  # "["
+        while self._peek() not in ("]", ""):
+            yield owner, self._value()
+        self.pos += 1
+
+    def __iter__(self):
+        first = self._peek()
+        if first == "[":
+            yield from self._items(None)
+        elif first == "{":
+            self.pos += 1
+            while self._peek() not in ("}", ""):
+                owner = self._value()
+                if self._peek() == "[":
+                    yield from self._items(owner)
+                else:
+                    self._value()  # not a run list; skip it
+
+
+def iter_history_runs(username=None):
+    """Yield (username, run) from every history store, one decoded run at a time."""
+    if username:
+        paths = [(username, os.path.join(data_path("history"), f"{os.path.basename(username)}.json"))]
+    elif os.path.isdir(data_path("history")):
+        paths = [(os.path.splitext(f)[0], os.path.join(data_path("history"), f))
+                 for f in sorted(os.listdir(data_path("history"))) if f.endswith(".json")]
+    else:
+        paths = []
+    paths.append((None, data_path("history.json")))
+
+    for owner, path in paths:
+        if not os.path.exists(path):
+            continue
         try:
-            e["wpm"] = int(float(e.get("wpm", 0) or 0))
-        except Exception:
-            e["wpm"] = 0
+            with open(path, "r", encoding="utf-8") as f:
+                for key, run in _JsonItemStream(f):
+                    uname = owner or key
+                    if isinstance(run, dict) and (username is None or uname == username):
+                        yield uname, run
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"[EXPORT] Stopped reading {path}: {e}")
+
+
+def _date_arg(value, end_of_day=False):
+    """Parse YYYY-MM-DD or a unix timestamp; raises ValueError on anything else."""
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        ts = time.mktime(time.strptime(value, "%Y-%m-%d"))
+        return ts + 86400 - 1 if end_of_day else ts
+
+
+def export_history_lines(fmt, username=None, since=None, until=None):
+    """Generate CSV or NDJSON text for the matching runs, one row at a time."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    if fmt == "csv":
+        writer.writerow(EXPORT_COLUMNS)
+        yield out.getvalue()
+    for uname, run in iter_history_runs(username):
+        e = normalize_history_entry(run)
+        ts = e.get("timestamp", 0)
+        if (since is not None and ts < since) or (until is not None and ts > until):
+            continue
+        e["username"] = uname
+        if fmt == "csv":
+            out.seek(0)
+            out.truncate()
+            writer.writerow([e.get(col, "") for col in EXPORT_COLUMNS])
+            yield out.getvalue()
+        else:
+            yield json.dumps(e) + "\n"
+
+
+def _chunked(lines, compress):
+    """Batch text lines into ~EXPORT_CHUNK_BYTES byte chunks, gzip-compressed if asked."""
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    pending, size = [], 0
+    for line in lines:
+        data = line.encode("utf-8")
+        pending.append(data)
+        size += len(data)
+        if size >= EXPORT_CHUNK_BYTES:
+            block = b"".join(pending)
+            pending, size = [], 0
+            block = gz.compress(block) if gz else block
+            if block:
+                yield block
+    block = b"".join(pending)
+    if gz:
+        block = gz.compress(block) + gz.flush()
+    if block:
+        yield block
+
+
+def history_export_response(fmt, username=None):
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+    try:
+        since = _date_arg(request.args.get("from"))
+        until = _date_arg(request.args.get("to"), end_of_day=True)
+    except ValueError:
+        return jsonify({"error": "from/to must be YYYY-MM-DD or a unix timestamp"}), 400
+    compress = request.args.get("gzip", "").lower() in ("1", "true", "yes")
+
+    filename = f"history-{username or 'all'}.{fmt}" + (".gz" if compress else "")
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    body = _chunked(export_history_lines(fmt, username, since, until), compress)
+    resp = Response(body, mimetype="application/gzip" if compress else mimetype)
+    resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return resp
+
+
+@web.route("/api/export/history.<fmt>")
+def api_export_history(fmt):
+    """The logged-in user's runs; ?from=&to= (YYYY-MM-DD), ?gzip=1."""
+    user = current_user()
+    if not user:
+        return jsonify({"error": "Not logged in"}), 401
+    return history_export_response(fmt, user["username"])
+
+
+@web.route("/api/admin/export/history.<fmt>")
+def api_admin_export_history(fmt):
+    """Every user's runs (or ?user=<name>); same filters as the user export."""
+    user = current_user()
+    if not user or user.get("role") != "admin":
+        return jsonify({"error": "unauthorized"}), 403
+    return history_export_response(fmt, request.args.get("user") or None)
+
+
+# -----------------------------------------------------
+# History retention & compaction
+# -----------------------------------------------------
+# Raw runs are kept for HISTORY_RETENTION_DAYS; older ones are folded into
+# one summary per user, UTC day and level in data/summaries/<user>.json:
+#   "2024-03-01|beginner": {"day", "level", "count", "mean_wpm", "mean_accuracy",
+#                           "best_wpm", "best_accuracy", "best_timestamp",
+#                           "legacy_count", "legacy_mean_wpm"}
+# legacy_* cover only the runs that came from history.json, so views that
+# read just that file (the /api/save_run average) can add back exactly what
+# was compacted out of it. Summaries merge (count-weighted means, max of
+# best), so compacting again later is safe. Aggregate views read them
+# alongside raw runs: leaderboards seed from each summary's best run and
+# averages weight by count. Retention
+# never drops below the longest rolling leaderboard window so windowed boards
+# only ever see raw runs.
+#
+# Every writer of a history or summary file (the save routes and compaction,
+# in whichever worker process) holds history_lock(path) across its
+# read-modify-write, so compaction re-reads under the lock and never folds a
+# run twice or drops one appended by another worker.
+_compaction = {"running": False, "last_run": None, "compacted": 0}
+HISTORY_LOCK_STALE = 30  # seconds before a lock left by a crashed worker is ignored
+
+
+@contextmanager
+def history_lock(path):
+    """Cross-process lock on one history/summary file: an O_EXCL <path>.lock next to it."""
+    lock = path + ".lock"
+    os.makedirs(os.path.dirname(lock), exist_ok=True)
+    while True:
         try:
-            e["time"] = int(float(e.get("time", 0) or 0))
-        except Exception:
-            e["time"] = 0
-        # status default
-        e["status"] = e.get("status") or "completed"
-        # timestamp & date fallback
-        if not e.get("timestamp") and e.get("date"):
-            # attempt parse date into timestamp if possible
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > HISTORY_LOCK_STALE:
+                    os.remove(lock)
+            except OSError:
+                pass
+            socketio.sleep(0.01)
+    try:
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(lock)
+        except OSError:
+            pass
+
+
+def load_json_if_exists(path, default):
+    """Like load_json, but never creates the file."""
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return default
+
+
+def _summary_path(username):
+    return os.path.join(data_path("summaries"), f"{os.path.basename(username)}.json")
+
+
+def load_history_summaries(username):
+    return load_json_if_exists(_summary_path(username), {})
+
+
+def iter_history_summaries():
+    if not os.path.isdir(data_path("summaries")):
+        return
+    for fname in sorted(os.listdir(data_path("summaries"))):
+        if fname.endswith(".json"):
+            uname = os.path.splitext(fname)[0]
+            for summary in load_json_if_exists(os.path.join(data_path("summaries"), fname), {}).values():
+                yield uname, summary
+
+
+def history_retention_cutoff(now=None):
+    """Timestamp before which raw runs get compacted, or None when retention is off."""
+    if HISTORY_RETENTION_DAYS <= 0:
+        return None
+    windows = [seconds * count for seconds, count in LEADERBOARD_WINDOWS.values() if seconds]
+    keep = max([HISTORY_RETENTION_DAYS * 86400] + windows)
+    return (time.time() if now is None else now) - keep
+
+
+def fold_run_into_summaries(summaries, run, legacy=False):
+    ts = _history_run_timestamp(run)
+    level = str(run.get("level") or run.get("difficulty") or "unknown").lower()
+    try:
+        wpm = float(run.get("wpm", 0) or 0)
+    except Exception:
+        wpm = 0.0
+    accuracy = _parse_accuracy(run.get("accuracy", 0))
+    day = time.strftime("%Y-%m-%d", time.gmtime(ts))
+    s = summaries.setdefault(f"{day}|{level}", {
+        "day": day, "level": level, "count": 0, "mean_wpm": 0.0, "mean_accuracy": 0.0,
+        "best_wpm": -1, "best_accuracy": 0.0, "best_timestamp": ts,
+    })
+    s["count"] += 1
+    s["mean_wpm"] += (wpm - s["mean_wpm"]) / s["count"]
+    s["mean_accuracy"] += (accuracy - s["mean_accuracy"]) / s["count"]
+    if (wpm, accuracy) > (s["best_wpm"], s["best_accuracy"]):
+        s["best_wpm"], s["best_accuracy"], s["best_timestamp"] = wpm, accuracy, ts
+    if legacy:
+        s["legacy_count"] = s.get("legacy_count", 0) + 1
+        mean = s.get("legacy_mean_wpm", 0.0)
+        s["legacy_mean_wpm"] = mean + (wpm - mean) / s["legacy_count"]
+
+
+def split_expired_runs(runs, cutoff):
+    """Return (kept, expired); runs without a usable timestamp are always kept."""
+    kept, expired = [], []
+    for run in runs or []:
+        ts = _history_run_timestamp(run) if isinstance(run, dict) else 0
+        (expired if 0 < ts < cutoff else kept).append(run)
+    return kept, expired
+
+
+def _store_summaries(username, expired, legacy=False):
+    path = _summary_path(username)
+    with history_lock(path):
+        summaries = load_json_if_exists(path, {})
+        for run in expired:
+            fold_run_into_summaries(summaries, run, legacy)
+        _write_atomic(path, json.dumps(summaries, indent=2).encode("utf-8"))
+
+
+def compact_history(now=None):
+    """Move raw runs past the retention window into summaries; returns runs compacted.
+
+    Each file is re-read, summarized and rewritten under its history_lock(),
+    which the save routes of every worker also take, so concurrent
+    compactions and appends never lose or double-count a run. The loop
+    yields between files to keep the server responsive.
+    """
+    cutoff = history_retention_cutoff(now)
+    if cutoff is None:
+        return 0
+    compacted = 0
+    if os.path.isdir(data_path("history")):
+        for fname in sorted(os.listdir(data_path("history"))):
+            if not fname.endswith(".json"):
+                continue
+            path = os.path.join(data_path("history"), fname)
+            username = os.path.splitext(fname)[0]
+            with history_lock(path):
+                kept, expired = split_expired_runs(load_json_if_exists(path, []), cutoff)
+                if expired:
+                    _store_summaries(username, expired)
+                    _write_atomic(path, json.dumps(kept, indent=2).encode("utf-8"))
+            if expired:
+                bump_data_version(f"history:{username}")
+                compacted += len(expired)
+            socketio.sleep(0)
+
+    with history_lock(data_path("history.json")):
+        history = load_json_if_exists(data_path("history.json"), {})
+        changed = []
+        for username, runs in history.items():
+            if not isinstance(runs, list):
+                continue
+            kept, expired = split_expired_runs(runs, cutoff)
+            if expired:
+                _store_summaries(username, expired, legacy=True)
+                history[username] = kept
+                changed.append(username)
+                compacted += len(expired)
+        if changed:
+            _write_atomic(data_path("history.json"), json.dumps(history, indent=2).encode("utf-8"))
+    for username in changed:
+        bump_data_version(f"history:{username}")
+    _compaction.update(last_run=time.time(), compacted=_compaction["compacted"] + compacted)
+    if compacted:
+        print(f"[HISTORY] Compacted {compacted} runs older than {time.strftime('%Y-%m-%d', time.gmtime(cutoff))}")
+    return compacted
+
+
+def _compaction_loop():
+    while True:
+        if _warmup["state"] == "ready":
             try:
-                e["timestamp"] = int(time.mktime(time.strptime(e["date"], "%Y-%m-%d %H:%M:%S")))
-            except Exception:
-                e["timestamp"] = int(time.time())
-        if not e.get("date"):
-            e["date"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(e.get("timestamp", time.time())))
-        return e
+                compact_history()
+            except Exception as e:
+                print(f"[HISTORY] Compaction failed: {e}")
+            socketio.sleep(HISTORY_COMPACT_INTERVAL)
+        else:
+            socketio.sleep(5)
 
-    normalized = [normalize(h) for h in history]
 
-    # optional: sort by timestamp newest first
-    normalized.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
+def start_history_compaction(app):
+    if HISTORY_RETENTION_DAYS > 0 and not _compaction["running"]:
+        _compaction["running"] = True
+        spawn(_compaction_loop, app=app)
 
-    return jsonify(normalized)
+
+@web.cli_command("compact-history")
+def compact_history_command():
+    """Fold runs past the retention window into daily summaries now."""
+    print(f"[HISTORY] {compact_history()} runs compacted into {data_path('summaries')}")
+
+
+# -----------------------------------------------------
+# Chart series (LTTB-downsampled WPM / accuracy)
+# -----------------------------------------------------
+# Charts get at most `points` points per series however long the history is.
+# Largest-Triangle-Three-Buckets keeps the points that shape the line (peaks,
+# dips) rather than every k-th run. Trailing moving averages are computed at
+# full resolution and sampled at the same x positions as their raw series.
+# Compacted days show up as one point at their daily mean. Results are cached
+# per user and parameters until the user's history changes.
+CHART_DEFAULT_POINTS = 200
+CHART_MAX_POINTS = 1000
+
+
+def lttb(points, threshold):
+    """Indices of the `threshold` points (x, y) that best preserve the series' shape."""
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # average of the next bucket is the third triangle corner
+        start = int((i + 1) * every) + 1
+        end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(points[j][0] for j in range(start, end)) / (end - start)
+        avg_y = sum(points[j][1] for j in range(start, end)) / (end - start)
+        ax, ay = points[a]
+        best, best_area = None, -1.0
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+
+def moving_average(values, window):
+    out, total = [], 0.0
+    for i, v in enumerate(values):
+        total += v
+        if i >= window:
+            total -= values[i - window]
+        out.append(total / min(i + 1, window))
+    return out
+
+
+def history_chart_points(username):
+    """(timestamp, wpm, accuracy) for every stored run and compacted day, oldest first."""
+    points = []
+    for summary in load_history_summaries(username).values():
+        try:
+            ts = calendar.timegm(time.strptime(summary["day"], "%Y-%m-%d"))
+        except (KeyError, ValueError):
+            continue
+        points.append((ts, float(summary["mean_wpm"]), float(summary["mean_accuracy"])))
+    for _, run in iter_history_runs(username):
+        e = normalize_history_entry(run)
+        points.append((e["timestamp"], float(e["wpm"]), e["accuracy"]))
+    points.sort(key=lambda p: p[0])
+    return points
+
+
+def build_history_chart(username, max_points, window):
+    points = history_chart_points(username)
+    series = {}
+    for name, col in (("wpm", 1), ("accuracy", 2)):
+        values = [p[col] for p in points]
+        averages = moving_average(values, window)
+        keep = lttb([(p[0], p[col]) for p in points], max_points)
+        series[name] = [[points[i][0], round(values[i], 2)] for i in keep]
+        series[f"{name}_avg"] = [[points[i][0], round(averages[i], 2)] for i in keep]
+    return {"username": username, "total_runs": len(points), "points": max_points, "window": window, "series": series}
+
+
+@web.route("/api/chart/history")
+def api_chart_history():
+    """Downsampled WPM/accuracy series for charts: ?points=200&window=10 (admins may pass ?user=)."""
+    user = current_user()
+    if not user:
+        return jsonify({"error": "Not logged in"}), 401
+    username = user["username"]
+    if request.args.get("user") and user.get("role") == "admin":
+        username = request.args["user"]
+    try:
+        max_points = max(3, min(CHART_MAX_POINTS, int(request.args.get("points", CHART_DEFAULT_POINTS))))
+        window = max(1, min(200, int(request.args.get("window", 10))))
+    except ValueError:
+        return jsonify({"error": "points and window must be integers"}), 400
+
+    key = f"history:{username}"
+    payload = fragment_cache.get(
+        f"chart:{username}:{max_points}:{window}",
+        _data_versions.get(key, 0),
+        lambda: json.dumps(build_history_chart(username, max_points, window)),
+    )
+    return Response(payload, mimetype="application/json")
 
 
-@app.route("/upgrade", methods=["GET", "POST"])
+@web.route("/upgrade", methods=["GET", "POST"])
 def upgrade():
     user = current_user()
     if not user:
@@ -608,14 +2657,14 @@ def upgrade():
 
     if request.method == "POST":
         plan = request.form.get("plan", "premium")
-        users = load_json(USERS_FILE, {})
+        users = load_json(data_path("users.json"), {})
         if user["username"] in users:
             users[user["username"]]["plan"] = plan
             # if they bought premium_plus manually, clear pending flag
             users[user["username"]].pop("pending_upgrade_to", None)
             users[user["username"]].pop("pending_amount", None)
             users[user["username"]].pop("pending_status", None)
-            save_json(USERS_FILE, users)
+            save_json(data_path("users.json"), users)
             flash(f"Plan updated to {plan}. You’ll get full access once payment is confirmed.", "success")
         return redirect(url_for("index"))
 
@@ -623,48 +2672,85 @@ def upgrade():
 
 
 # ✅ FIXED SENTENCES ROUTES (connects properly to data/sentences.json)
-@app.route("/api/sentences/all")
+@web.route("/api/sentences/all")
 def api_sentences_all():
     """Return all sentences grouped by difficulty for preloading."""
-    sentences_file = os.path.join("data", "sentences.json")
-    if not os.path.exists(sentences_file):
+    sentences_file = data_path("sentences.json")
+    version = _file_version(sentences_file)
+    if version is None:
         return jsonify({"error": "missing_file"}), 404
-    try:
+
+    def render_payload():
         with open(sentences_file, "r", encoding="utf-8") as f:
             data = json.load(f)
         print("[API] Sentences loaded successfully from data/sentences.json")
-        return jsonify(data)
+        return json.dumps(data)
+
+    try:
+        payload = fragment_cache.get("sentences:all", version, render_payload)
+        return Response(payload, mimetype="application/json")
     except Exception as e:
         print("[API ERROR] Failed to load sentences:", e)
         return jsonify({"error": "load_failed", "message": str(e)}), 500
 
 
-@app.route("/api/sentences", methods=["GET"])
+@web.route("/api/sentences", methods=["GET"])
 def api_sentences():
-    """Returns one random sentence by difficulty level."""
-    difficulty = request.args.get("difficulty", "easy").lower()
-    sentences_file = os.path.join("data", "sentences.json")
+    """
+    Returns one sentence by difficulty level.
+    mode=drill returns a practice set targeting the user's weakest bigrams.
+    Optional: seconds & wpm (pick a passage lasting about that long) or
+    percentile (0-100 difficulty rank). Without a difficulty these search the
+    whole corpus; otherwise the pick is uniform random within the difficulty.
+    """
+    if request.args.get("mode") == "drill":
+        return api_sentences_drill()
+    seconds = _float_arg(request.args.get("seconds"))
+    wpm = _float_arg(request.args.get("wpm"))
+    percentile = _float_arg(request.args.get("percentile"))
+    default_difficulty = "easy" if seconds is None and percentile is None else "all"
+    difficulty = request.args.get("difficulty", default_difficulty).lower()
+    sentences_file = data_path("sentences.json")
 
     if not os.path.exists(sentences_file):
         print("[WARN] sentences.json missing in data/")
         return jsonify({"sentence": "The programmer eats at school.", "offline": True})
 
     try:
-        with open(sentences_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        sents = data.get(difficulty) or []
-        if not sents:
+        index = get_sentence_index()
+        pool = index.pool("all") if difficulty == "all" else index.pool("sentences", difficulty)
+        picked = pick_sentence(pool, seconds, wpm, percentile)
+        if not picked:
             print(f"[WARN] No sentences found for {difficulty}")
             return jsonify({"sentence": "Typing practice makes perfect.", "offline": True})
-        sentence = random.choice(sents)
+        sentence = picked["text"]
         print(f"[OK] Serving {difficulty} sentence: {sentence}")
-        return jsonify({"sentence": sentence, "difficulty": difficulty})
+        return jsonify({
+            "sentence": sentence,
+            "difficulty": difficulty,
+            "features": {k: v for k, v in picked.items() if k != "text"},
+            "estimated_seconds": round(picked["chars"] / CHARS_PER_WORD / (wpm or 40) * 60, 1),
+        })
     except Exception as e:
         print("[ERROR] Could not load sentences:", e)
         return jsonify({"sentence": "The programmer eats at school.", "offline": True})
 
 
-@app.route("/api/save_run", methods=["POST"])
+def api_sentences_drill():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+    targets = weakest_bigrams(load_bigram_profile(user["username"]))
+    sentences = build_drill(get_sentence_index(), targets) if targets else []
+    if not sentences:
+        # not enough keystroke data yet: fall back to a regular easy pick
+        picked = pick_sentence(get_sentence_index().pool("sentences", "easy"))
+        sentences = [picked["text"]] if picked else []
+    return jsonify({"mode": "drill", "targets": targets, "sentences": sentences,
+                    "sentence": sentences[0] if sentences else None})
+
+
+@web.route("/api/save_run", methods=["POST"])
 def api_save_run():
     """Save a typing run and return updated summary."""
     data = request.get_json() or {}
@@ -685,27 +2771,43 @@ def api_save_run():
         accuracy = 0.0
     timestamp = int(time.time())
 
-    history = load_json(HISTORY_FILE, {})
-    # store as a consistent dict (includes difficulty)
-    history.setdefault(user["username"], []).append({
-        "wpm": wpm,
-        "accuracy": accuracy,
-        "time": timestamp,
-        "difficulty": difficulty,
-        "timestamp": timestamp
-    })
-    save_json(HISTORY_FILE, history)
+    reasons = screen_saved_result(user["username"], wpm)
+    if reasons:
+        quarantine_result(user["username"], "save_run", reasons, {"wpm": wpm, "accuracy": accuracy, "difficulty": difficulty})
+        return jsonify({"ok": False, "quarantined": True, "reasons": reasons}), 202
+
+    with history_lock(data_path("history.json")):
+        history = load_json(data_path("history.json"), {})
+        # store as a consistent dict (includes difficulty)
+        history.setdefault(user["username"], []).append({
+            "wpm": wpm,
+            "accuracy": accuracy,
+            "time": timestamp,
+            "difficulty": difficulty,
+            "timestamp": timestamp
+        })
+        save_json(data_path("history.json"), history)
+    bump_data_version(f"history:{user['username']}")
+    record_leaderboard_run(user["username"], difficulty, wpm, accuracy, timestamp)
+    update_bigram_profile(user["username"], data.get("keystrokes"))
 
     # return updated recent summary for frontend dashboard refresh
     recent = history[user["username"]][-5:]
-    avg = sum([r.get("wpm", 0) for r in history[user["username"]]]) / max(1, len(history[user["username"]]))
+    # runs compacted out of history.json still count through their summaries
+    # (runs from data/history/<user>.json never did, so they stay out)
+    count, total = 0, 0.0
+    for summary in load_history_summaries(user["username"]).values():
+        count += summary.get("legacy_count", 0)
+        total += summary.get("legacy_mean_wpm", 0.0) * summary.get("legacy_count", 0)
+    runs = history[user["username"]]
+    avg = (total + sum([r.get("wpm", 0) for r in runs])) / max(1, count + len(runs))
     return jsonify({
         "ok": True,
         "recent_runs": recent[::-1],
         "average_wpm": round(avg, 2)
     })
 from datetime import datetime
-@app.route("/save_result", methods=["POST"])
+@web.route("/save_result", methods=["POST"])
 @login_required
 def save_result():
     data = request.get_json()
@@ -720,30 +2822,38 @@ def save_result():
     user = current_user()
     username = user["username"] if user else "Anonymous"
 
-    # Load history file
-    history = load_json(HISTORY_FILE, {})
-
-    if username not in history:
-        history[username] = []
-
-    history[username].append({
-        "date": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-        "difficulty": difficulty,
-        "wpm": wpm,
-        "accuracy": accuracy,
-        "time": time_spent,
-        "status": "completed",
-        "timestamp": int(time.time())
-    })
+    reasons = screen_saved_result(username, _float_arg(wpm))
+    if reasons:
+        quarantine_result(username, "save_result", reasons, {"wpm": wpm, "accuracy": accuracy, "difficulty": difficulty})
+        return jsonify({"success": False, "quarantined": True, "reasons": reasons}), 202
 
-    save_json(HISTORY_FILE, history)
+    # Load history file
+    with history_lock(data_path("history.json")):
+        history = load_json(data_path("history.json"), {})
+
+        if username not in history:
+            history[username] = []
+
+        history[username].append({
+            "date": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            "difficulty": difficulty,
+            "wpm": wpm,
+            "accuracy": accuracy,
+            "time": time_spent,
+            "status": "completed",
+            "timestamp": int(time.time())
+        })
+
+        save_json(data_path("history.json"), history)
+    bump_data_version(f"history:{username}")
+    record_leaderboard_run(username, difficulty, wpm, accuracy)
 
     print(f"[SAVE_RESULT] {username} — {wpm}WPM, {accuracy}% @ {difficulty}")
     return jsonify({"success": True})
 
 
 # alias some clients expect /api/submit
-@app.route("/api/submit", methods=["POST"])
+@web.route("/api/submit", methods=["POST"])
 def api_submit_alias():
     return api_save_run()
 
@@ -751,7 +2861,7 @@ def api_submit_alias():
 # User upgrade request endpoint (user-side)
 # Stores request on users.json as pending_upgrade_to/pending_amount/pending_status
 # -----------------------------------------------------
-@app.route("/api/upgrade_request", methods=["POST"])
+@web.route("/api/upgrade_request", methods=["POST"])
 def api_upgrade_request():
     user = current_user()
     if not user:
@@ -761,7 +2871,7 @@ def api_upgrade_request():
     # We'll only support premium_plus and premium
     if plan_req not in ("premium_plus", "premium"):
         return jsonify({"error": "invalid_plan"}), 400
-    users = load_json(USERS_FILE, {})
+    users = load_json(data_path("users.json"), {})
     u = users.get(user["username"])
     if not u:
         return jsonify({"error": "user_not_found"}), 404
@@ -776,25 +2886,29 @@ def api_upgrade_request():
     u["pending_amount"] = amount
     u["pending_status"] = "pending"
     users[user["username"]] = u
-    save_json(USERS_FILE, users)
+    save_json(data_path("users.json"), users)
     return jsonify({"ok": True, "pending": {"plan": plan_req, "amount": amount}})
 
 # -----------------------------------------------------
 # Multiplayer routes & socket events (with room isolation)
 # -----------------------------------------------------
-@app.route("/multiplayer/<level>")
+def allowed_multiplayer_levels(user):
+    """Levels a user may race in (or watch), by plan; admins see everything."""
+    if user.get("role") == "admin" or user.get("plan") == "premium_plus":
+        return ["beginner", "intermediate", "advanced", "expert"]
+    if user.get("plan") == "premium":
+        return ["beginner"]
+    return []
+
+@web.route("/multiplayer/<level>")
 def multiplayer(level):
     user = current_user()
     if not user:
         flash("Login first", "error")
         return redirect(url_for("login"))
 
-    # Define access levels by plan
-    if user["plan"] == "premium_plus":
-        allowed_levels = ["beginner", "intermediate", "advanced", "expert"]
-    elif user["plan"] == "premium":
-        allowed_levels = ["beginner"]
-    else:
+    allowed_levels = allowed_multiplayer_levels(user)
+    if not allowed_levels:
         flash("Multiplayer is Premium only", "error")
         return redirect(url_for("upgrade"))
 
@@ -807,62 +2921,905 @@ def multiplayer(level):
 
 
 
-# helper to list players in a given room/level
-def room_players(level):
-    """Helper to get all players in a specific room."""
-    return [p for p in players.values() if p.get("level") == level]
+# helper to list players in a given race room (shard)
+def room_players(room):
+    """Helper to get all players in a specific race room."""
+    return [p for p in players.values() if p.get("room") == room]
+
+# -----------------------------------------------------
+# Race shards & skill-based matchmaking
+# -----------------------------------------------------
+# Players of a level are split into race rooms ("beginner:3") of at most
+# RACE_SHARD_CAPACITY racers. A new shard only takes players from its own WPM
+# bucket; for every MATCH_WAIT_BUDGET seconds it stays under-filled it accepts
+# one more bucket either side, so nobody waits long for opponents.
+_shards = {}  # room -> {"room", "level", "bucket", "created", "sids": set, "started_at", "finished": set,
+#                        "racers": set of sids in the running race, "winner": its first clean finisher}
+_shard_counter = 0
+
+
+def wpm_bucket(avg_wpm):
+    try:
+        return int(float(avg_wpm or 0)) // max(1, MATCH_WPM_BUCKET)
+    except Exception:
+        return 0
+
+
+def _shard_is_open(shard, now):
+    if len(shard["sids"]) >= RACE_SHARD_CAPACITY:
+        return False
+    started = shard.get("started_at")
+    return not started or now - started > RACE_LOCK_SECONDS
+
+
+def find_shard(level, bucket, now=None):
+    """Pick the fullest open shard this bucket may join, or open a new one."""
+    global _shard_counter
+    now = time.time() if now is None else now
+    best = None
+    for shard in _shards.values():
+        if shard["level"] != level or not _shard_is_open(shard, now):
+            continue
+        reach = int((now - shard["created"]) // MATCH_WAIT_BUDGET) if MATCH_WAIT_BUDGET > 0 else 0
+        if abs(shard["bucket"] - bucket) > reach:
+            continue
+        if best is None or len(shard["sids"]) > len(best["sids"]):
+            best = shard
+    if best is None:
+        _shard_counter += 1
+        room = f"{level}:{_shard_counter}"
+        best = _shards[room] = {"room": room, "level": level, "bucket": bucket, "created": now,
+                                "sids": set(), "started_at": None, "finished": set()}
+    return best
+
+
+def leave_shard(sid, room):
+    shard = _shards.get(room)
+    if not shard:
+        return
+    shard["sids"].discard(sid)
+    shard["finished"].discard(sid)
+    if not shard["sids"]:
+        _shards.pop(room, None)
+        _slot_tables.pop(room, None)
+        finalize_race_recording(shard.pop("race_id", None))
+    elif shard["finished"]:
+        # the one racer still typing may have been the one who left
+        _reopen_if_all_finished(shard)
+
+
+def mark_shard_finished(sid, room):
+    """Reopen the shard for matchmaking once every racer in it has finished."""
+    shard = _shards.get(room)
+    if not shard:
+        return
+    shard["finished"].add(sid)
+    _reopen_if_all_finished(shard)
+
+
+def _reopen_if_all_finished(shard):
+    if shard["finished"] >= shard["sids"]:
+        shard["started_at"] = None
+        shard.pop("race_start_at", None)
+        shard.pop("racers", None)
+        shard.pop("winner", None)
+        shard["finished"] = set()
+        finalize_race_recording(shard.pop("race_id", None))
+
+
+# -----------------------------------------------------
+# Race replays (compact keystroke / progress timelines)
+# -----------------------------------------------------
+# While a race runs every racer gets a bytearray timeline of records:
+#   varint((delta_ms << 2) | kind) + varint(value)
+# where kind is REPLAY_PROGRESS (value = 0..100), REPLAY_KEY (value = code
+# point) or REPLAY_FINISH (value = wpm) and delta_ms is the time since that
+# racer's previous record of the same kind. Each kind keeps its own clock:
+# keystrokes carry the client's ms since the start, progress and finish are
+# server time since the race's actual start_at, so neither clamps the other.
+# A keystroke typically costs 2-3 bytes. When the
+# race ends all timelines go into one zlib blob, data/replays/<race_id>.bin:
+#   varint(len) + JSON header, then per racer varint(len) + name + varint(len) + timeline
+REPLAY_PROGRESS, REPLAY_KEY, REPLAY_FINISH = 0, 1, 2
+_REPLAY_KINDS = {REPLAY_PROGRESS: "progress", REPLAY_KEY: "key", REPLAY_FINISH: "finish"}
+
+_race_recordings = {}  # race_id -> {"meta": {...}, "timelines": {name: bytearray}, "last_ms": {(name, kind): int}}
+
+
+def _write_varint(buf, n):
+    n = max(0, int(n))
+    while n >= 0x80:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _read_varint(read):
+    """Read one varint using read(n) -> bytes; returns None at end of stream."""
+    shift = result = 0
+    while True:
+        b = read(1)
+        if not b:
+            return None
+        result |= (b[0] & 0x7F) << shift
+        if not b[0] & 0x80:
+            return result
+        shift += 7
+
+
+def start_race_recording(shard, sentence, start_at):
+    finalize_race_recording(shard.pop("race_id", None))
+    race_id = f"{shard['room'].replace(':', '-')}-{int(start_at * 1000)}"
+    shard["race_id"] = race_id
+    _race_recordings[race_id] = {
+        "meta": {"race_id": race_id, "room": shard["room"], "level": shard["level"],
+                 "sentence": sentence, "start_at": start_at},
+        "timelines": {},
+        "last_ms": {},
+    }
+    return race_id
+
+
+def record_race_event(sid, kind, value, at_ms=None):
+    """Append one record to the racer's timeline if their shard is mid-race."""
+    p = players.get(sid)
+    shard = _shards.get(p.get("room")) if p else None
+    rec = _race_recordings.get(shard.get("race_id")) if shard else None
+    if not rec:
+        return
+    name = p["name"]
+    timeline = rec["timelines"].setdefault(name, bytearray())
+    if len(timeline) >= REPLAY_MAX_BYTES_PER_PLAYER:
+        return
+    if at_ms is None:
+        at_ms = (time.time() - rec["meta"]["start_at"]) * 1000
+    last = rec["last_ms"].get((name, kind), 0)
+    at_ms = max(last, int(at_ms))  # each kind's clock only moves forward
+    _write_varint(timeline, ((at_ms - last) << 2) | kind)
+    _write_varint(timeline, value)
+    rec["last_ms"][(name, kind)] = at_ms
+
+
+def record_keystrokes(sid, keys):
+    """keys: [[ms_since_start, "k"], ...] as sent by the client alongside progress_update."""
+    if not isinstance(keys, list):
+        return
+    for item in keys[:256]:
+        try:
+            at_ms, key = int(item[0]), str(item[1])
+        except Exception:
+            continue
+        if key:
+            record_race_event(sid, REPLAY_KEY, ord(key[0]), at_ms)
+
+
+def finalize_race_recording(race_id):
+    """Compress a finished race's timelines into data/replays/<race_id>.bin."""
+    rec = _race_recordings.pop(race_id, None) if race_id else None
+    if not rec or not rec["timelines"]:
+        return None
+    os.makedirs(data_path("replays"), exist_ok=True)
+    path = os.path.join(data_path("replays"), f"{race_id}.bin")
+    header = json.dumps({**rec["meta"], "players": list(rec["timelines"])}).encode("utf-8")
+    compressor = zlib.compressobj(9)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            buf = bytearray()
+            _write_varint(buf, len(header))
+            buf += header
+            f.write(compressor.compress(bytes(buf)))
+            for name, timeline in rec["timelines"].items():
+                buf = bytearray()
+                encoded = name.encode("utf-8")
+                _write_varint(buf, len(encoded))
+                buf += encoded
+                _write_varint(buf, len(timeline))
+                buf += timeline
+                f.write(compressor.compress(bytes(buf)))
+            f.write(compressor.flush())
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"[REPLAY] Failed to write {path}: {e}")
+        return None
+    print(f"[REPLAY] Saved {race_id} ({os.path.getsize(path)} bytes)")
+    return path
+
+
+class _InflateReader:
+    """read(n) over a zlib file, inflating one chunk at a time."""
+
+    def __init__(self, f, chunk_size=16 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.inflater = zlib.decompressobj()
+        self.buf = b""
+
+    def read(self, n):
+        while len(self.buf) < n:
+            chunk = self.f.read(self.chunk_size)
+            if not chunk:
+                self.buf += self.inflater.flush()
+                break
+            self.buf += self.inflater.decompress(chunk)
+        out, self.buf = self.buf[:n], self.buf[n:]
+        return out
+
+
+def iter_replay(path):
+    """Yield the race header, then one dict per recorded event, without inflating the whole blob."""
+    with open(path, "rb") as f:
+        reader = _InflateReader(f)
+        size = _read_varint(reader.read)
+        if size is None:
+            return
+        yield {"type": "race", **json.loads(reader.read(size).decode("utf-8"))}
+        while True:
+            size = _read_varint(reader.read)
+            if size is None:
+                return
+            name = reader.read(size).decode("utf-8")
+            remaining = _read_varint(reader.read) or 0
+
+            def read_timeline(n):
+                nonlocal remaining
+                if remaining <= 0:
+                    return b""
+                data = reader.read(min(n, remaining))
+                remaining -= len(data)
+                return data
+
+            clocks = {}  # kind -> ms
+            while True:
+                head = _read_varint(read_timeline)
+                value = _read_varint(read_timeline)
+                if head is None or value is None:
+                    break
+                kind = head & 3
+                clocks[kind] = clocks.get(kind, 0) + (head >> 2)
+                yield {"type": _REPLAY_KINDS.get(kind, "unknown"), "player": name, "t": clocks[kind], "value": value}
+
+
+@web.route("/api/replays/<race_id>")
+def api_replay(race_id):
+    """Stream a recorded race back as NDJSON (header line, then one line per event)."""
+    if not current_user():
+        return jsonify({"error": "login required"}), 401
+    safe_id = os.path.basename(race_id)
+    path = os.path.join(data_path("replays"), f"{safe_id}.bin")
+    if safe_id != race_id or not os.path.exists(path):
+        return jsonify({"error": "not_found"}), 404
+
+    def generate():
+        for event in iter_replay(path):
+            if event["type"] == "key":
+                event["value"] = chr(event["value"])
+            yield json.dumps(event) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+# -----------------------------------------------------
+# Spectators (downsampled per-level snapshots)
+# -----------------------------------------------------
+# Spectators are not racers: they hold no slot or shard and never receive the
+# per-update broadcasts. One background loop per watched level emits a single
+# "spectator_snapshot" to the level's spectator room every SPECTATOR_INTERVAL
+# seconds (only when something changed), so viewer count does not multiply
+# the cost of progress_update.
+_spectators = {}         # sid -> level
+_spectator_loops = set()  # levels with a running snapshot loop
+
+
+def spectator_room(level):
+    return f"{level}:spectators"
+
+
+def spectator_snapshot(level):
+    """update_progress-shaped payloads for every race room of a level."""
+    rooms = {}
+    for p in players.values():
+        if p.get("level") != level or not p.get("room"):
+            continue
+        entry = rooms.setdefault(p["room"], {"players": {}, "wpm": {}})
+        entry["players"][p["name"]] = int(p.get("progress", 0) or 0)
+        entry["wpm"][p["name"]] = int(p.get("wpm", 0) or 0)
+    for room, entry in rooms.items():
+        shard = _shards.get(room)
+        entry["started"] = bool(shard and shard.get("started_at"))
+    return {"level": level, "rooms": rooms}
+
+
+def _spectator_loop(level):
+    last = None
+    while True:
+        socketio.sleep(SPECTATOR_INTERVAL)
+        if not any(lvl == level for lvl in _spectators.values()):
+            break
+        snapshot = spectator_snapshot(level)
+        if snapshot != last:
+            watchers = [sid for sid, lvl in _spectators.items() if lvl == level]
+            stalled = stalled_sids(watchers)
+            socketio.emit("spectator_snapshot", {**snapshot, "t": time.time()},
+                          to=spectator_room(level), skip_sid=stalled or None)
+            last = snapshot
+    _spectator_loops.discard(level)
+
+
+def add_spectator(sid, level):
+    _spectators[sid] = level
+    join_room(spectator_room(level))
+    emit("spectating", {"level": level, "interval": SPECTATOR_INTERVAL})
+    emit("spectator_snapshot", {**spectator_snapshot(level), "t": time.time()})
+    if level not in _spectator_loops:
+        _spectator_loops.add(level)
+        spawn(_spectator_loop, level)
+
+
+def remove_spectator(sid):
+    level = _spectators.pop(sid, None)
+    if level is not None:
+        try:
+            leave_room(spectator_room(level))
+        except Exception:
+            pass
+
+
+@socketio.on("spectate")
+def handle_spectate(data):
+    """Stop racing (if we were) and watch a level's races instead."""
+    sid = flask_request.sid  # type: ignore[attr-defined]
+    user = current_user()
+    level = (data or {}).get("level")
+    if not user or level not in allowed_multiplayer_levels(user):
+        emit("error", {"msg": "spectate-not-allowed"})
+        return
+    player = drop_player(sid)
+    if player:
+        room = player.get("room")
+        try:
+            leave_room(player.get("level", "beginner"))
+            leave_room(room)
+            leave_room(legacy_room(room))
+        except Exception:
+            pass
+    remove_spectator(sid)
+    add_spectator(sid, level)
+    print(f"[SPECTATE] {user['username']} watching {level}")
+
+
+# -----------------------------------------------------
+# Compact socket protocol (player slots + progress deltas)
+# -----------------------------------------------------
+# A client opts in by emitting "protocol_hello" {"encoding": "array"|"binary"}.
+# It then leaves the legacy JSON room and, instead of update_players /
+# update_progress, receives:
+#   "compact_roster"  {"v": version, "slots": [[slot, name, username], ...]} when players join/leave
+#   "progress_delta"  only the (slot, progress, wpm) tuples changed since the
+#                     version it last confirmed with "delta_ack" {"v": version}
+#       array:  {"v": version, "u": [[slot, progress, wpm], ...]}
+#       binary: uint32 version, then uint16 slot / uint8 progress / uint16 wpm per
+#               player (little-endian)
+# Clients that never say hello keep getting the legacy JSON events unchanged.
+COMPACT_ENCODINGS = ("array", "binary")
+_DELTA_HEADER = struct.Struct("<I")
+_DELTA_ENTRY = struct.Struct("<HBH")
+
+_slot_tables = {}      # race room -> {"version", "next", "free", "slots": {sid: slot}, "changed": {slot: version}}
+_compact_clients = {}  # sid -> {"encoding": str, "acked": int}
+
+
+def legacy_room(room):
+    """Socket.IO room for clients still on the JSON update_players/update_progress events."""
+    return f"{room}:json"
+
+
+def _slot_table(room):
+    return _slot_tables.setdefault(room, {"version": 0, "next": 0, "free": [], "slots": {}, "changed": {}})
+
+
+def assign_slot(room, sid):
+    """Give sid a stable slot number in the race room, reusing the lowest freed slot."""
+    table = _slot_table(room)
+    if sid in table["slots"]:
+        return table["slots"][sid]
+    if table["free"]:
+        slot = heapq.heappop(table["free"])
+    else:
+        slot = table["next"]
+        table["next"] += 1
+    table["slots"][sid] = slot
+    table["version"] += 1
+    table["changed"][slot] = table["version"]
+    return slot
+
+
+def release_slot(room, sid):
+    table = _slot_table(room)
+    slot = table["slots"].pop(sid, None)
+    if slot is None:
+        return
+    table["changed"].pop(slot, None)
+    heapq.heappush(table["free"], slot)
+    table["version"] += 1
+
+
+def mark_slot_changed(room, sid):
+    table = _slot_table(room)
+    slot = table["slots"].get(sid)
+    if slot is None:
+        return
+    table["version"] += 1
+    table["changed"][slot] = table["version"]
+
+
+def compact_roster(room):
+    table = _slot_table(room)
+    slots = []
+    for sid, slot in sorted(table["slots"].items(), key=lambda item: item[1]):
+        p = players.get(sid, {})
+        slots.append([slot, p.get("name"), p.get("username")])
+    return {"v": table["version"], "slots": slots}
+
+
+def encode_progress_delta(room, client):
+    """Build the progress_delta payload for one compact client, or None if it is up to date."""
+    table = _slot_table(room)
+    acked = client.get("acked", 0)
+    changes = []
+    for sid, slot in table["slots"].items():
+        if table["changed"].get(slot, 0) <= acked:
+            continue
+        p = players.get(sid, {})
+        progress = max(0, min(100, int(p.get("progress", 0) or 0)))
+        wpm = max(0, min(0xFFFF, int(p.get("wpm", 0) or 0)))
+        changes.append((slot, progress, wpm))
+    if not changes:
+        return None
+    if client.get("encoding") == "binary":
+        return _DELTA_HEADER.pack(table["version"] & 0xFFFFFFFF) + b"".join(_DELTA_ENTRY.pack(*c) for c in changes)
+    return {"v": table["version"], "u": [list(c) for c in changes]}
+
+
+def broadcast_room_state(room, roster_changed=False):
+    """Send the room state to legacy JSON clients and per-client deltas to compact clients.
+
+    Clients with a full outbound queue are skipped; legacy payloads are full
+    snapshots and compact deltas cover everything since the last ack, so they
+    catch up on the next broadcast after draining.
+    """
+    roster_players = room_players(room)
+    stalled = stalled_sids(list(_slot_table(room)["slots"]))
+    # emit both names for legacy clients
+    socketio.emit("update_players", roster_players, to=legacy_room(room), skip_sid=stalled or None)
+    socketio.emit("update_progress", {"players": {p["name"]: p.get("progress", 0) for p in roster_players}},
+                  to=legacy_room(room), skip_sid=stalled or None)
+
+    roster = compact_roster(room) if roster_changed else None
+    for sid in list(_slot_table(room)["slots"]):
+        client = _compact_clients.get(sid)
+        if not client or sid in stalled:
+            continue
+        if roster is not None:
+            socketio.emit("compact_roster", roster, to=sid)
+        payload = encode_progress_delta(room, client)
+        if payload is not None:
+            socketio.emit("progress_delta", payload, to=sid)
+
+
+_pending_flushes = set()  # rooms with a deferred broadcast already scheduled
+
+
+def _flush_room_later(room, delay):
+    socketio.sleep(delay)
+    _pending_flushes.discard(room)
+    broadcast_room_state(room)
+
+
+def schedule_room_flush(room, delay):
+    """Broadcast the room once after `delay`, however many updates arrive meanwhile."""
+    if room in _pending_flushes:
+        return
+    _pending_flushes.add(room)
+    spawn(_flush_room_later, room, delay)
+
+
+@socketio.on("protocol_hello")
+def handle_protocol_hello(data):
+    sid = flask_request.sid  # type: ignore[attr-defined]
+    p = players.get(sid)
+    if not p:
+        emit("error", {"msg": "player-not-found"})
+        return
+    encoding = (data or {}).get("encoding", "array")
+    if encoding not in COMPACT_ENCODINGS:
+        encoding = "array"
+    room = p.get("room")
+    client = _compact_clients[sid] = {"encoding": encoding, "acked": 0}
+    try:
+        leave_room(legacy_room(room))
+    except Exception:
+        pass
+    emit("protocol_ack", {"encoding": encoding, "slot": assign_slot(room, sid)})
+    emit("compact_roster", compact_roster(room))
+    payload = encode_progress_delta(room, client)
+    if payload is not None:
+        emit("progress_delta", payload)
+
+
+@socketio.on("delta_ack")
+def handle_delta_ack(data):
+    sid = flask_request.sid  # type: ignore[attr-defined]
+    client = _compact_clients.get(sid)
+    p = players.get(sid)
+    if not client or not p:
+        return
+    try:
+        version = int((data or {}).get("v", 0))
+    except Exception:
+        return
+    latest = _slot_table(p.get("room"))["version"]
+    client["acked"] = max(client["acked"], min(version, latest))
+
+
+# -----------------------------------------------------
+# Anti-cheat (streaming plausibility checks per racer)
+# -----------------------------------------------------
+# Each racer gets a TypingMonitor for the running race, fed every
+# progress_update in O(1) with fixed-size state. Progress is turned into
+# characters of the race sentence and timed on the server clock (arrival
+# minus the connection's one-way delay, with its jitter as slack):
+#   early        progress reported before the race started
+#   velocity     characters so far imply more than ANTICHEAT_MAX_WPM
+#   burst        one update jumps faster than ANTICHEAT_MAX_BURST_CPS (pastes)
+#   robotic      typing rhythm too even for a human (Welford mean/variance)
+#   wpm_mismatch the finish claims a WPM the server-side timing can't support
+#   no_race      the finish isn't from a racer of the shard's running race
+#   unmonitored  the racer finished without any progress the monitor saw
+# Any claim over ANTICHEAT_MAX_WPM is flagged however the race went.
+# A flagged finish is quarantined: no level/wins update, and the player's
+# follow-up history save for that race is held back too. Quarantined results
+# go to data/quarantine.jsonl for review; counters are at /api/admin/anticheat.
+_monitors = {}  # sid -> TypingMonitor
+_quarantine_holds = {}  # username -> (expires, reasons) for the post-race HTTP save
+_anticheat_stats = {"updates_checked": 0, "races_checked": 0, "quarantined": 0,
+                    "early": 0, "velocity": 0, "burst": 0, "robotic": 0, "wpm_mismatch": 0,
+                    "no_race": 0, "unmonitored": 0, "implausible_wpm": 0, "implausible_save": 0}
+_recent_quarantine = deque(maxlen=50)
+
+
+class TypingMonitor:
+    """Constant-memory plausibility state for one racer in one race."""
+
+    ROBOTIC_MIN_SAMPLES = 20
+    ROBOTIC_MAX_CV = 0.05
+
+    def __init__(self, race_id, start_at, chars):
+        self.race_id = race_id
+        self.start_at = start_at
+        self.chars = max(1, chars)
+        self.last_t = start_at
+        self.last_chars = 0.0
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.peak_cps = 0.0
+        self.flags = set()
+
+    def update(self, t, progress, jitter, tolerance):
+        typed = max(0.0, min(100.0, progress)) / 100.0 * self.chars
+        elapsed = t - self.start_at
+        if typed > 0 and elapsed < -tolerance:
+            self.flags.add("early")
+        gained = typed - self.last_chars
+        if gained <= 0:
+            return
+        dt = max(0.0, t - self.last_t)
+        cps = gained / (dt + jitter)
+        self.peak_cps = max(self.peak_cps, cps)
+        if gained >= 3 and cps > ANTICHEAT_MAX_BURST_CPS:
+            self.flags.add("burst")
+        if dt > 0:
+            self.n += 1
+            delta = cps - self.mean
+            self.mean += delta / self.n
+            self.m2 += delta * (cps - self.mean)
+            if self.n >= self.ROBOTIC_MIN_SAMPLES and self.mean > 0:
+                cv = math.sqrt(self.m2 / (self.n - 1)) / self.mean
+                if cv < self.ROBOTIC_MAX_CV:
+                    self.flags.add("robotic")
+        if typed >= 10 and (typed / CHARS_PER_WORD) / ((max(elapsed, 0.0) + tolerance) / 60) > ANTICHEAT_MAX_WPM:
+            self.flags.add("velocity")
+        self.last_t, self.last_chars = t, typed
+
+    def finish(self, t, reported_wpm, tolerance):
+        """Check the claimed WPM against server timing; returns the sorted flags."""
+        # the slack shortens the race, so server_wpm is the fastest the timing allows
+        elapsed = max(t - self.start_at - tolerance, 0.001)
+        typed = max(self.last_chars, 0.0)
+        server_wpm = (typed / CHARS_PER_WORD) / (elapsed / 60)
+        if reported_wpm and (reported_wpm > ANTICHEAT_MAX_WPM or reported_wpm > server_wpm * 1.15 + 5):
+            self.flags.add("wpm_mismatch")
+        return sorted(self.flags)
+
+
+def monitor_progress(sid, progress):
+    """Feed one progress_update into the racer's monitor (created when a race is running)."""
+    p = players.get(sid)
+    shard = _shards.get(p.get("room")) if p else None
+    if not shard or not shard.get("race_start_at"):
+        return
+    monitor = _monitors.get(sid)
+    if monitor is None or monitor.race_id != shard.get("race_id"):
+        rec = _race_recordings.get(shard.get("race_id"))
+        if not rec:
+            return
+        monitor = _monitors[sid] = TypingMonitor(shard["race_id"], shard["race_start_at"], len(rec["meta"]["sentence"]))
+    before = set(monitor.flags)
+    monitor.update(time.time() - one_way_delay(sid), progress, network_jitter(sid), timing_tolerance(sid))
+    _anticheat_stats["updates_checked"] += 1
+    for flag in monitor.flags - before:
+        _anticheat_stats[flag] += 1
+
+
+def check_race_finish(sid, reported_wpm):
+    """Flags for the racer's finished race ([] only for a clean, monitored race)."""
+    monitor = _monitors.pop(sid, None)
+    p = players.get(sid)
+    shard = _shards.get(p.get("room")) if p else None
+    _anticheat_stats["races_checked"] += 1
+    counted = set()
+    if not shard or not shard.get("race_start_at") or sid not in shard.get("racers", ()):
+        flags = {"no_race"}
+    elif monitor is None or monitor.race_id != shard.get("race_id"):
+        flags = {"unmonitored"}
+    else:
+        counted = set(monitor.flags)  # already counted as the progress came in
+        flags = set(monitor.finish(time.time() - one_way_delay(sid), reported_wpm, timing_tolerance(sid)))
+    if reported_wpm and reported_wpm > ANTICHEAT_MAX_WPM and "wpm_mismatch" not in flags:
+        flags.add("implausible_wpm")
+    for flag in flags - counted:
+        _anticheat_stats[flag] += 1
+    return sorted(flags)
+
+
+def quarantine_result(username, source, reasons, result):
+    """Keep a suspicious result out of history/leaderboard and log it for review."""
+    record = {"username": username, "source": source, "reasons": reasons, "result": result, "timestamp": int(time.time())}
+    _anticheat_stats["quarantined"] += 1
+    _recent_quarantine.append(record)
+    try:
+        ensure_data_dir()
+        with open(data_path("quarantine.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        print(f"[ANTICHEAT] Failed to log quarantine: {e}")
+    print(f"[ANTICHEAT] Quarantined {username} ({source}): {', '.join(reasons)}")
+
+
+def screen_saved_result(username, wpm):
+    """Reasons to quarantine an HTTP-saved run: a held race or an impossible WPM."""
+    hold = _quarantine_holds.pop(username, None)
+    if hold and hold[0] > time.time():
+        return hold[1]
+    try:
+        if float(wpm or 0) > ANTICHEAT_MAX_WPM:
+            _anticheat_stats["implausible_save"] += 1
+            return ["implausible_wpm"]
+    except (TypeError, ValueError):
+        pass
+    return []
+
+
+# -----------------------------------------------------
+# Session resume (reconnect grace period)
+# -----------------------------------------------------
+# match_found hands every racer a resume token. When the socket drops, the
+# player stays parked in players/slot table/shard for SESSION_RESUME_GRACE
+# seconds with nothing broadcast; reconnecting with ?resume=<token> rebinds
+# that state (compact-protocol negotiation and anti-cheat monitor included)
+# to the new sid without reading users.json or re-sending the roster to the
+# room. Only when the grace window lapses, or the same user connects again
+# without a usable token, is the player really removed (and the room told once).
+_resume_tokens = {}  # token -> sid currently holding the session (live or parked)
+_session_tokens = {}  # sid -> token
+_parked = {}  # sid -> time the parked session expires
+
+
+def issue_resume_token(sid):
+    token = secrets.token_urlsafe(16)
+    _resume_tokens[token] = sid
+    _session_tokens[sid] = token
+    return token
+
+
+def park_player(sid):
+    _parked[sid] = time.time() + SESSION_RESUME_GRACE
+    spawn(_expire_parked, sid)
+
+
+def _expire_parked(sid):
+    socketio.sleep(SESSION_RESUME_GRACE)
+    expires = _parked.get(sid)
+    if expires is not None and expires <= time.time():
+        _parked.pop(sid, None)
+        player = drop_player(sid)
+        if player:
+            print(f"[DISCONNECT] {player['name']} did not come back to {player.get('room')}")
+
+
+def drop_player(sid):
+    """Remove a player for good and tell the room once; returns the player record."""
+    player = players.pop(sid, None)
+    _resume_tokens.pop(_session_tokens.pop(sid, None), None)
+    _monitors.pop(sid, None)
+    _compact_clients.pop(sid, None)
+    _parked.pop(sid, None)
+    if not player:
+        return None
+    room = player.get("room")
+    release_slot(room, sid)
+    leave_shard(sid, room)
+    if room in _shards:
+        broadcast_room_state(room, roster_changed=True)
+    return player
+
+
+def resume_session(token, sid, uname):
+    """Move a parked session onto the new sid; returns the player record or None."""
+    old_sid = _resume_tokens.get(token)
+    player = players.get(old_sid)
+    if old_sid not in _parked or not player or player.get("username") != uname:
+        return None
+    _parked.pop(old_sid)
+    players[sid] = players.pop(old_sid)
+    _session_tokens[sid] = _session_tokens.pop(old_sid)
+    _resume_tokens[token] = sid
+    for state in (_monitors, _compact_clients):
+        if old_sid in state:
+            state[sid] = state.pop(old_sid)
+
+    room = player.get("room")
+    table = _slot_table(room)
+    if old_sid in table["slots"]:
+        table["slots"][sid] = table["slots"].pop(old_sid)  # same slot, roster unchanged
+    shard = _shards.get(room)
+    if shard:
+        for key in ("sids", "finished", "racers"):
+            if old_sid in shard.get(key, ()):
+                shard[key].discard(old_sid)
+                shard[key].add(sid)
+        if shard.get("winner") == old_sid:
+            shard["winner"] = sid
+    return player
+
+
+def drop_parked_sessions(uname):
+    """A user connecting afresh (no usable token) gives up their parked seat instead of leaving a ghost."""
+    for old_sid in [s for s in _parked if players.get(s, {}).get("username") == uname]:
+        player = drop_player(old_sid)
+        if player:
+            print(f"[DISCONNECT] {player['name']} reconnected without resuming; released {player.get('room')}")
+
+
+def race_in_progress(room):
+    """Sentence and timing of the shard's running race, for a resumed racer."""
+    shard = _shards.get(room) or {}
+    rec = _race_recordings.get(shard.get("race_id"))
+    if not rec or not shard.get("race_start_at"):
+        return None
+    return {"race_id": shard["race_id"], "sentence": rec["meta"]["sentence"], "start_at": shard["race_start_at"]}
+
 
 # SOCKET.IO CONNECTION HANDLING
 @socketio.on("connect")
 def handle_connect():
     sid = flask_request.sid  # type: ignore[attr-defined]
     uname = session.get("username")
-    users = load_json(USERS_FILE, {})
+
+    # ?spectate=<level> on the socket URL watches without ever joining a race
+    spectate_level = flask_request.args.get("spectate")
+    if spectate_level:
+        user = current_user()
+        if not user or spectate_level not in allowed_multiplayer_levels(user):
+            return False
+        add_spectator(sid, spectate_level)
+        ensure_clock_sync(sid)
+        print(f"[SPECTATE] {uname} watching {spectate_level}")
+        return
+
+    token = flask_request.args.get("resume")
+    player = resume_session(token, sid, uname) if token else None
+    if player:
+        room = player["room"]
+        client = _compact_clients.get(sid)
+        try:
+            join_room(player["level"])
+            join_room(room)
+            if not client:
+                join_room(legacy_room(room))
+        except Exception:
+            pass
+        # only the returning client needs a snapshot; the room saw no change
+        emit("session_resumed", {"room": room, "level": player["level"], "resume_token": token,
+                                 "progress": player.get("progress", 0), "wpm": player.get("wpm", 0),
+                                 "race": race_in_progress(room), "encoding": client and client["encoding"]})
+        if client:
+            # compact clients keep their protocol; resend what they haven't acked
+            emit("compact_roster", compact_roster(room))
+            payload = encode_progress_delta(room, client)
+            if payload is not None:
+                emit("progress_delta", payload)
+        else:
+            emit("update_players", room_players(room))
+        ensure_clock_sync(sid)
+        print(f"[RESUME] {player['name']} back in {room}")
+        return
+
+    if uname:
+        drop_parked_sessions(uname)
+    users = load_json(data_path("users.json"), {})
 
     if not uname or uname not in users:
         display_name = f"Guest-{len(players) + 1}"
         level = "beginner"
         plan = "free"
+        avg_wpm = 0
     else:
         meta = users[uname]
         display_name = uname
         level = meta.get("level", "beginner")
         plan = meta.get("plan", "free")
+        avg_wpm = meta.get("avg_wpm", 0)
 
         # Restrict premium (not plus) to beginner room
         if plan == "premium":
             level = "beginner"
 
-    players[sid] = {"name": display_name, "username": uname, "level": level, "wpm": 0, "progress": 0}
+    shard = find_shard(level, wpm_bucket(avg_wpm))
+    room = shard["room"]
+    shard["sids"].add(sid)
+    players[sid] = {"name": display_name, "username": uname, "level": level, "room": room, "wpm": 0, "progress": 0}
+    assign_slot(room, sid)
 
-    # Join the player's level room
+    # Join the player's level room, its race shard, and the shard's JSON room
+    # until the client negotiates the compact protocol
     try:
         join_room(level)
+        join_room(room)
+        join_room(legacy_room(room))
     except Exception:
         pass
 
-    print(f"[CONNECT] {display_name} joined {level} room")
+    print(f"[CONNECT] {display_name} matched into {room} ({len(shard['sids'])}/{RACE_SHARD_CAPACITY})")
+    emit("match_found", {"room": room, "level": level, "bucket": shard["bucket"], "capacity": RACE_SHARD_CAPACITY,
+                         "resume_token": issue_resume_token(sid)})
+    ensure_clock_sync(sid)
 
-    # Send player list only for that room (both event names for backward compatibility)
-    emit("update_players", list(room_players(level)), to=level)
-    emit("update_progress", {"players": {p["name"]: p.get("progress", 0) for p in room_players(level)}}, to=level)
+    # Send player list only for that race room
+    broadcast_room_state(room, roster_changed=True)
 
 @socketio.on("disconnect")
 def handle_disconnect():
     sid = flask_request.sid  # type: ignore[attr-defined]
-    player = players.pop(sid, None)
-    if player:
-        level = player.get("level", "beginner")
-        try:
-            leave_room(level)
-        except Exception:
-            pass
-        emit("update_players", list(room_players(level)), to=level)
-        emit("update_progress", {"players": {p["name"]: p.get("progress", 0) for p in room_players(level)}}, to=level)
-        print(f"[DISCONNECT] {player['name']} left {level} room")
+    _rate_buckets.pop(sid, None)
+    _clock.pop(sid, None)
+    remove_spectator(sid)
+    player = players.get(sid)
+    if not player:
+        _compact_clients.pop(sid, None)
+        return
+    # the socket layer drops the sid from its rooms; keep the seat for a resume
+    if SESSION_RESUME_GRACE > 0 and sid in _session_tokens:
+        park_player(sid)
+        print(f"[DISCONNECT] {player['name']} dropped from {player.get('room')}, holding seat {SESSION_RESUME_GRACE:g}s")
+        return
+    drop_player(sid)
+    print(f"[DISCONNECT] {player['name']} left {player.get('room')}")
 
 # When a client requests a race, server sends countdown then start_game for that specific room
 @socketio.on("request_race")
+@rate_limited("request_race")
 def handle_request_race(data):
     sid = flask_request.sid  # type: ignore[attr-defined]
     user_info = players.get(sid)
@@ -870,35 +3827,55 @@ def handle_request_race(data):
         emit("error", {"msg": "player-not-found"})
         return
 
-    level = data.get("level") or user_info.get("level", "beginner")
-    username = user_info.get("username")
+    # Races always run in the requester's own shard, at the shard's level
+    # (plan restrictions were applied when the shard was picked on connect)
+    room = user_info.get("room")
+    shard = _shards.get(room)
+    if not shard:
+        emit("error", {"msg": "room-not-found"})
+        return
+    level = shard["level"]
 
-    # Enforce plan restriction
-    if username:
-        users = load_json(USERS_FILE, {})
-        meta = users.get(username, {})
-        if meta.get("plan") == "premium" and level != "beginner":
-            level = "beginner"
+    # optional {"seconds", "wpm"} or {"percentile"} steer the pick via the feature index
+    data = data or {}
+    picked = pick_sentence(
+        get_sentence_index().pool("levels", level),
+        _float_arg(data.get("seconds")), _float_arg(data.get("wpm")), _float_arg(data.get("percentile")),
+    )
+    if not picked:
+        picked = pick_sentence(get_sentence_index().pool("sentences", "easy"))
+    sentence = picked["text"] if picked else "Typing test sentence."
 
-    sentence = pick_level_sentence(level)
-    if not sentence:
-        sentence = random.choice(load_sentences_all().get("easy", ["Typing test sentence."]))
+    # Close the shard to newcomers while the race runs
+    shard["started_at"] = time.time()
+    shard["finished"] = set()
+    race_id = start_race_recording(shard, sentence, shard["started_at"] + 5)
 
-    # Broadcast countdown only to players in that level room
-    emit("countdown", {"from": 5}, to=level)
+    # Broadcast countdown only to players in that race room
+    emit("countdown", {"from": 5}, to=room)
     # Use socketio.sleep to avoid blocking main thread
     socketio.sleep(5)
+    # start once the slowest racer has received the sentence; start_at is server
+    # time, which clients map onto their clock with the clock_sync offset
+    start_at = time.time() + max([one_way_delay(sid) for sid in shard["sids"]] or [0.0])
+    shard["race_start_at"] = start_at
+    # the race is between the players connected now; the first clean finisher among them wins
+    shard["racers"] = {s for s in shard["sids"] if s not in _parked}
+    shard["winner"] = None
+    rec = _race_recordings.get(race_id)
+    if rec:
+        rec["meta"]["start_at"] = start_at  # server-clock records count from the real start
+    payload = {"sentence": sentence, "level": level, "room": room, "race_id": race_id, "start_at": start_at}
     # emit both event names so all variants of your frontend receive the sentence
-    emit("start_game", {"sentence": sentence, "level": level}, to=level)
-    emit("new_sentence", {"sentence": sentence, "level": level}, to=level)
-    print(f"[RACE START] Level {level} — Sentence sent to {len(room_players(level))} players")
+    emit("start_game", payload, to=room)
+    emit("new_sentence", payload, to=room)
+    print(f"[RACE START] {room} — Sentence sent to {len(room_players(room))} players")
 
-@socketio.on("progress_update")
-def handle_progress_update(data):
-    sid = flask_request.sid  # type: ignore[attr-defined]
+def apply_progress(sid, data):
+    """Store a progress_update on the player; returns the player's race room or None."""
     p = players.get(sid)
     if not p:
-        return
+        return None
 
     # Accept progress either numeric or percentage
     try:
@@ -910,13 +3887,31 @@ def handle_progress_update(data):
     except Exception:
         wpm = int(p.get("wpm", 0) or 0)
 
+    monitor_progress(sid, progress)
     p["progress"] = progress
     p["wpm"] = wpm
+    record_keystrokes(sid, data.get("keys"))
+    record_race_event(sid, REPLAY_PROGRESS, max(0, min(100, progress)))
 
-    level = p.get("level", "beginner")
-    # emit both names for clients
-    emit("update_players", list(room_players(level)), to=level)
-    emit("update_progress", {"players": {pp["name"]: pp.get("progress", 0) for pp in room_players(level)}}, to=level)
+    room = p.get("room")
+    mark_slot_changed(room, sid)
+    return room
+
+
+def _coalesce_progress_update(sid, data, bucket):
+    # keep the newest values but fold the broadcast into one deferred flush
+    room = apply_progress(sid, data or {})
+    if room is not None:
+        schedule_room_flush(room, bucket.wait_time())
+
+
+@socketio.on("progress_update")
+@rate_limited("progress_update", coalesce=_coalesce_progress_update)
+def handle_progress_update(data):
+    sid = flask_request.sid  # type: ignore[attr-defined]
+    room = apply_progress(sid, data)
+    if room is not None:
+        broadcast_room_state(room)
 
 @socketio.on("race_finished")
 def handle_race_finished(data):
@@ -925,35 +3920,55 @@ def handle_race_finished(data):
     if not user_info:
         return
 
+    # server-side race time, compensated for this connection's latency
+    shard = _shards.get(user_info.get("room")) or {}
+    duration = None
+    if shard.get("race_start_at"):
+        finished_at = time.time() - one_way_delay(sid)
+        # the client's own finish stamp, mapped onto our clock, beats the arrival estimate when it agrees
+        client_finish = data.get("finished_at")
+        if isinstance(client_finish, (int, float)) and abs(client_finish - client_offset(sid) - finished_at) < timing_tolerance(sid):
+            finished_at = client_finish - client_offset(sid)
+        duration = round(finished_at - shard["race_start_at"], 3)
+        client_time = data.get("time")
+        if isinstance(client_time, (int, float)) and abs(client_time - duration) < timing_tolerance(sid):
+            duration = client_time
+
+    try:
+        wpm = int(float(data.get("wpm", 0) or 0))
+    except Exception:
+        wpm = 0
+    record_race_event(sid, REPLAY_FINISH, wpm)
+    reasons = check_race_finish(sid, wpm)
+
+    # the server decides the winner (the client's "won" flag is ignored): the
+    # first clean finish of the running race beats the other racers in it
+    won = False
+    opponents = []
+    if shard.get("race_start_at") and sid in shard.get("racers", ()) and not reasons and shard.get("winner") is None:
+        shard["winner"] = sid
+        won = True
+        opponents = [players[s].get("username") for s in shard["racers"] if s != sid and s in players]
+    mark_shard_finished(sid, user_info.get("room"))
+
     username = user_info.get("username")
     if not username:
         return
 
-    users = load_json(USERS_FILE, {})
-    user = users.get(username, {})
-    levels_data = load_json(LEVELS_FILE, {})
-
-    wpm = int(data.get("wpm", 0) or 0)
-    won = bool(data.get("won", False))
-
-    # Update performance
-    user["races_played"] = user.get("races_played", 0) + 1
-    user["total_wpm"] = user.get("total_wpm", 0) + wpm
-    user["avg_wpm"] = round(user["total_wpm"] / user["races_played"], 2)
-
-    if won:
-        user["wins"] = user.get("wins", 0) + 1
-
-    old_level = user.get("level", "beginner")
-    new_level = calculate_level(user, levels_data)
-    leveled_up = new_level != old_level
-    user["level"] = new_level
-
-    users[username] = user
-    save_json(USERS_FILE, users)
+    if reasons:
+        # hold back the race and the history save the client sends next
+        quarantine_result(username, "race", reasons, {"wpm": wpm, "won": won, "time": duration, "room": user_info.get("room")})
+        _quarantine_holds[username] = (time.time() + 120, reasons)
+        level = load_json(data_path("users.json"), {}).get(username, {}).get("level", user_info.get("level"))
+        result = {"level": level, "leveled_up": False, "promotion": None}
+    else:
+        result = apply_race_result(username, wpm, won, opponents)
+    new_level = result["level"]
+    leveled_up = result["leveled_up"]
 
-    reward_text = levels_data.get(new_level, {}).get("reward", "")
-    description = levels_data.get(new_level, {}).get("description", "")
+    lvl_meta = get_level_table().meta(new_level)
+    reward_text = lvl_meta.get("reward", "")
+    description = lvl_meta.get("description", "")
 
     # emit level update back to the single user (use to=sid for SocketIO)
     emit(
@@ -963,6 +3978,9 @@ def handle_race_finished(data):
             "reward": reward_text,
             "description": description,
             "leveled_up": leveled_up,
+            "promotion": result["promotion"],
+            "time": duration,
+            "quarantined": bool(reasons),
         },
         to=sid,
     )
@@ -972,25 +3990,21 @@ def handle_race_finished(data):
 # -----------------------------------------------------
 # Level progression helper used above (keeps your original formula)
 # --\`-------------------------------------------------
-def calculate_level(user_data, levels_data):
-    """Determine user's level based on WPM and wins."""
+def calculate_level(user_data, level_table):
+    """Determine user's level based on WPM and wins (level_table: LevelTable or raw levels dict)."""
+    if not isinstance(level_table, LevelTable):
+        level_table = LevelTable(level_table)
     wpm = user_data.get("avg_wpm", 0)
     wins = user_data.get("wins", 0)
     current = user_data.get("level", "beginner")
 
-    # Go through levels in order
-    for name, info in levels_data.items():
-        # expect "range": [min, max]
-        rng = info.get("range", [0, 9999])
-        if len(rng) >= 2:
-            min_wpm, max_wpm = rng[0], rng[1]
-        else:
-            min_wpm, max_wpm = rng[0], 9999
-        if min_wpm <= wpm <= max_wpm and wins >= 3:
+    if wins >= 3:
+        name = level_table.level_for_wpm(wpm)
+        if name:
             return name
     return current or "beginner"
 
-@app.route("/api/user")
+@web.route("/api/user")
 def api_user():
     """Returns the currently logged-in user (for JS to sync state)."""
     u = current_user()
@@ -1007,20 +4021,20 @@ def api_user():
 # -----------------------------------------------------
 # Admin API — Pending Upgrades Management
 # -----------------------------------------------------
-@app.route("/api/admin/pending_upgrades")
+@web.route("/api/admin/pending_upgrades")
 def api_pending_upgrades():
     user = current_user()
     if not user or user.get("role") != "admin":
         return jsonify([]), 403
 
-    users = load_json(USERS_FILE, {})
+    users = load_json(data_path("users.json"), {})
     pending = [
         {"username": uname, "pending": u.get("pending_upgrade_to"), "amount": u.get("pending_amount", 0), "status": u.get("pending_status", "pending")}
         for uname, u in users.items() if u.get("pending_upgrade_to")
     ]
     return jsonify(pending)
 
-@app.route("/api/admin/mark_paid", methods=["POST"])
+@web.route("/api/admin/mark_paid", methods=["POST"])
 def api_mark_paid():
     user = current_user()
     if not user or user.get("role") != "admin":
@@ -1028,7 +4042,7 @@ def api_mark_paid():
 
     data = request.get_json() or {}
     uname = data.get("username")
-    users = load_json(USERS_FILE, {})
+    users = load_json(data_path("users.json"), {})
     if uname in users and users[uname].get("pending_upgrade_to"):
         # apply requested plan
         target = users[uname].pop("pending_upgrade_to", None)
@@ -1036,23 +4050,56 @@ def api_mark_paid():
         # clear pending metadata
         users[uname].pop("pending_amount", None)
         users[uname].pop("pending_status", None)
-        save_json(USERS_FILE, users)
+        save_json(data_path("users.json"), users)
         return jsonify({"ok": True})
     return jsonify({"error": "invalid user"}), 400
 
-@app.after_request
+@web.route("/api/admin/anticheat")
+def api_anticheat_stats():
+    user = current_user()
+    if not user or user.get("role") != "admin":
+        return jsonify({"error": "unauthorized"}), 403
+    return jsonify({
+        **_anticheat_stats,
+        "monitored_racers": len(_monitors),
+        "limits": {"max_wpm": ANTICHEAT_MAX_WPM, "max_burst_cps": ANTICHEAT_MAX_BURST_CPS},
+        "recent": list(_recent_quarantine)[::-1],
+    })
+
+@web.route("/api/admin/rtt")
+def api_rtt_stats():
+    user = current_user()
+    if not user or user.get("role") != "admin":
+        return jsonify({"error": "unauthorized"}), 403
+    return jsonify(rtt_summary())
+
+@web.route("/api/admin/socket_stats")
+def api_socket_stats():
+    user = current_user()
+    if not user or user.get("role") != "admin":
+        return jsonify({"error": "unauthorized"}), 403
+    return jsonify({
+        **_socket_stats,
+        "connections": len(players),
+        "spectators": len(_spectators),
+        "parked_sessions": len(_parked),
+        "limits": {event: {"rate": r, "burst": b} for event, (r, b) in SOCKET_RATE_LIMITS.items()},
+        "max_outbound_queue": SOCKET_MAX_OUTBOUND_QUEUE,
+    })
+
+@web.after_request
 def add_no_cache_headers_api(response):
     """Prevent caching on JSON routes so new sentences always load fresh."""
     if request.path.startswith("/api/"):
         response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     return response
 
-@app.after_request
+@web.after_request
 def add_no_cache_headers(response):
     if request.path.startswith("/api/"):
         response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     return response
-@app.route("/save_history", methods=["POST"])
+@web.route("/save_history", methods=["POST"])
 def save_history():
     """Save typing test result to the user's history (safe parsing + normalized fields)."""
     try:
@@ -1099,27 +4146,36 @@ def save_history():
 }
 
 
+    reasons = screen_saved_result(username, entry["wpm"])
+    if reasons:
+        quarantine_result(username, "save_history", reasons, entry)
+        return jsonify({"success": False, "quarantined": True, "reasons": reasons}), 202
+
     # Ensure data dir
-    os.makedirs("data/history", exist_ok=True)
-    user_file = os.path.join("data/history", f"{username}.json")
+    os.makedirs(data_path("history"), exist_ok=True)
+    user_file = os.path.join(data_path("history"), f"{username}.json")
 
-    # Load existing history if present
-    history = []
-    if os.path.exists(user_file):
-        try:
-            with open(user_file, "r", encoding="utf-8") as f:
-                history = json.load(f) or []
-        except Exception:
-            history = []
+    with history_lock(user_file):
+        # Load existing history if present
+        history = []
+        if os.path.exists(user_file):
+            try:
+                with open(user_file, "r", encoding="utf-8") as f:
+                    history = json.load(f) or []
+            except Exception:
+                history = []
 
-    # Append and save
-    history.append(entry)
-    try:
-        with open(user_file, "w", encoding="utf-8") as f:
-            json.dump(history, f, indent=2)
-    except Exception as e:
-        print(f"[SAVE_HISTORY] Failed to write {user_file}: {e}")
-        return jsonify({"success": False, "message": "Failed to save history"}), 500
+        # Append and save
+        history.append(entry)
+        try:
+            with open(user_file, "w", encoding="utf-8") as f:
+                json.dump(history, f, indent=2)
+        except Exception as e:
+            print(f"[SAVE_HISTORY] Failed to write {user_file}: {e}")
+            return jsonify({"success": False, "message": "Failed to save history"}), 500
+    bump_data_version(f"history:{username}")
+    record_leaderboard_run(username, entry["level"], entry["wpm"], entry["accuracy"], entry["timestamp"])
+    update_bigram_profile(username, data.get("keystrokes"))
 
     # Debug log
     print(f"[SAVE_HISTORY] {username} ({plan}) — {entry['wpm']} WPM, {entry['accuracy']}%, {entry['level']}")
@@ -1128,11 +4184,87 @@ def save_history():
 
 
 
+# -----------------------------------------------------
+# App factory & deferred warm-up
+# -----------------------------------------------------
+# Importing this module builds no app: gunicorn runs 'app:create_app()' and
+# `flask --app app` finds the factory. create_app() only writes defaults for
+# missing data files (admin user, empty history and sentences, placeholder
+# levels; existing files are not even read) so no early /login or /register
+# can write users.json first. Each app keeps its DATA_DIR in app.config and
+# data_path() resolves against the current app. Leaderboards, the sentence index and the asset build are
+# loaded by warm_up(), which (in "background" mode) starts on the first
+# request or /readyz probe and reports progress through /readyz.
+_warmup = {"state": "idle", "started": None, "finished": None, "error": None}
+
+
+def warm_up(app):
+    _warmup.update(state="running", started=time.time(), error=None)
+    try:
+        with app.app_context():
+            init_data_files()
+            compile_current_corpus()
+            seed_leaderboards()
+            get_sentence_index()
+            get_level_table()
+            if app.config.get("BUILD_ASSETS"):
+                try:
+                    build_assets()
+                except Exception as e:
+                    # plain /static/ URLs still work if the build dir is read-only
+                    print(f"[ASSETS] build failed, falling back to /static: {e}")
+        _warmup.update(state="ready", finished=time.time())
+        print(f"[WARM_UP] ready in {_warmup['finished'] - _warmup['started']:.2f}s")
+    except Exception as e:
+        _warmup.update(state="failed", finished=time.time(), error=str(e))
+        print(f"[WARM_UP] failed: {e}")
+
+
+def start_warm_up(app):
+    """Kick off the background warm-up once (and again after a failure)."""
+    if _warmup["state"] in ("idle", "failed"):
+        _warmup["state"] = "running"
+        spawn(warm_up, app, app=app)
+    start_history_compaction(app)
+
+
+@web.before_request
+def ensure_warm_up_started():
+    if _warmup["state"] in ("idle", "failed") and current_app.config.get("WARM_UP") == "background":
+        start_warm_up(current_app._get_current_object())
+
+
+@web.route("/readyz")
+def readyz():
+    """Readiness probe: 200 once warm-up finished, 503 while loading (or failed)."""
+    ready = _warmup["state"] == "ready"
+    return jsonify({"ready": ready, **_warmup}), (200 if ready else 503)
+
+
+def create_app(config=None):
+    """Build the Flask app (and bind socketio) from a config object; see Config."""
+    app = Flask(__name__)
+    app.config.from_object(config or Config)
+    app.secret_key = app.config["SECRET_KEY"]
+    web.init_app(app)
+    socketio.init_app(app, cors_allowed_origins="*")
+    _warmup.update(state="idle", started=None, finished=None, error=None)
+    if app.config.get("WARM_UP") != "off":
+        with app.app_context():
+            init_data_files()
+    if app.config.get("WARM_UP") == "sync":
+        warm_up(app)
+        start_history_compaction(app)
+    return app
+
+
 # -----------------------------------------------------
 # Run server
 # -----------------------------------------------------
 
 if __name__ == "__main__":
+    app = create_app()
     port = int(os.environ.get("PORT", 5000))
     print(f"Starting TypeForge with levels + multiplayer on port {port}")
+    start_warm_up(app)
     socketio.run(app, host="0.0.0.0", port=port, debug=False, use_reloader=False)
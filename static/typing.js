@@ -32,6 +32,8 @@ document.addEventListener("DOMContentLoaded", () => {
   let currentSentence = "";
   let started = false;
   let recentSentences = [];
+  let keystrokes = [];  // [[ms_since_start, typed, expected], ...] for the server's bigram drills
+  let lastTyped = "";
 
   const levelDurations = {
     easy: 30,
@@ -160,6 +162,8 @@ document.addEventListener("DOMContentLoaded", () => {
     inputBox.focus();
     started = true;
     startTime = Date.now();
+    keystrokes = [];
+    lastTyped = inputBox.value;
 
     timerDisplay.textContent = `${timeLeft}s`;
     progressBar.style.width = "100%";
@@ -183,6 +187,15 @@ document.addEventListener("DOMContentLoaded", () => {
   const typed = inputBox.value;
   const target = currentSentence;
 
+  // record each newly typed character against the one expected at its position
+  const at = Date.now() - startTime;
+  let same = 0;
+  while (same < typed.length && same < lastTyped.length && typed[same] === lastTyped[same]) same++;
+  for (let i = same; i < typed.length && keystrokes.length < 5000; i++) {
+    keystrokes.push([at, typed[i], target[i] || ""]);
+  }
+  lastTyped = typed;
+
   // Highlight each character
   let highlighted = "";
   for (let i = 0; i < target.length; i++) {
@@ -400,7 +413,8 @@ const payload = {
   wpm,
   accuracy,
   time: levelDurations[level] - timeLeft,
-  status: "completed"
+  status: "completed",
+  keystrokes
 };
 
     // ✅ Send to Flask /save_history endpoint
@@ -489,7 +503,7 @@ const payload = {
   if (!table) return; // Not on leaderboard page
   if (!document.querySelector("#leaderboard-table")) return; // Exit if not on leaderboard page
   try {
-    const res = await fetch("/api/leaderboard");
+    const res = await fetch("/api/leaderboard" + window.location.search);
     if (!res.ok) throw new Error("Failed to refresh leaderboard");
     const data = await res.json();
 
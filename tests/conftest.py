@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as typeforge  # noqa: E402
+
+# per-process socket/race state that would otherwise leak from one test into the next
+_RESET = ("players", "_shards", "_slot_tables", "_compact_clients", "_pending_flushes", "_race_recordings",
+          "_monitors", "_quarantine_holds", "_resume_tokens", "_session_tokens", "_parked", "_clock",
+          "_rate_buckets", "_spectators", "_spectator_loops", "_leaderboards", "_data_versions", "_corpus_compiles")
+
+
+def make_config(data_dir, warm_up="sync"):
+    class TestConfig(typeforge.Config):
+        DATA_DIR = str(data_dir)
+        WARM_UP = warm_up
+        BUILD_ASSETS = False
+        TESTING = True
+    return TestConfig
+
+
+@pytest.fixture(autouse=True)
+def reset_state():
+    for name in _RESET:
+        getattr(typeforge, name).clear()
+    typeforge._clock_loop["running"] = True  # tests ping explicitly; no background loop
+    typeforge.fragment_cache.entries.clear()
+    typeforge.fragment_cache.size = 0
+    yield
+
+
+@pytest.fixture
+def flask_app(tmp_path):
+    app = typeforge.create_app(make_config(tmp_path))
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def client(flask_app):
+    return flask_app.test_client()
+
+
+def login(flask_app, username, **fields):
+    """Add `username` to users.json and return a test client logged in as them."""
+    users = typeforge.load_json(typeforge.data_path("users.json"), {})
+    users[username] = {"password": "x", "role": "user", "plan": "premium_plus", "level": "beginner", **fields}
+    typeforge.save_json(typeforge.data_path("users.json"), users)
+    client = flask_app.test_client()
+    with client.session_transaction() as s:
+        s["username"] = username
+    return client
@@ -0,0 +1,741 @@
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+import app as typeforge
+from conftest import login, make_config
+
+
+# -----------------------------------------------------
+# App factory
+# -----------------------------------------------------
+def test_create_app_seeds_temp_data_dir(tmp_path, client):
+    users = json.load(open(tmp_path / "users.json"))
+    assert users[typeforge.ADMIN_USERNAME]["role"] == "admin"
+    for name in ("history.json", "sentences.json", "levels.json"):
+        assert (tmp_path / name).exists()
+    assert client.get("/readyz").status_code == 200
+
+
+def test_admin_login(client):
+    r = client.post("/login", data={"username": typeforge.ADMIN_USERNAME, "password": typeforge.ADMIN_PASSWORD})
+    assert r.status_code == 302 and r.headers["Location"].endswith("/admin_dashboard")
+
+
+def test_register_before_background_warm_up_keeps_admin(tmp_path):
+    flask_app = typeforge.create_app(make_config(tmp_path, warm_up="background"))
+    client = flask_app.test_client()
+    client.post("/register", data={"username": "alice", "password": "pw"})
+    users = json.load(open(tmp_path / "users.json"))
+    assert typeforge.ADMIN_USERNAME in users and "alice" in users
+    deadline = time.time() + 10
+    while client.get("/readyz").status_code != 200 and time.time() < deadline:
+        time.sleep(0.05)
+    assert client.get("/readyz").status_code == 200
+
+
+def test_warm_up_off_leaves_data_dir_alone(tmp_path):
+    typeforge.create_app(make_config(tmp_path, warm_up="off"))
+    assert not os.listdir(tmp_path)
+
+
+def test_import_builds_no_app():
+    assert not hasattr(typeforge, "app")
+
+
+def test_existing_data_files_are_not_read(tmp_path):
+    (tmp_path / "users.json").write_text("not json")
+    typeforge.create_app(make_config(tmp_path, warm_up="off"))
+    typeforge.create_app(make_config(tmp_path, warm_up="background"))
+    assert (tmp_path / "users.json").read_text() == "not json"
+    assert (tmp_path / "levels.json").exists()
+
+
+def test_apps_keep_their_own_data_dirs(tmp_path):
+    first = typeforge.create_app(make_config(tmp_path / "a", warm_up="off"))
+    second = typeforge.create_app(make_config(tmp_path / "b", warm_up="off"))
+    with first.app_context():
+        assert typeforge.data_path("users.json") == str(tmp_path / "a" / "users.json")
+    with second.app_context():
+        assert typeforge.data_path("users.json") == str(tmp_path / "b" / "users.json")
+
+
+# -----------------------------------------------------
+# Rolling leaderboards
+# -----------------------------------------------------
+def _run(username, wpm, ts, accuracy=95):
+    return {"username": username, "level": "easy", "wpm": wpm, "accuracy": accuracy, "timestamp": ts}
+
+
+def test_rolling_leaderboard_evicts_buckets_that_leave_the_window():
+    board = typeforge.RollingLeaderboard(bucket_seconds=3600, bucket_count=24)
+    now = 1_000 * 86400
+    board.add(_run("old", 120, now - 23 * 3600), now)
+    board.add(_run("new", 80, now - 60), now)
+    board.add(_run("stale", 200, now - 25 * 3600), now)  # already outside the window
+    assert [e["username"] for e in board.top(now=now)] == ["old", "new"]
+
+    version = board.current_version(now)
+    later = now + 2 * 3600
+    assert [e["username"] for e in board.top(now=later)] == ["new"]
+    assert board.current_version(later) > version and len(board.buckets) == 1
+
+
+def test_rolling_leaderboard_keeps_best_run_and_bounds_buckets():
+    board = typeforge.RollingLeaderboard(bucket_seconds=None, capacity=2)
+    board.add(_run("ann", 50, 10), 10)
+    board.add(_run("ann", 40, 20), 20)  # slower run doesn't replace the best
+    board.add(_run("bob", 60, 30), 30)
+    board.add(_run("cy", 70, 40), 40)  # over capacity: the slowest user goes
+    assert [(e["username"], e["wpm"]) for e in board.top()] == [("cy", 70), ("bob", 60)]
+
+
+# -----------------------------------------------------
+# Race shards
+# -----------------------------------------------------
+def test_last_unfinished_racer_leaving_reopens_the_shard(flask_app):
+    shard = typeforge.find_shard("beginner", 0)
+    room = shard["room"]
+    for sid in ("fast", "slow"):
+        shard["sids"].add(sid)
+        typeforge.players[sid] = {"name": sid, "room": room}
+    shard["started_at"] = shard["race_start_at"] = time.time()
+    shard["racers"] = {"fast", "slow"}
+    race_id = shard["race_id"] = typeforge.start_race_recording(shard, "abc", shard["race_start_at"])
+    typeforge.record_race_event("slow", typeforge.REPLAY_KEY, ord("a"), 100)
+
+    typeforge.mark_shard_finished("fast", room)
+    assert shard["started_at"] is not None
+    typeforge.leave_shard("slow", room)
+
+    assert shard["started_at"] is None and "race_id" not in shard and not shard["finished"]
+    assert race_id not in typeforge._race_recordings
+    assert os.path.exists(typeforge.data_path("replays", f"{race_id}.bin"))
+
+
+# -----------------------------------------------------
+# Static assets
+# -----------------------------------------------------
+def test_build_assets_fingerprints_subdirectories(tmp_path, monkeypatch, client):
+    static = tmp_path / "static"
+    (static / "js").mkdir(parents=True)
+    (static / "style.css").write_text("body { color: red }")
+    (static / "js" / "chart.js").write_text("var chart = 1;")
+    monkeypatch.setattr(typeforge, "STATIC_DIR", str(static))
+    monkeypatch.setattr(typeforge, "ASSET_BUILD_DIR", str(static / "build"))
+    monkeypatch.setattr(typeforge, "_asset_manifest", {})
+
+    manifest = typeforge.build_assets()
+    assert set(manifest) == {"style.css", "js/chart.js"}
+    assert manifest["js/chart.js"].startswith("js/chart.")
+    assert typeforge.build_assets() == manifest  # rebuild skips the build dir itself
+    assert not [f for f in os.listdir(static / "build" / "js") if f.endswith(".tmp")]
+
+    with typeforge.current_app.test_request_context():
+        url = typeforge.asset_url("static", filename="js/chart.js")
+    assert url == "/assets/" + manifest["js/chart.js"]
+    r = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert r.status_code == 200 and r.headers["Content-Encoding"] == "gzip"
+
+
+# -----------------------------------------------------
+# Socket rate limiting & backpressure
+# -----------------------------------------------------
+class _Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_refills_up_to_burst(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(typeforge.time, "monotonic", clock)
+    bucket = typeforge.TokenBucket(rate=10, burst=3)
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait_time() == pytest.approx(0.1)
+    clock.now += 10  # a long idle spell still holds only `burst` tokens
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+
+def test_rate_limited_coalesces_or_drops_over_budget(monkeypatch):
+    monkeypatch.setattr(typeforge.time, "monotonic", _Clock())
+    monkeypatch.setattr(typeforge, "flask_request", type("Req", (), {"sid": "sid-rl"}))
+    monkeypatch.setitem(typeforge.SOCKET_RATE_LIMITS, "test_event", (1.0, 2.0))
+    handled, coalesced = [], []
+
+    @typeforge.rate_limited("test_event", coalesce=lambda sid, data, bucket: coalesced.append((sid, data)))
+    def with_coalesce(data):
+        handled.append(data)
+
+    for n in range(5):
+        with_coalesce({"n": n})
+    assert [d["n"] for d in handled] == [0, 1]
+    assert coalesced == [("sid-rl", {"n": 2}), ("sid-rl", {"n": 3}), ("sid-rl", {"n": 4})]
+
+    dropped = typeforge._socket_stats["dropped"].get("test_event", 0)
+    typeforge.rate_limited("test_event")(handled.append)({"n": 5})  # same sid, bucket still empty
+    assert len(handled) == 2 and typeforge._socket_stats["dropped"]["test_event"] == dropped + 1
+
+
+def test_stalled_sids_skips_backed_up_and_disconnects_hopeless(flask_app, monkeypatch):
+    backlog = {"ok": 0, "slow": typeforge.SOCKET_MAX_OUTBOUND_QUEUE, "dead": typeforge.SOCKET_DISCONNECT_QUEUE}
+    monkeypatch.setattr(typeforge, "outbound_backlog", backlog.get)
+    disconnected = []
+    monkeypatch.setattr(typeforge.socketio.server, "disconnect", lambda sid, namespace=None: disconnected.append(sid))
+    assert typeforge.stalled_sids(["ok", "slow", "dead"]) == ["slow", "dead"]
+    assert disconnected == ["dead"]
+
+
+# -----------------------------------------------------
+# Clock sync
+# -----------------------------------------------------
+def test_clock_offset_comes_from_the_lowest_rtt_sample():
+    # client clock 2 s ahead; 100 ms round trip, 10 ms spent on the client
+    state = typeforge.record_clock_sample("sid-clock", 1000.0, 1002.05, 1002.06, 1000.11)
+    assert state["srtt"] == pytest.approx(0.1) and typeforge.client_offset("sid-clock") == pytest.approx(2.0)
+    # a slow sample with a lopsided path: the RTT average moves, the offset doesn't
+    typeforge.record_clock_sample("sid-clock", 1010.0, 1012.7, 1012.7, 1010.9)
+    assert typeforge.client_offset("sid-clock") == pytest.approx(2.0)
+    assert typeforge._clock["sid-clock"]["srtt"] == pytest.approx(0.875 * 0.1 + 0.125 * 0.9)
+    assert typeforge.one_way_delay("sid-clock") == pytest.approx(typeforge._clock["sid-clock"]["srtt"] / 2)
+    assert 1.0 <= typeforge.timing_tolerance("sid-clock") <= 5.0
+    assert typeforge.timing_tolerance("unknown") == 5.0 and typeforge.client_offset("unknown") == 0.0
+
+
+def test_time_pong_answers_with_clock_sync(flask_app):
+    socket = typeforge.socketio.test_client(flask_app, flask_test_client=login(flask_app, "racer"))
+    try:
+        socket.emit("join_room", {"room": "beginner"})
+        (sid,) = [s for s in typeforge._clock if typeforge._clock[s]["pending"]]
+        ping_id, t0 = next(iter(typeforge._clock[sid]["pending"].items()))
+        socket.get_received()
+        socket.emit("time_pong", {"id": ping_id + 99, "t0": t0, "t1": t0, "t2": t0})  # unknown ping
+        assert not [m for m in socket.get_received() if m["name"] == "clock_sync"]
+        socket.emit("time_pong", {"id": ping_id, "t0": t0, "t1": t0 + 1.0, "t2": t0 + 1.0})
+        (sync,) = [m["args"][0] for m in socket.get_received() if m["name"] == "clock_sync"]
+        assert sync["offset_ms"] == pytest.approx(1000, abs=50) and sync["rtt_ms"] >= 0
+    finally:
+        socket.disconnect()
+
+
+# -----------------------------------------------------
+# Session resume
+# -----------------------------------------------------
+def _connect(flask_app, client, **query):
+    socket = typeforge.socketio.test_client(
+        flask_app, flask_test_client=client, query_string="&".join(f"{k}={v}" for k, v in query.items()))
+    return socket, {m["name"]: m["args"][0] for m in socket.get_received()}
+
+
+def test_reconnect_with_token_resumes_the_parked_seat(flask_app):
+    client = login(flask_app, "racer")
+    first, events = _connect(flask_app, client)
+    token = events["match_found"]["resume_token"]
+    (old_sid,) = typeforge.players
+    slot = typeforge._slot_table(typeforge.players[old_sid]["room"])["slots"][old_sid]
+    first.disconnect()
+    assert old_sid in typeforge._parked and old_sid in typeforge.players  # seat held
+
+    second, events = _connect(flask_app, client, resume=token)
+    try:
+        assert "match_found" not in events and events["session_resumed"]["resume_token"] == token
+        (new_sid,) = typeforge.players
+        room = typeforge.players[new_sid]["room"]
+        assert new_sid != old_sid and not typeforge._parked
+        assert typeforge._slot_table(room)["slots"] == {new_sid: slot}
+        assert typeforge._shards[room]["sids"] == {new_sid}
+    finally:
+        second.disconnect()
+
+
+def test_reconnect_without_token_releases_the_ghost(flask_app):
+    client = login(flask_app, "racer")
+    first, _ = _connect(flask_app, client)
+    (old_sid,) = typeforge.players
+    first.disconnect()
+    second, events = _connect(flask_app, client)
+    try:
+        assert "match_found" in events and old_sid not in typeforge.players and not typeforge._parked
+        assert len(typeforge.players) == 1
+    finally:
+        second.disconnect()
+
+
+def test_parked_seat_expires_after_the_grace_period(flask_app, monkeypatch):
+    monkeypatch.setattr(typeforge, "SESSION_RESUME_GRACE", 0.05)
+    socket, events = _connect(flask_app, login(flask_app, "racer"))
+    token = events["match_found"]["resume_token"]
+    socket.disconnect()
+    deadline = time.time() + 2
+    while typeforge.players and time.time() < deadline:
+        time.sleep(0.02)
+    assert not typeforge.players and not typeforge._parked and token not in typeforge._resume_tokens
+
+
+# -----------------------------------------------------
+# Compact socket protocol
+# -----------------------------------------------------
+def test_progress_delta_carries_only_unacked_changes():
+    room = "beginner:9"
+    for sid, name in (("s1", "ann"), ("s2", "bob")):
+        typeforge.players[sid] = {"name": name, "username": name, "room": room, "progress": 0, "wpm": 0}
+        typeforge.assign_slot(room, sid)
+    client = {"encoding": "array", "acked": 0}
+    first = typeforge.encode_progress_delta(room, client)
+    assert sorted(first["u"]) == [[0, 0, 0], [1, 0, 0]]
+
+    client["acked"] = first["v"]
+    assert typeforge.encode_progress_delta(room, client) is None
+    typeforge.players["s2"].update(progress=40, wpm=55)
+    typeforge.mark_slot_changed(room, "s2")
+    delta = typeforge.encode_progress_delta(room, client)
+    assert delta == {"v": first["v"] + 1, "u": [[1, 40, 55]]}
+
+    binary = typeforge.encode_progress_delta(room, {"encoding": "binary", "acked": first["v"]})
+    assert binary == typeforge._DELTA_HEADER.pack(delta["v"]) + typeforge._DELTA_ENTRY.pack(1, 40, 55)
+
+
+def test_released_slots_are_reused_lowest_first():
+    room = "beginner:9"
+    slots = [typeforge.assign_slot(room, sid) for sid in ("a", "b", "c")]
+    assert slots == [0, 1, 2] and typeforge.assign_slot(room, "b") == 1
+    typeforge.release_slot(room, "c")
+    typeforge.release_slot(room, "a")
+    assert typeforge.assign_slot(room, "d") == 0 and typeforge.assign_slot(room, "e") == 2
+    assert [s for s, *_ in typeforge.compact_roster(room)["slots"]] == [0, 1, 2]
+
+
+# -----------------------------------------------------
+# Spectators
+# -----------------------------------------------------
+def test_spectator_snapshot_groups_a_levels_rooms():
+    typeforge.players.update({
+        "a": {"name": "ann", "level": "beginner", "room": "beginner:1", "progress": 40, "wpm": 50},
+        "b": {"name": "bob", "level": "beginner", "room": "beginner:2", "progress": 10, "wpm": 20},
+        "c": {"name": "cy", "level": "advanced", "room": "advanced:1", "progress": 90, "wpm": 90},
+        "d": {"name": "dee", "level": "beginner"},  # still in the lobby
+    })
+    typeforge._shards["beginner:1"] = {"started_at": 1.0}
+    snapshot = typeforge.spectator_snapshot("beginner")
+    assert snapshot == {"level": "beginner", "rooms": {
+        "beginner:1": {"players": {"ann": 40}, "wpm": {"ann": 50}, "started": True},
+        "beginner:2": {"players": {"bob": 10}, "wpm": {"bob": 20}, "started": False},
+    }}
+
+
+def test_spectators_get_snapshots_only_when_something_changed(flask_app, monkeypatch):
+    monkeypatch.setattr(typeforge, "SPECTATOR_INTERVAL", 0.02)
+    client = login(flask_app, "watcher")
+    socket = typeforge.socketio.test_client(flask_app, flask_test_client=client)
+    try:
+        socket.emit("spectate", {"level": "beginner"})
+        names = [m["name"] for m in socket.get_received()]
+        assert names.count("spectating") == 1 and names.count("spectator_snapshot") == 1
+        time.sleep(0.1)
+        quiet = [m for m in socket.get_received() if m["name"] == "spectator_snapshot"]
+        assert len(quiet) <= 1  # the loop's first snapshot, then nothing while idle
+
+        typeforge.players["racer"] = {"name": "ann", "level": "beginner", "room": "beginner:1", "progress": 30}
+        time.sleep(0.1)
+        updates = [m["args"][0] for m in socket.get_received() if m["name"] == "spectator_snapshot"]
+        assert len(updates) == 1 and updates[0]["rooms"]["beginner:1"]["players"] == {"ann": 30}
+    finally:
+        socket.disconnect()
+
+
+# -----------------------------------------------------
+# Replay varint codec
+# -----------------------------------------------------
+def test_varint_round_trip():
+    values = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 32 + 5]
+    buf = bytearray()
+    for v in values:
+        typeforge._write_varint(buf, v)
+    stream = io.BytesIO(bytes(buf))
+    assert [typeforge._read_varint(stream.read) for _ in values] == values
+    assert typeforge._read_varint(stream.read) is None
+
+
+def test_replay_round_trip(flask_app):
+    sid = "sid-replay"
+    shard = {"room": "beginner:1", "level": "beginner"}
+    typeforge._shards["beginner:1"] = shard
+    typeforge.players[sid] = {"name": "racer", "room": "beginner:1"}
+    try:
+        race_id = typeforge.start_race_recording(shard, "abc", 1000.0)
+        typeforge.record_race_event(sid, typeforge.REPLAY_KEY, ord("a"), 120)
+        typeforge.record_race_event(sid, typeforge.REPLAY_PROGRESS, 50, 400)
+        typeforge.record_race_event(sid, typeforge.REPLAY_KEY, ord("b"), 250)  # earlier than the progress record
+        typeforge.record_race_event(sid, typeforge.REPLAY_FINISH, 42, 900)
+        path = typeforge.finalize_race_recording(race_id)
+    finally:
+        typeforge.players.pop(sid, None)
+        typeforge._shards.pop("beginner:1", None)
+
+    header, *events = typeforge.iter_replay(path)
+    assert header["race_id"] == race_id and header["sentence"] == "abc" and header["players"] == ["racer"]
+    assert [(e["type"], e["t"], e["value"]) for e in events] == [
+        ("key", 120, ord("a")), ("progress", 400, 50), ("key", 250, ord("b")), ("finish", 900, 42),
+    ]
+
+
+def test_progress_update_keys_land_in_the_replay(flask_app):
+    shard = typeforge.find_shard("beginner", 0)
+    shard["sids"].add("sid-keys")
+    typeforge.players["sid-keys"] = {"name": "racer", "room": shard["room"]}
+    race_id = shard["race_id"] = typeforge.start_race_recording(shard, "ab", time.time())
+
+    # the shape multiplayer.html sends: per-key deltas, "\b" for a deletion
+    typeforge.apply_progress("sid-keys", {"progress": 50, "keys": [[100, "a"], [180, "x"], [260, "\b"]]})
+    header, *events = typeforge.iter_replay(typeforge.finalize_race_recording(race_id))
+    keys = [(e["t"], e["value"]) for e in events if e["type"] == "key"]
+    assert keys == [(100, ord("a")), (180, ord("x")), (260, 8)]
+
+
+# -----------------------------------------------------
+# Compiled corpus
+# -----------------------------------------------------
+def test_compiled_corpus_round_trip(tmp_path):
+    sentences = {"easy": ["The cat sat.", "A dog ran far away."], "hard": ["Quixotic zephyrs jumble, vexing wizards!"]}
+    levels = {"beginner": {"sentences": ["The cat sat.", "Über naïve café — ünïcode."]}}
+    path = str(tmp_path / "corpus" / "compiled.test.bin")
+    typeforge.compile_corpus(sentences, levels, path)
+    index = typeforge.SentenceIndex(typeforge.CompiledCorpus(path))
+
+    assert len(index.corpus) == 4  # the shared passage is stored once
+    assert sorted(index.names("sentences")) == ["easy", "hard"]
+    beginner = index.pool("levels", "beginner")
+    texts = {f["text"] for f in beginner.by_chars}
+    assert texts == {"The cat sat.", "Über naïve café — ünïcode."}
+    chars = [f["chars"] for f in beginner.by_chars]
+    assert chars == sorted(chars) == sorted(len(t) for t in texts)
+    assert len(index.pool("all")) == 5
+
+    ids, counts = index.postings("th")
+    assert [index.corpus.text(i) for i in ids] == ["The cat sat."]
+    assert list(counts) == [1]
+    assert index.pool("sentences", "easy").pick_by_length(12)["text"] in sentences["easy"]
+
+
+def test_drill_scans_densest_postings_first(tmp_path, monkeypatch):
+    sentences = {"easy": ["Then the cat sat on a mat today.", "The thin thistle thrives.", "A dog ran far away."]}
+    path = str(tmp_path / "corpus" / "compiled.drill.bin")
+    typeforge.compile_corpus(sentences, {}, path)
+    index = typeforge.SentenceIndex(typeforge.CompiledCorpus(path))
+    monkeypatch.setattr(typeforge, "DRILL_POSTINGS_CAP", 1)
+    assert typeforge.build_drill(index, [{"bigram": "th", "score": 1.0}]) == ["The thin thistle thrives."]
+
+
+MIXED_SAMPLE = [
+    "The cat sat on the mat.", "We went home.", "I like to run in the park with my dog.",
+    "Sam has a red hat and a big box.", "It is a sunny day so we play.",
+    "The quarterly report omitted several key variables.", "Our committee postponed the vote until Thursday.",
+    "Quixotic zephyrs jumble, vexing wizards' kaleidoscopic rhythms!",
+    'He said: "Don\'t; it\'s 3:45 p.m. -- #urgent (really)!"',
+    "Phlegmatic sphinxes quizzically juxtapose xylophones; wry gnomes vex them.",
+]
+
+
+def _ingest_buckets(client, texts):
+    admin = login(client.application, "boss", role="admin")
+    r = admin.post("/api/admin/corpus/ingest", data="\n".join(texts) + "\n")
+    assert r.status_code == 202
+    return {name: n for name, n in r.get_json()["buckets"].items() if n}
+
+
+def test_ingest_into_empty_corpus_spreads_buckets(client):
+    buckets = _ingest_buckets(client, MIXED_SAMPLE)
+    assert len(buckets) > 1 and sum(buckets.values()) == len(MIXED_SAMPLE)
+
+
+def test_ingest_into_tiny_corpus_spreads_buckets(tmp_path):
+    # too few passages for medians or quartiles: the import is split by its own quartiles
+    tiny = ["The man and the dog went to the park.", "She sat on the bench in the sun.", "They ate their lunch at home."]
+    (tmp_path / "sentences.json").write_text(json.dumps({"easy": tiny}))
+    flask_app = typeforge.create_app(make_config(tmp_path))
+    with flask_app.app_context():
+        buckets = _ingest_buckets(flask_app.test_client(), MIXED_SAMPLE)
+    assert len(buckets) == len(typeforge.CORPUS_BUCKETS)
+
+
+def test_ingest_with_overlapping_curated_buckets_spreads_buckets(tmp_path):
+    # the shipped corpus: its hard median sits below medium, so medians can't be the cut points
+    shutil.copy(os.path.join(os.path.dirname(typeforge.__file__), "data", "sentences.json"), tmp_path / "sentences.json")
+    flask_app = typeforge.create_app(make_config(tmp_path))
+    with flask_app.app_context():
+        index = typeforge.get_sentence_index()
+        medians = [p.by_difficulty[len(p) // 2]["difficulty"]
+                   for p in (index.pool("sentences", n) for n in typeforge.CORPUS_BUCKETS)]
+        assert medians != sorted(medians)
+        buckets = _ingest_buckets(flask_app.test_client(), MIXED_SAMPLE)
+    assert len(buckets) > 1
+
+
+def _length_ladder_index(tmp_path):
+    texts = [("word " * n).strip() + "." for n in range(2, 42, 2)]  # 10 .. 200 chars
+    path = str(tmp_path / "corpus" / "compiled.ladder.bin")
+    typeforge.compile_corpus({"easy": texts}, {}, path)
+    return typeforge.SentenceIndex(typeforge.CompiledCorpus(path))
+
+
+def test_pick_by_length_and_percentile(tmp_path):
+    pool = _length_ladder_index(tmp_path).pool("sentences", "easy")
+    for target in (10, 75, 200, 5000):
+        picked = pool.pick_by_length(target, spread=1)
+        nearest = min((f["chars"] for f in pool.by_chars), key=lambda c: abs(c - target))
+        assert abs(picked["chars"] - nearest) <= 10
+    difficulties = [f["difficulty"] for f in pool.by_difficulty]
+    assert difficulties == sorted(difficulties)
+    assert pool.pick_by_percentile(0, spread=0)["difficulty"] == difficulties[0]
+    assert pool.pick_by_percentile(100, spread=0)["difficulty"] == difficulties[-1]
+
+
+def test_api_sentences_by_duration(flask_app, client):
+    texts = [("word " * n).strip() + "." for n in range(2, 42, 2)]
+    typeforge.save_json(typeforge.data_path("sentences.json"), {"easy": texts})
+    typeforge.compile_current_corpus()
+    # 15 s at 40 wpm is 50 chars
+    data = client.get("/api/sentences?seconds=15&wpm=40").get_json()
+    assert abs(data["features"]["chars"] - 50) <= 20 and abs(data["estimated_seconds"] - 15) <= 6
+    assert "offline" not in data
+
+
+def test_sentence_index_serves_compiled_file(flask_app):
+    index = typeforge.get_sentence_index()
+    assert any(f.startswith("compiled.") for f in os.listdir(typeforge.data_path("corpus")))
+    assert index.pool("sentences", "easy") is not None
+
+
+# -----------------------------------------------------
+# Fragment cache
+# -----------------------------------------------------
+def test_fragment_cache_rerenders_on_new_version_and_evicts_lru():
+    cache = typeforge.FragmentCache(max_bytes=10)
+    renders = []
+
+    def render(text):
+        return lambda: renders.append(text) or text
+
+    assert cache.get("a", 1, render("aaaa")) == "aaaa"
+    assert cache.get("a", 1, render("stale")) == "aaaa"  # same version: a hit
+    assert cache.get("a", 2, render("AAAA")) == "AAAA"  # new version replaces it
+    cache.get("b", 1, render("bbbb"))
+    cache.get("a", 2, render("x"))  # touch "a" so "b" is least recent
+    cache.get("c", 1, render("cccc"))
+    assert set(cache.entries) == {"a", "c"} and cache.size == 8
+    cache.get("big", 1, render("z" * 11))  # larger than the budget: served, not kept
+    assert "big" not in cache.entries and renders == ["aaaa", "AAAA", "bbbb", "cccc", "z" * 11]
+    assert (cache.hits, cache.misses) == (2, 5)
+
+
+def test_history_rows_refresh_after_a_save(flask_app):
+    client = login(flask_app, "racer")
+    assert b"<td>77</td>" not in client.get("/history").data
+    r = client.post("/save_result", json={"difficulty": "easy", "wpm": 77, "accuracy": 98, "time": 30})
+    assert r.get_json()["success"]
+    assert b"<td>77</td>" in client.get("/history").data
+
+
+# -----------------------------------------------------
+# Level progression
+# -----------------------------------------------------
+def test_promotion_survives_a_slow_race(flask_app):
+    login(flask_app, "racer", races_played=3, total_wpm=60, wins=2, beaten={"beginner": ["a", "b"]})
+
+    promoted = typeforge.apply_race_result("racer", 35, True, ["c"])
+    assert promoted["level"] == "intermediate" and promoted["leveled_up"]
+
+    after = typeforge.apply_race_result("racer", 10, False)
+    assert after["level"] == "intermediate" and not after["leveled_up"]
+    assert typeforge.load_json(typeforge.data_path("users.json"), {})["racer"]["level"] == "intermediate"
+
+
+def test_ingest_compiles_in_the_background(flask_app, monkeypatch):
+    tasks = []
+    monkeypatch.setattr(typeforge, "spawn", lambda f, *args, app=None: tasks.append((f, args)))
+    old_index = typeforge.get_sentence_index()
+    admin = login(flask_app, "boss", role="admin")
+
+    r = admin.post("/api/admin/corpus/ingest", data="A brand new passage to type.\n")
+    assert r.status_code == 202 and r.get_json()["compiling"] and r.get_json()["added"] == 1
+    assert len(tasks) == 1
+    assert not os.path.exists(typeforge.compiled_corpus_path(typeforge.corpus_version()))
+    assert typeforge.get_sentence_index() is old_index  # previous corpus keeps serving
+    assert len(tasks) == 1  # no second compile while one is pending
+
+    f, args = tasks[0]
+    f(*args)
+    texts = {p["text"] for p in typeforge.get_sentence_index().pool("all").by_chars}
+    assert "A brand new passage to type." in texts
+
+
+def test_sentence_index_without_compiled_file_never_compiles(tmp_path, monkeypatch):
+    flask_app = typeforge.create_app(make_config(tmp_path))
+    tasks = []
+    monkeypatch.setattr(typeforge, "spawn", lambda f, *args, app=None: tasks.append(f))
+    with flask_app.app_context():
+        for name in os.listdir(typeforge.data_path("corpus")):
+            os.remove(typeforge.data_path("corpus", name))
+        typeforge._sentence_index.update(version=None, index=None, missing=None)
+        index = typeforge.get_sentence_index()
+        assert index.pool("sentences", "easy") is None and not os.listdir(typeforge.data_path("corpus"))
+    assert len(tasks) == 1
+
+
+# -----------------------------------------------------
+# History export
+# -----------------------------------------------------
+def test_json_item_stream_matches_json_load_across_chunks():
+    history = {"ann": [{"wpm": 50, "note": "[tricky], {\"quoted\"}"}, {"wpm": 60}], "meta": {"x": 1},
+               "bob": [], "cy": [{"wpm": 70, "nested": {"a": [1, 2]}}]}
+    text = json.dumps(history, indent=2)
+    for chunk in (1, 3, 7, 64):
+        items = list(typeforge._JsonItemStream(io.StringIO(text), chunk_size=chunk))
+        assert items == [(u, r) for u, runs in history.items() if isinstance(runs, list) for r in runs]
+    runs = [{"wpm": 1}, {"wpm": 2}]
+    assert list(typeforge._JsonItemStream(io.StringIO(json.dumps(runs)), chunk_size=2)) == [(None, r) for r in runs]
+
+
+def _seed_export_history():
+    typeforge.save_json(typeforge.data_path("history.json"), {
+        "ann": [{"wpm": "50", "accuracy": "97%", "difficulty": "easy", "timestamp": 1_700_000_000},
+                {"wpm": 65, "accuracy": 99, "level": "hard", "timestamp": 1_700_200_000}],
+    })
+    os.makedirs(typeforge.data_path("history"), exist_ok=True)
+    typeforge.save_json(typeforge.data_path("history", "bob.json"),
+                        [{"wpm": 80, "accuracy": 95, "level": "medium", "timestamp": 1_700_100_000}])
+
+
+def _expected_runs():
+    expected = []
+    for path, owner in ((typeforge.data_path("history", "bob.json"), "bob"), (typeforge.data_path("history.json"), None)):
+        stored = typeforge.load_json(path, {})
+        pairs = [(owner, r) for r in stored] if owner else [(u, r) for u, runs in stored.items() for r in runs]
+        expected += [{**typeforge.normalize_history_entry(r), "username": u} for u, r in pairs]
+    return expected
+
+
+def test_history_export_matches_stored_runs(flask_app):
+    _seed_export_history()
+    admin = login(flask_app, "boss", role="admin")
+    expected = _expected_runs()
+
+    ndjson = admin.get("/api/admin/export/history.ndjson").get_data(as_text=True)
+    assert [json.loads(line) for line in ndjson.splitlines()] == expected
+
+    rows = list(csv.reader(io.StringIO(admin.get("/api/admin/export/history.csv").get_data(as_text=True))))
+    assert rows[0] == typeforge.EXPORT_COLUMNS
+    assert rows[1:] == [[str(e.get(c, "")) for c in typeforge.EXPORT_COLUMNS] for e in expected]
+
+    packed = admin.get("/api/admin/export/history.ndjson?gzip=1")
+    assert packed.mimetype == "application/gzip" and gzip.decompress(packed.data).decode() == ndjson
+
+
+def test_history_export_date_filters_and_user_scope(flask_app):
+    _seed_export_history()
+    admin = login(flask_app, "boss", role="admin")
+
+    def stamps(url):
+        return [json.loads(line)["timestamp"] for line in admin.get(url).get_data(as_text=True).splitlines()]
+
+    assert stamps("/api/admin/export/history.ndjson?from=1700050000&to=1700150000") == [1_700_100_000]
+    day = time.strftime("%Y-%m-%d", time.localtime(1_700_200_000))
+    assert stamps(f"/api/admin/export/history.ndjson?from={day}") == [1_700_200_000]
+    assert stamps("/api/admin/export/history.ndjson?user=bob") == [1_700_100_000]
+    assert admin.get("/api/admin/export/history.ndjson?from=yesterday").status_code == 400
+    own = login(flask_app, "ann").get("/api/export/history.ndjson").get_data(as_text=True).splitlines()
+    assert {json.loads(line)["username"] for line in own} == {"ann"} and len(own) == 2
+
+
+# -----------------------------------------------------
+# Chart downsampling
+# -----------------------------------------------------
+def test_lttb_keeps_endpoints_budget_and_spikes():
+    points = [(x, 50 + (x % 7)) for x in range(1000)]
+    points[500] = (500, 400)  # one spike the chart must not lose
+    keep = typeforge.lttb(points, 50)
+    assert len(keep) == 50 and keep[0] == 0 and keep[-1] == 999
+    assert keep == sorted(set(keep)) and 500 in keep
+    assert typeforge.lttb(points[:10], 50) == list(range(10))  # under budget: everything
+
+
+def test_moving_average_is_trailing():
+    assert typeforge.moving_average([2, 4, 6, 8], 2) == [2, 3, 5, 7]
+
+
+def test_history_chart_endpoint_respects_points(flask_app):
+    base = 1_700_000_000
+    runs = [{"wpm": 40 + i % 20, "accuracy": 90 + i % 10, "timestamp": base + i * 60} for i in range(300)]
+    typeforge.save_json(typeforge.data_path("history.json"), {"racer": runs})
+    client = login(flask_app, "racer")
+    data = client.get("/api/chart/history?points=25&window=5").get_json()
+    assert data["total_runs"] == 300
+    for name in ("wpm", "accuracy", "wpm_avg", "accuracy_avg"):
+        series = data["series"][name]
+        assert len(series) == 25 and series[0][0] == base and series[-1][0] == base + 299 * 60
+    assert client.get("/api/chart/history?points=lots").status_code == 400
+
+
+# -----------------------------------------------------
+# History compaction
+# -----------------------------------------------------
+def test_compaction_waits_for_appends_and_folds_once(flask_app, monkeypatch):
+    import threading
+
+    monkeypatch.setattr(typeforge, "HISTORY_RETENTION_DAYS", 1)
+    path = typeforge.data_path("history.json")
+    old = {"wpm": 40, "accuracy": 95, "difficulty": "easy", "timestamp": 1_000_000}
+    typeforge.save_json(path, {"racer": [old]})
+
+    with typeforge.history_lock(path):  # another worker mid-append
+        history = typeforge.load_json(path, {})
+        worker = threading.Thread(target=lambda: flask_app.app_context().push() or typeforge.compact_history())
+        worker.start()
+        time.sleep(0.1)
+        history["racer"].append({"wpm": 55, "accuracy": 99, "difficulty": "easy", "timestamp": int(time.time())})
+        typeforge.save_json(path, history)
+    worker.join(5)
+
+    assert [r["wpm"] for r in typeforge.load_json(path, {})["racer"]] == [55]
+    assert typeforge.compact_history() == 0
+    (summary,) = typeforge.load_history_summaries("racer").values()
+    assert summary["count"] == 1 and summary["legacy_count"] == 1
+    assert not [f for f in os.listdir(typeforge.data_path()) if f.endswith(".lock")]
+
+
+# -----------------------------------------------------
+# Anti-cheat
+# -----------------------------------------------------
+def test_honest_finish_is_not_a_wpm_mismatch():
+    for chars, wpm in ((60, 60), (150, 100)):
+        monitor = typeforge.TypingMonitor("race", 1000.0, chars)
+        seconds = (chars / typeforge.CHARS_PER_WORD) / wpm * 60
+        for c in range(1, chars + 1):
+            monitor.update(1000.0 + seconds * c / chars, c * 100 / chars, 0.25, 5.0)
+        assert "wpm_mismatch" not in monitor.finish(1000.0 + seconds, wpm, 5.0)
+
+
+def test_finish_outside_a_race_is_quarantined(tmp_path, flask_app):
+    users = json.load(open(tmp_path / "users.json"))
+    users["racer"] = {"password": "x", "role": "user", "plan": "premium_plus", "level": "beginner"}
+    json.dump(users, open(tmp_path / "users.json", "w"))
+    client = flask_app.test_client()
+    with client.session_transaction() as s:
+        s["username"] = "racer"
+    socket = typeforge.socketio.test_client(flask_app, flask_test_client=client)
+    try:
+        socket.emit("race_finished", {"wpm": 900, "won": True})
+        update = [m["args"][0] for m in socket.get_received() if m["name"] == "level_update"][0]
+    finally:
+        socket.disconnect()
+    assert update["quarantined"]
+    racer = json.load(open(tmp_path / "users.json"))["racer"]
+    assert "avg_wpm" not in racer and "wins" not in racer